@@ -4,6 +4,9 @@
 import os
 import argparse
 from psd_html_generator import generate_psd_html
+from psd_log import get_logger
+
+logger = get_logger('html')
 
 def main():
     # 解析命令行参数
@@ -14,15 +17,17 @@ def main():
                         help='图层图片目录路径')
     parser.add_argument('--output-file', type=str, default='../src/psd_layout_generated.html',
                         help='输出HTML文件路径')
+    parser.add_argument('--atlas', action='store_true',
+                        help='使用 psd_atlas.py 生成的图集，以CSS背景位置切片显示图层')
     args = parser.parse_args()
     
     # 确保输入文件存在
     if not os.path.exists(args.psd_info):
-        print(f"错误: PSD信息文件不存在: {args.psd_info}")
+        logger.error("PSD信息文件不存在: %s", args.psd_info)
         return
     
     if not os.path.exists(args.layers_dir):
-        print(f"错误: 图层目录不存在: {args.layers_dir}")
+        logger.error("图层目录不存在: %s", args.layers_dir)
         return
     
     # 确保输出目录存在
@@ -31,9 +36,9 @@ def main():
         os.makedirs(output_dir, exist_ok=True)
     
     # 生成HTML
-    generate_psd_html(args.psd_info, args.layers_dir, args.output_file)
-    print(f"HTML生成成功: {args.output_file}")
-    print("你可以在浏览器中打开此文件查看PSD布局")
+    generate_psd_html(args.psd_info, args.layers_dir, args.output_file, args.atlas)
+    logger.info("HTML生成成功: %s", args.output_file)
+    logger.info("你可以在浏览器中打开此文件查看PSD布局")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+图层图集（sprite sheet）导出
+
+把 save_layer_images 提取的叶子图层图像裁剪到不透明区域后装箱到一张或几张图集中，
+并在图层清单中记录每个图层在图集中的矩形，HTML生成器可以用CSS背景位置切片显示图层，
+避免每个图层各发起一次请求、各解码一次图片。
+"""
+
+import os
+import re
+import argparse
+from PIL import Image
+
+from psd_log import get_logger
+from psd_manifest import load_layer_manifest, write_layer_manifest
+from psd_output import open_image
+
+logger = get_logger('atlas')
+
+# 图集文件名格式
+ATLAS_NAME_FORMAT = 'layers_atlas_{}.png'
+ATLAS_NAME_PATTERN = re.compile(r'^layers_atlas_(\d+)\.png$')
+
+
+def remove_atlas_files(layers_dir, keep=0):
+    """
+    删除图层目录中序号不小于 keep 的图集文件
+
+    图集比上次生成时少，或重新提取图层后清单不再引用图集时，旧的图集文件不会被覆盖，需要删除。
+
+    参数:
+        layers_dir: 图层目录路径
+        keep: 保留的图集数，为0时删除所有图集
+
+    返回:
+        删除的文件数
+    """
+    removed = 0
+    for name in os.listdir(layers_dir):
+        match = ATLAS_NAME_PATTERN.match(name)
+        if match and int(match.group(1)) >= keep:
+            os.remove(os.path.join(layers_dir, name))
+            removed += 1
+    return removed
+
+
+def _trimmed_sprites(layers_dir, manifest):
+    """
+    读取所有叶子图层图像并裁剪到不透明区域
+
+    返回:
+        精灵列表，每项为 {'entry', 'image', 'left', 'top'}，left/top 为裁剪区域在图层图像中的偏移
+    """
+    sprites = []
+    for entry in manifest['layers']:
+        if entry.get('type') == 'Group' or not entry.get('image'):
+            continue
+
+        try:
+            image = open_image(os.path.join(layers_dir, entry['image'])).convert('RGBA')
+        except Exception as e:
+            logger.warning("无法读取图层图像 %s: %s", entry['image'], e)
+            continue
+
+        bbox = image.getchannel('A').getbbox()
+        if bbox is None:
+            # 完全透明的图层不放入图集
+            continue
+
+        sprites.append({
+            'entry': entry,
+            'image': image.crop(bbox),
+            'left': bbox[0],
+            'top': bbox[1]
+        })
+    return sprites
+
+
+def pack_shelves(sizes, max_size=2048, padding=1):
+    """
+    使用货架（shelf）算法把矩形装箱到若干张图集中
+
+    矩形按高度从大到小依次放入当前货架，货架宽度不足时在下方新开货架，
+    图集高度不足时新开图集；超过 max_size 的矩形单独占用一张图集。
+
+    参数:
+        sizes: 矩形尺寸 (width, height) 列表
+        max_size: 图集的最大宽度和高度
+        padding: 矩形之间的透明间隔，防止缩放时相邻图层的像素渗入
+
+    返回:
+        (placements, sheets)：placements 与 sizes 一一对应，每项为 (sheet, x, y)；
+        sheets 为每张图集的实际尺寸 (width, height)
+    """
+    placements = [None] * len(sizes)
+    sheets = []
+    # 当前货架内已用的宽度、货架顶边的纵坐标和货架高度
+    shelf_x = shelf_y = shelf_height = 0
+    current = None
+
+    order = sorted(range(len(sizes)), key=lambda i: (sizes[i][1], sizes[i][0]), reverse=True)
+    for i in order:
+        width, height = sizes[i]
+        if width > max_size or height > max_size:
+            placements[i] = (len(sheets), 0, 0)
+            sheets.append([width, height])
+            # 单独占用的图集不再放入其他矩形
+            current = None
+            continue
+
+        if current is not None and shelf_x + width > max_size:
+            # 当前货架放不下，在下方新开货架
+            shelf_x = 0
+            shelf_y += shelf_height + padding
+            shelf_height = 0
+        if current is not None and shelf_y + height > max_size:
+            current = None
+        if current is None:
+            current = len(sheets)
+            sheets.append([0, 0])
+            shelf_x = shelf_y = shelf_height = 0
+
+        placements[i] = (current, shelf_x, shelf_y)
+        shelf_x += width + padding
+        shelf_height = max(shelf_height, height)
+        sheet = sheets[current]
+        sheet[0] = max(sheet[0], shelf_x - padding)
+        sheet[1] = max(sheet[1], shelf_y + height)
+
+    return placements, [tuple(sheet) for sheet in sheets]
+
+
+def build_atlas(layers_dir, max_size=2048, padding=1):
+    """
+    为图层目录生成图集，并在图层清单中记录每个图层的图集矩形
+
+    图层条目的 'atlas' 为 {'sheet', 'x', 'y', 'width', 'height', 'left', 'top'}：
+    sheet 为图集序号，x/y/width/height 为图集中的矩形，left/top 为该矩形在图层图像中的偏移。
+    清单的 'atlases' 为图集列表，每项为 {'image', 'width', 'height'}。
+
+    参数:
+        layers_dir: 图层目录路径，需包含 save_layer_images 写出的图层清单
+        max_size: 图集的最大宽度和高度
+        padding: 图层之间的透明间隔
+
+    返回:
+        图集图像路径列表
+    """
+    manifest = load_layer_manifest(layers_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"在 {layers_dir} 中找不到图层清单，请先使用 save_layer_images 提取图层")
+
+    # 删除上次生成的图集记录，重新生成
+    for entry in manifest['layers']:
+        entry.pop('atlas', None)
+
+    sprites = _trimmed_sprites(layers_dir, manifest)
+    placements, sheet_sizes = pack_shelves([sprite['image'].size for sprite in sprites], max_size, padding)
+
+    sheets = [Image.new('RGBA', size, (0, 0, 0, 0)) for size in sheet_sizes]
+    for sprite, (sheet, x, y) in zip(sprites, placements):
+        sheets[sheet].paste(sprite['image'], (x, y))
+        width, height = sprite['image'].size
+        sprite['entry']['atlas'] = {
+            'sheet': sheet,
+            'x': x,
+            'y': y,
+            'width': width,
+            'height': height,
+            'left': sprite['left'],
+            'top': sprite['top']
+        }
+
+    atlases = []
+    atlas_paths = []
+    for i, sheet in enumerate(sheets):
+        atlas_file = ATLAS_NAME_FORMAT.format(i)
+        sheet.save(os.path.join(layers_dir, atlas_file))
+        atlases.append({'image': atlas_file, 'width': sheet.width, 'height': sheet.height})
+        atlas_paths.append(os.path.join(layers_dir, atlas_file))
+        logger.info("已保存图集到: %s (%dx%d)", atlas_file, sheet.width, sheet.height)
+
+    remove_atlas_files(layers_dir, keep=len(sheets))
+
+    write_layer_manifest(layers_dir, manifest['root'], manifest['layers'], atlases, manifest.get('image_format'))
+    logger.info("已将 %d 个图层装入 %d 张图集", len(sprites), len(sheets))
+    return atlas_paths
+
+
+def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='将提取的图层图像装箱为图集')
+    parser.add_argument('layers_dir', help='图层目录路径')
+    parser.add_argument('--max-size', type=int, default=2048, help='图集的最大宽度和高度')
+    parser.add_argument('--padding', type=int, default=1, help='图层之间的透明间隔')
+    args = parser.parse_args()
+
+    build_atlas(args.layers_dir, args.max_size, args.padding)
+
+
+if __name__ == '__main__':
+    main()
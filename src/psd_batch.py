@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+批量处理PSD文件
+
+对一个目录或通配符匹配到的所有PSD文件，在进程池中依次执行解析、图层提取、合成和HTML生成。
+每个PSD的输出位于输出目录下以PSD文件名命名的子目录中:
+    <name>/psd_info.json      解析信息
+    <name>/layers/            图层图像（格式由 --image-format 指定）、元数据和图层清单
+    <name>/<name>_composed.png 合成图像
+    <name>/<name>.html        HTML布局
+    <name>/batch.log          处理过程的输出
+
+每个PSD处理结束后向任务日志（batch_journal.jsonl）追加一条记录，中途崩溃后重新运行会跳过
+已经成功且文件未变化的PSD；全部结束后写出每个文件各步骤耗时的汇总（batch_summary.json）。
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import signal
+import argparse
+import threading
+import contextlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from psd_parser import open_psd_reader, walk_psd, export_psd_layers
+from psd_composer import compose_layers
+from psd_output import DEFAULT_IMAGE_FORMAT, normalize_image_format
+from psd_html_generator import generate_psd_html
+from psd_log import get_logger
+
+logger = get_logger('batch')
+
+# 任务日志和耗时汇总的文件名
+JOURNAL_NAME = 'batch_journal.jsonl'
+SUMMARY_NAME = 'batch_summary.json'
+
+# 处理步骤
+BATCH_STEPS = ('parse', 'extract', 'compose', 'html')
+
+# 工作进程检查常驻内存的间隔（秒）
+MEMORY_CHECK_INTERVAL = 0.1
+
+
+def find_psd_files(source):
+    """
+    查找要处理的PSD文件
+
+    参数:
+        source: 目录（递归查找其中的 .psd 文件）或通配符
+
+    返回:
+        按路径排序的PSD文件路径列表
+    """
+    if os.path.isdir(source):
+        pattern = os.path.join(source, '**', '*')
+    else:
+        pattern = source
+    return sorted(path for path in glob.glob(pattern, recursive=True)
+                  if os.path.isfile(path) and path.lower().endswith('.psd'))
+
+
+def _job_name(psd_path, used_names):
+    """
+    以PSD文件名作为输出子目录名，重名时添加后缀
+    """
+    base_name = os.path.splitext(os.path.basename(psd_path))[0]
+    name = base_name
+    counter = 1
+    while name in used_names:
+        name = f"{base_name}_{counter}"
+        counter += 1
+    used_names.add(name)
+    return name
+
+
+def _file_signature(psd_path):
+    stat = os.stat(psd_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def load_journal(journal_path):
+    """
+    读取任务日志，返回每个PSD的最后一条记录
+
+    崩溃时可能留下写了一半的最后一行，无法解析的行直接忽略。
+    """
+    records = {}
+    if not os.path.exists(journal_path):
+        return records
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['psd']] = record
+    return records
+
+
+def _append_journal(journal_path, record):
+    # 每条记录写完立即落盘，进程崩溃时最多丢失正在处理的PSD
+    with open(journal_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _private_resident_bytes():
+    """
+    读取当前进程的私有常驻内存（字节）
+
+    /proc/self/statm 的常驻页数减去共享页数，即 RssAnon：
+    内存映射的PSD文件、分块合成的临时数组文件等按文件映射的页面可以随时换出，
+    已分配但未使用的地址空间（如 malloc 预留的内存区域）不占用物理页面，两者都不计入。
+    """
+    with open('/proc/self/statm') as f:
+        fields = f.read().split()
+    return (int(fields[1]) - int(fields[2])) * os.sysconf('SC_PAGE_SIZE')
+
+
+# 工作进程是否正在处理PSD；只在处理中把超出内存限制转换为 MemoryError，
+# 避免在进程池的任务循环中抛出异常
+_job_running = False
+# 处理过程中是否超出过内存限制；MemoryError 可能被逐个图层的异常处理捕获，
+# 任务结束时据此把该PSD记为失败
+_memory_exceeded = False
+
+
+def _raise_memory_error(signum, frame):
+    global _memory_exceeded
+    if _job_running:
+        _memory_exceeded = True
+        raise MemoryError("常驻内存超出限制")
+
+
+def _watch_memory(limit):
+    while True:
+        time.sleep(MEMORY_CHECK_INTERVAL)
+        if _job_running and _private_resident_bytes() > limit:
+            # 信号处理函数在主线程中执行，主线程从正在运行的 NumPy 等调用返回后抛出 MemoryError
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(1.0)
+
+
+def _init_batch_worker(memory_limit):
+    """
+    限制工作进程的私有常驻内存，超出时该PSD以 MemoryError 失败而不会拖垮整台机器
+
+    由后台线程按 MEMORY_CHECK_INTERVAL 检查，是软限制：单次大块分配在下一次检查前可以暂时超出。
+    不使用 RLIMIT_AS，它限制的是地址空间，内存映射的输入文件和 malloc 预留的区域都会计入。
+    """
+    if not memory_limit:
+        return
+    try:
+        _private_resident_bytes()
+        signal.signal(signal.SIGUSR1, _raise_memory_error)
+    except (OSError, ValueError, AttributeError) as e:
+        # 没有 /proc 或 SIGUSR1 的平台（如 Windows、macOS）
+        logger.warning("无法限制工作进程内存: %s", e)
+        return
+    threading.Thread(target=_watch_memory, args=(memory_limit * 1024 * 1024,), daemon=True).start()
+
+
+def process_psd(psd_path, job_dir, steps=BATCH_STEPS, tile_size=None, image_format=DEFAULT_IMAGE_FORMAT):
+    """
+    处理单个PSD文件：解析、提取图层、合成和生成HTML
+
+    参数:
+        psd_path: PSD文件路径
+        job_dir: 该PSD的输出目录
+        steps: 要执行的步骤
+        tile_size: 合成的分块大小，为None时整幅画布合成
+        image_format: 图层图像的输出格式（见 psd_output），合成图像始终为PNG
+
+    返回:
+        各步骤的耗时（秒）字典
+    """
+    name = os.path.basename(job_dir)
+    info_path = os.path.join(job_dir, 'psd_info.json')
+    layers_dir = os.path.join(job_dir, 'layers')
+    os.makedirs(job_dir, exist_ok=True)
+    timings = {}
+
+    # 解析：PSD以映射模式只打开一次、图层树只遍历一次，结果供提取使用
+    start = time.perf_counter()
+    psd = open_psd_reader(psd_path)
+    walk = walk_psd(psd, psd_path)
+    with open(info_path, 'w', encoding='utf-8') as f:
+        json.dump(walk['info'], f, ensure_ascii=False, indent=2)
+    timings['parse'] = time.perf_counter() - start
+
+    if 'extract' in steps:
+        # 递归合成不需要预渲染的图层组图像；增量提取使中断后重新处理时只写出缺失的图层
+        start = time.perf_counter()
+        export_psd_layers(psd, psd_path, layers_dir, walk, render_groups='compose' not in steps,
+                          incremental=True, image_format=image_format)
+        timings['extract'] = time.perf_counter() - start
+    del psd, walk
+
+    if 'compose' in steps:
+        start = time.perf_counter()
+        compose_layers(layers_dir, os.path.join(job_dir, f"{name}_composed.png"), engine='numpy',
+                       recursive=True, tile_size=tile_size)
+        timings['compose'] = time.perf_counter() - start
+
+    if 'html' in steps:
+        start = time.perf_counter()
+        generate_psd_html(info_path, os.path.abspath(layers_dir), os.path.join(job_dir, f"{name}.html"))
+        timings['html'] = time.perf_counter() - start
+
+    return timings
+
+
+def _run_batch_job(psd_path, job_dir, steps, tile_size, image_format):
+    """
+    在工作进程中处理一个PSD，输出重定向到日志文件，异常转换为失败记录
+    """
+    global _job_running
+    os.makedirs(job_dir, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.path.join(job_dir, 'batch.log'), 'w', encoding='utf-8') as log, \
+            contextlib.redirect_stdout(log):
+        try:
+            _job_running = True
+            try:
+                timings = process_psd(psd_path, job_dir, steps, tile_size, image_format)
+            finally:
+                _job_running = False
+            status, error = 'done', None
+        except MemoryError:
+            timings, status, error = {}, 'failed', '内存超出限制'
+            logger.error(error)
+        except Exception as e:
+            timings, status, error = {}, 'failed', f"{type(e).__name__}: {e}"
+            traceback.print_exc(file=log)
+        if _memory_exceeded and error != '内存超出限制':
+            timings, status, error = {}, 'failed', '内存超出限制'
+            logger.error(error)
+    return {'status': status, 'error': error, 'timings': timings, 'total': time.perf_counter() - start}
+
+
+def run_batch(source, output_dir, workers=None, memory_limit=None, steps=BATCH_STEPS, tile_size=None,
+              restart=False, image_format=DEFAULT_IMAGE_FORMAT):
+    """
+    批量处理目录或通配符匹配到的所有PSD文件
+
+    参数:
+        source: PSD目录或通配符
+        output_dir: 输出目录，任务日志和耗时汇总也写在这里
+        workers: 工作进程数，为None时使用CPU核数
+        memory_limit: 每个工作进程的私有常驻内存上限（MB），为None时不限制
+        steps: 要执行的步骤，解析始终执行
+        tile_size: 合成的分块大小，为None时整幅画布合成
+        restart: 是否忽略任务日志重新处理所有PSD
+        image_format: 图层图像的输出格式，改变后之前完成的PSD也会重新处理
+
+    返回:
+        每个PSD的处理结果列表
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    image_format = normalize_image_format(image_format)
+    journal_path = os.path.join(output_dir, JOURNAL_NAME)
+    if restart and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = load_journal(journal_path)
+
+    psd_files = find_psd_files(source)
+    used_names = set()
+    jobs = []
+    skipped = []
+    for psd_path in psd_files:
+        psd_path = os.path.abspath(psd_path)
+        job_dir = os.path.join(output_dir, _job_name(psd_path, used_names))
+        signature = _file_signature(psd_path)
+        record = journal.get(psd_path)
+        if (record and record['status'] == 'done' and record['size'] == signature['size']
+                and record['mtime'] == signature['mtime'] and record.get('steps') == list(steps)
+                and record.get('image_format', DEFAULT_IMAGE_FORMAT) == image_format):
+            skipped.append(record)
+        else:
+            jobs.append((psd_path, job_dir, signature))
+
+    logger.info("找到 %d 个PSD文件，%d 个已完成，%d 个待处理", len(psd_files), len(skipped), len(jobs))
+
+    results = list(skipped)
+    # 每个工作进程只处理一个PSD，处理完即退出，释放全部内存
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                             initargs=(memory_limit,), max_tasks_per_child=1) as executor:
+        futures = {executor.submit(_run_batch_job, psd_path, job_dir, steps, tile_size, image_format):
+                   (psd_path, job_dir, signature) for psd_path, job_dir, signature in jobs}
+        for done_count, future in enumerate(as_completed(futures), 1):
+            psd_path, job_dir, signature = futures[future]
+            try:
+                outcome = future.result()
+            except Exception as e:
+                # 工作进程异常退出（如被系统终止）
+                outcome = {'status': 'failed', 'error': f"工作进程异常退出: {e}", 'timings': {}, 'total': None}
+            record = {
+                'psd': psd_path,
+                'output': job_dir,
+                'size': signature['size'],
+                'mtime': signature['mtime'],
+                'steps': list(steps),
+                'image_format': image_format,
+                'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')
+            }
+            record.update(outcome)
+            _append_journal(journal_path, record)
+            results.append(record)
+
+            state = '完成' if record['status'] == 'done' else f"失败: {record['error']}"
+            logger.info("[%d/%d] %s %s", done_count, len(jobs), os.path.basename(psd_path), state)
+
+    write_batch_summary(output_dir, results)
+    return results
+
+
+def write_batch_summary(output_dir, results):
+    """
+    打印并写出每个PSD各步骤的耗时汇总
+    """
+    results = sorted(results, key=lambda record: record['psd'])
+    with open(os.path.join(output_dir, SUMMARY_NAME), 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    def cell(value):
+        return f"{value:>9.2f}" if value is not None else f"{'-':>9}"
+
+    print("\n" + "=" * 50)
+    print("批量处理耗时汇总（秒）")
+    print("=" * 50)
+    print(f"{'文件':<30}{''.join(f'{step:>9}' for step in BATCH_STEPS)}{'total':>9}  状态")
+    for record in results:
+        name = os.path.basename(record['psd'])
+        timings = record.get('timings', {})
+        status = '完成' if record['status'] == 'done' else '失败'
+        print(f"{name[:30]:<30}{''.join(cell(timings.get(step)) for step in BATCH_STEPS)}"
+              f"{cell(record.get('total'))}  {status}")
+    failed = sum(1 for record in results if record['status'] != 'done')
+    logger.info("共 %d 个文件，失败 %d 个，汇总已保存到 %s", len(results), failed, SUMMARY_NAME)
+
+
+def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='批量解析、提取、合成PSD文件并生成HTML')
+    parser.add_argument('source', help='PSD目录（递归查找）或通配符，如 "data/psd/*.psd"')
+    parser.add_argument('-o', '--output-dir', default='batch_output', help='输出目录')
+    parser.add_argument('-w', '--workers', type=int, help='工作进程数，默认为CPU核数')
+    parser.add_argument('--memory-limit', type=int, help='每个工作进程的私有常驻内存上限（MB），内存映射的文件不计入')
+    parser.add_argument('--tile-size', type=int, help='合成的分块大小，用于超大画布')
+    parser.add_argument('--skip', choices=BATCH_STEPS[1:], nargs='+', default=[], help='跳过的步骤')
+    parser.add_argument('--restart', action='store_true', help='忽略任务日志，重新处理所有PSD')
+    parser.add_argument('--image-format', type=normalize_image_format, default=DEFAULT_IMAGE_FORMAT,
+                        help='图层图像的输出格式：png、png:0-9、webp、webp:0-6、qoi 或 npy（生成HTML时使用png或webp）')
+    args = parser.parse_args()
+
+    steps = tuple(step for step in BATCH_STEPS if step not in args.skip)
+    results = run_batch(args.source, args.output_dir, args.workers, args.memory_limit, steps,
+                        args.tile_size, args.restart, args.image_format)
+    sys.exit(1 if any(record['status'] != 'done' for record in results) else 0)
+
+
+if __name__ == '__main__':
+    main()
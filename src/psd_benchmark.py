@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.api.layers import PixelLayer
+from psd_tools.compression import decompress
+from psd_tools.constants import Compression
+
+import psd_blend
+from psd_codec import decode_channels
+from psd_composer import apply_blend_mode, compose_tiled
+from psd_manifest import write_layer_manifest
+from psd_output import image_extension, normalize_image_format, open_image, save_image
+
+def _random_rgba(width, height, seed):
+    """
+    生成带有随机颜色和随机透明度的RGBA测试图像
+    """
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 4), dtype=np.uint8), 'RGBA')
+
+def _best_time(func, repeat):
+    """
+    多次运行函数，返回最短耗时（秒）；运行失败时返回None
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            print(f"  运行失败: {e}")
+            return None
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def _format_ms(seconds, width):
+    return f"{'失败':>{width - 2}}" if seconds is None else f"{seconds * 1000:>{width}.1f}"
+
+def benchmark_blend(width=1920, height=1080, repeat=3, opacity=0.8):
+    """
+    对比PIL和NumPy混合引擎在所有混合模式下的耗时
+
+    参数:
+        width: 测试图像宽度
+        height: 测试图像高度
+        repeat: 每个模式的重复次数，取最短耗时
+        opacity: 顶层不透明度
+
+    返回:
+        每个混合模式的耗时结果列表
+    """
+    base = _random_rgba(width, height, 1)
+    top = _random_rgba(width, height, 2)
+    base_array = psd_blend.to_premultiplied(base)
+    top_array = psd_blend.to_premultiplied(top)
+    out_array = np.empty_like(base_array)
+
+    results = []
+    print(f"混合引擎基准测试: {width}x{height}, 重复 {repeat} 次")
+    # NumPy(ms) 包含图像与预乘数组之间的转换，数组(ms) 为画布常驻预乘数组时的纯混合耗时
+    print(f"{'混合模式':<14}{'PIL(ms)':>10}{'NumPy(ms)':>12}{'数组(ms)':>10}{'加速比':>8}")
+    for mode in psd_blend.BLEND_FUNCS:
+        blend_mode = f"BlendMode.{mode}"
+        pil_time = _best_time(lambda: apply_blend_mode(base, top, blend_mode, opacity, engine='pil'), repeat)
+        numpy_time = _best_time(lambda: apply_blend_mode(base, top, blend_mode, opacity, engine='numpy'), repeat)
+        array_time = _best_time(lambda: psd_blend.blend_premultiplied(base_array, top_array, blend_mode,
+                                                                      opacity, out=out_array), repeat)
+        results.append({'blend_mode': mode, 'pil': pil_time, 'numpy': numpy_time, 'array': array_time})
+        speedup = f"{pil_time / array_time:>8.2f}" if pil_time and array_time else f"{'-':>8}"
+        print(f"{mode:<14}{_format_ms(pil_time, 10)}{_format_ms(numpy_time, 12)}{_format_ms(array_time, 10)}{speedup}")
+
+    return results
+
+def _synthetic_document(layers_dir, width, height, layer_count, seed=0):
+    """
+    生成合成用的参考文档：随机位置和混合模式的图层，以及一个普通图层组和一个穿透图层组，
+    写出图层PNG和图层清单，与 save_layer_images 的输出结构相同
+    """
+    rng = np.random.default_rng(seed)
+    modes = list(psd_blend.BLEND_FUNCS)
+    layers = []
+    
+    def add_layer(name, parent_dir, index, left, top, layer_width, layer_height, blend_mode, layer_type, image=None):
+        layer_dir = os.path.join(parent_dir, name) if parent_dir else name
+        os.makedirs(os.path.join(layers_dir, layer_dir), exist_ok=True)
+        image_file = None
+        if image is not None:
+            image_file = os.path.join(layer_dir, f"{name}.png")
+            image.save(os.path.join(layers_dir, image_file), compress_level=1)
+        layers.append({
+            'name': name, 'visible': True, 'opacity': 255 if layer_type != 'Group' else 200,
+            'blend_mode': f"BlendMode.{blend_mode}", 'top': top, 'left': left,
+            'bottom': top + layer_height, 'right': left + layer_width,
+            'width': layer_width, 'height': layer_height, 'type': layer_type,
+            'path': layer_dir.replace(os.sep, '/'), 'index': index, 'save_name': name,
+            'image': image_file, 'dir': layer_dir, 'info_path': layer_dir.replace(os.sep, '/')
+        })
+    
+    def random_layer(name, parent_dir, index, full=False):
+        layer_width = width if full else int(rng.integers(width // 8, width // 2))
+        layer_height = height if full else int(rng.integers(height // 8, height // 2))
+        left = 0 if full else int(rng.integers(0, width - layer_width))
+        top = 0 if full else int(rng.integers(0, height - layer_height))
+        # 渐变加噪声的图像，压缩率接近真实图层
+        y, x = np.mgrid[0:layer_height, 0:layer_width]
+        pixels = np.empty((layer_height, layer_width, 4), dtype=np.uint8)
+        pixels[..., 0] = (x * 255 // layer_width) ^ int(rng.integers(0, 256))
+        pixels[..., 1] = y * 255 // layer_height
+        pixels[..., 2] = rng.integers(0, 256, (layer_height, layer_width), dtype=np.uint8) // 8 + 100
+        pixels[..., 3] = 255 if full else rng.integers(100, 256, dtype=np.uint8)
+        blend_mode = 'NORMAL' if full else modes[int(rng.integers(0, len(modes)))]
+        if blend_mode == 'PASS_THROUGH':
+            blend_mode = 'NORMAL'
+        add_layer(name, parent_dir, index, left, top, layer_width, layer_height, blend_mode, 'PixelLayer',
+                  Image.fromarray(pixels, 'RGBA'))
+    
+    random_layer('background', '', 0, full=True)
+    per_group = max(1, (layer_count - 1) // 3)
+    index = 1
+    for group_name, blend_mode in (('isolated', 'NORMAL'), ('pass_through', 'PASS_THROUGH')):
+        add_layer(group_name, '', index, 0, 0, width, height, blend_mode, 'Group')
+        for i in range(per_group):
+            random_layer(f"layer_{i}", group_name, i)
+        index += 1
+    for i in range(max(0, layer_count - 1 - 2 * per_group)):
+        random_layer(f"layer_{i}", '', index)
+        index += 1
+    
+    root = {'name': 'synthetic.psd', 'width': width, 'height': height, 'image': 'synthetic.png'}
+    write_layer_manifest(layers_dir, root, layers)
+
+def benchmark_compose(layers_dir=None, workers_list=(1, 2, 4, 8, 16), tile_size=512,
+                      width=8000, height=8000, layer_count=24):
+    """
+    测量分块并行合成在不同线程数下的耗时和加速比，并检查输出与单线程逐字节相同
+
+    参数:
+        layers_dir: 参考文档的图层目录，为None时在临时目录中生成合成文档
+        workers_list: 要测量的线程数
+        tile_size: 分块大小
+        width: 合成文档的宽度
+        height: 合成文档的高度
+        layer_count: 合成文档的图层数量
+
+    返回:
+        每个线程数的耗时结果列表
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix='psd_benchmark_') as temp_dir:
+        if layers_dir is None:
+            layers_dir = os.path.join(temp_dir, 'layers')
+            print(f"生成参考文档: {width}x{height}, {layer_count} 个图层")
+            _synthetic_document(layers_dir, width, height, layer_count)
+        
+        print(f"并行合成基准测试: 分块大小 {tile_size}, CPU 核数 {os.cpu_count()}")
+        print(f"{'线程数':<8}{'耗时(s)':>10}{'加速比':>8}{'输出一致':>10}")
+        base_time = None
+        base_digest = None
+        for workers in workers_list:
+            output_path = os.path.join(temp_dir, f"composed_{workers}.png")
+            start = time.perf_counter()
+            compose_tiled(layers_dir, output_path, tile_size, workers)
+            elapsed = time.perf_counter() - start
+            with open(output_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            os.remove(output_path)
+            
+            if base_time is None:
+                base_time, base_digest = elapsed, digest
+            results.append({'workers': workers, 'time': elapsed, 'identical': digest == base_digest})
+            print(f"{workers:<10}{elapsed:>10.2f}{base_time / elapsed:>9.2f}{'是' if digest == base_digest else '否':>9}")
+    
+    return results
+
+def _codec_document(psd_path, width, height, depth, seed=0):
+    """
+    生成通道解压测试用的PSD：每种压缩方式各一个整幅图层，颜色为渐变加少量噪声，
+    透明度含大片全透明和全不透明的区域
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., 0] = x * 255 // width
+    pixels[..., 1] = y * 255 // height
+    pixels[..., 2] = rng.integers(0, 256, (height, width), dtype=np.uint8) // 16 + 100
+    pixels[..., 3] = 0
+    pixels[height // 4:height * 3 // 4, :, 3] = 255
+    pixels[height // 3:height // 2, width // 4:width * 3 // 4, 3] = x[height // 3:height // 2, width // 4:width * 3 // 4]
+    image = Image.fromarray(pixels, 'RGBA')
+
+    psd = PSDImage.new('RGB', (width, height), depth=depth)
+    for compression in (Compression.RAW, Compression.RLE, Compression.ZIP, Compression.ZIP_WITH_PREDICTION):
+        PixelLayer.frompil(image, psd, compression.name, compression=compression)
+    psd.save(psd_path)
+
+def benchmark_codec(psd_path=None, repeat=3, workers=None, width=4000, height=3000, depth=8):
+    """
+    测量每种压缩方式的通道解压速度（MB/s，按解压后的字节数计算），对比 psd_tools 与
+    psd_codec 的单线程和多线程解压，并检查解压结果与 psd_tools 逐字节相同
+
+    参数:
+        psd_path: 测试用的PSD文件，为None时生成每种压缩方式各一个图层的文档
+        repeat: 重复次数，取最短耗时
+        workers: 多线程解压的线程数，为None时使用CPU核数
+        width: 生成文档的宽度
+        height: 生成文档的高度
+        depth: 生成文档的位深
+
+    返回:
+        每种压缩方式的测量结果列表
+    """
+    with tempfile.TemporaryDirectory(prefix='psd_benchmark_') as temp_dir:
+        if psd_path is None:
+            psd_path = os.path.join(temp_dir, 'codec.psd')
+            print(f"生成测试文档: {width}x{height}, {depth} 位")
+            _codec_document(psd_path, width, height, depth)
+        psd = PSDImage.open(psd_path)
+
+    # 按压缩方式收集所有图层的颜色和透明度通道，蒙版通道的尺寸不同，不参与测试
+    dtype = {8: np.uint8, 16: np.dtype('>u2'), 32: np.dtype('>f4')}[psd.depth]
+    channels = {}
+    for layer in psd.descendants():
+        record = layer._record
+        if record.width <= 0 or record.height <= 0:
+            continue
+        for info, channel in zip(record.channel_info, layer._channels):
+            if info.id >= -1:
+                channels.setdefault(channel.compression, []).append((channel.data, record.width, record.height))
+
+    print(f"通道解压基准测试: {os.path.basename(psd_path)}, {psd.depth} 位, 线程数 {workers or os.cpu_count()}")
+    print(f"{'压缩方式':<20}{'通道数':>5}{'MB':>8}{'psd_tools':>11}{'单线程':>8}{'多线程':>8}{'结果一致':>6}")
+    results = []
+    for compression, items in sorted(channels.items()):
+        size = sum(width * height for _, width, height in items) * np.dtype(dtype).itemsize / 1e6
+
+        def decode_reference():
+            return [decompress(data, compression, width, height, psd.depth, psd.version)
+                    for data, width, height in items]
+
+        jobs = [(data, compression, np.empty((height, width), dtype), psd.depth, psd.version)
+                for data, width, height in items]
+        reference_time = _best_time(decode_reference, repeat)
+        serial_time = _best_time(lambda: decode_channels(jobs, 1), repeat)
+        parallel_time = _best_time(lambda: decode_channels(jobs, workers), repeat)
+        identical = all(job[2].tobytes() == expected for job, expected in zip(jobs, decode_reference()))
+
+        speeds = [size / seconds if seconds else None for seconds in (reference_time, serial_time, parallel_time)]
+        results.append({'compression': compression.name, 'channels': len(items), 'mb': size,
+                        'psd_tools': speeds[0], 'serial': speeds[1], 'parallel': speeds[2],
+                        'identical': identical})
+        print(f"{compression.name:<24}{len(items):>8}{size:>8.1f}" +
+              ''.join(f"{speed:>11.0f}" if speed else f"{'失败':>9}" for speed in speeds) +
+              f"{'是' if identical else '否':>9}")
+
+    return results
+
+# 输出格式测试默认测量的格式
+_OUTPUT_FORMATS = ['png', 'png:1', 'png:0', 'webp', 'webp:0', 'qoi', 'npy']
+
+def _textured_rgba(width, height, seed):
+    """
+    生成接近实际图层的RGBA测试图像：平滑变化的颜色、纯色块和完全透明的区域
+    """
+    rng = np.random.default_rng(seed)
+    array = np.zeros((height, width, 4), dtype=np.uint8)
+    array[..., :3] = (np.cumsum(rng.integers(-2, 3, (height, width, 3)), axis=1) % 256).astype(np.uint8)
+    array[..., 3] = 255
+    array[:height // 5] = 0
+    array[height * 3 // 5:height * 3 // 4, width // 6:width * 5 // 6, :3] = (20, 200, 90)
+    return Image.fromarray(array, 'RGBA')
+
+def benchmark_output(image_path=None, repeat=3, formats=None, width=2000, height=2000):
+    """
+    测量每种输出格式的编码和解码耗时及文件大小，并检查解码结果与原图逐像素相同
+
+    参数:
+        image_path: 测试用的图像，为None时生成纹理测试图像
+        repeat: 重复次数，取最短耗时
+        formats: 要测量的格式字符串列表，为None时测量各格式的默认级别和最快的级别
+        width: 生成图像的宽度
+        height: 生成图像的高度
+
+    返回:
+        每种格式的测量结果列表
+    """
+    image = open_image(image_path).convert('RGBA') if image_path else _textured_rgba(width, height, 0)
+    expected = np.asarray(image)
+    formats = [normalize_image_format(image_format) for image_format in formats or _OUTPUT_FORMATS]
+
+    print(f"输出格式基准测试: {image.width}x{image.height}")
+    print(f"{'格式':<10}{'编码(ms)':>10}{'解码(ms)':>10}{'大小(MB)':>10}{'无损':>6}")
+    results = []
+    with tempfile.TemporaryDirectory(prefix='psd_benchmark_') as temp_dir:
+        for image_format in formats:
+            path = os.path.join(temp_dir, f"image{image_extension(image_format)}")
+            encode_time = _best_time(lambda: save_image(image, path, image_format), repeat)
+            decode_time = _best_time(lambda: open_image(path), repeat)
+            if encode_time is None or decode_time is None:
+                continue
+            lossless = np.array_equal(np.asarray(open_image(path).convert('RGBA')), expected)
+            size = os.path.getsize(path) / 1e6
+            results.append({'format': image_format, 'encode': encode_time, 'decode': decode_time, 'mb': size,
+                            'lossless': lossless})
+            print(f"{image_format:<10}{encode_time * 1000:>12.0f}{decode_time * 1000:>12.0f}{size:>12.2f}"
+                  f"{'是' if lossless else '否':>7}")
+
+    return results
+
+def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='PSD工具集性能基准测试')
+    subparsers = parser.add_subparsers(dest='command', help='子命令')
+
+    # 混合引擎基准测试
+    blend_parser = subparsers.add_parser('blend', help='对比PIL和NumPy混合引擎')
+    blend_parser.add_argument('--width', type=int, default=1920, help='测试图像宽度')
+    blend_parser.add_argument('--height', type=int, default=1080, help='测试图像高度')
+    blend_parser.add_argument('--repeat', type=int, default=3, help='重复次数')
+
+    # 分块并行合成的扩展性测试
+    compose_parser = subparsers.add_parser('compose', help='测量分块并行合成在不同线程数下的扩展性')
+    compose_parser.add_argument('layers_dir', nargs='?', help='参考文档的图层目录，省略时生成合成文档')
+    compose_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='要测量的线程数')
+    compose_parser.add_argument('--tile-size', type=int, default=512, help='分块大小')
+    compose_parser.add_argument('--width', type=int, default=8000, help='合成文档的宽度')
+    compose_parser.add_argument('--height', type=int, default=8000, help='合成文档的高度')
+    compose_parser.add_argument('--layers', type=int, default=24, help='合成文档的图层数量')
+
+    # 通道解压速度测试
+    codec_parser = subparsers.add_parser('codec', help='测量每种压缩方式的通道解压速度')
+    codec_parser.add_argument('psd_file', nargs='?', help='测试用的PSD文件，省略时生成测试文档')
+    codec_parser.add_argument('--repeat', type=int, default=3, help='重复次数')
+    codec_parser.add_argument('--workers', type=int, help='多线程解压的线程数，默认为CPU核数')
+    codec_parser.add_argument('--width', type=int, default=4000, help='测试文档的宽度')
+    codec_parser.add_argument('--height', type=int, default=3000, help='测试文档的高度')
+    codec_parser.add_argument('--depth', type=int, choices=[8, 16, 32], default=8, help='测试文档的位深')
+
+    # 输出格式测试
+    output_parser = subparsers.add_parser('output', help='测量每种输出格式的编码、解码速度和文件大小')
+    output_parser.add_argument('image', nargs='?', help='测试用的图像，省略时生成纹理测试图像')
+    output_parser.add_argument('--repeat', type=int, default=3, help='重复次数')
+    output_parser.add_argument('--formats', nargs='+', help='要测量的格式，如 png png:1 webp:0 npy')
+    output_parser.add_argument('--width', type=int, default=2000, help='测试图像的宽度')
+    output_parser.add_argument('--height', type=int, default=2000, help='测试图像的高度')
+
+    args = parser.parse_args()
+
+    if args.command == 'blend':
+        benchmark_blend(args.width, args.height, args.repeat)
+    elif args.command == 'compose':
+        benchmark_compose(args.layers_dir, args.workers, args.tile_size, args.width, args.height, args.layers)
+    elif args.command == 'codec':
+        benchmark_codec(args.psd_file, args.repeat, args.workers, args.width, args.height, args.depth)
+    elif args.command == 'output':
+        benchmark_output(args.image, args.repeat, args.formats, args.width, args.height)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
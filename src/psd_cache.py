@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+解码后图层像素的缓存
+
+反复调整合成参数时，每次合成都要重新解码所有图层图像并转换为预乘数组。LayerCache
+把解码结果保存为缓存目录中的 .npy 文件，之后的合成以只读内存映射方式直接读取，不再解码:
+    cache = LayerCache()
+    compose_layers(layers_dir, recursive=True, cache=cache)
+
+每个图层图像可以缓存两种形式：'premultiplied' 为递归、分块和numpy引擎使用的 HxWx4 float32
+预乘数组，'rgba' 为PIL引擎和区域合成使用的 HxWx4 uint8 RGBA数组。缓存键包含图像文件的
+绝对路径、修改时间、大小和形式，图像重新提取后旧条目不再命中，随后被淘汰。
+
+缓存分两级：
+    磁盘  缓存目录中的文件总大小超过 max_bytes 时按最近使用时间淘汰，命中时更新文件的
+          修改时间，因此多次运行之间也按LRU顺序淘汰。文件先写入临时文件再改名，多个进程
+          可以共用同一个缓存目录（每个进程启动时扫描一次目录，不跟踪其他进程新写入的文件）
+    内存  同一进程内最近用过的数组按 memory_bytes 限制保留，重复合成不再打开文件
+
+LRUCache 为按字节数限制大小的通用LRU缓存，也供 psd_daemon 使用。
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import psd_blend
+from psd_log import get_logger
+from psd_output import format_for_path, load_array, open_image
+
+logger = get_logger('cache')
+
+# 默认的缓存目录
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'psd_layer_cache')
+
+# 磁盘缓存的默认大小上限
+DEFAULT_CACHE_BYTES = 4 << 30
+
+# 内存缓存的默认大小上限
+DEFAULT_MEMORY_BYTES = 1 << 30
+
+# 缓存的像素形式
+CACHE_KINDS = ('premultiplied', 'rgba')
+
+
+class LRUCache:
+    """
+    按字节数限制总大小的LRU缓存，线程安全
+
+    每个条目在放入时给出估计的字节数，总大小超过上限时淘汰最久未使用的条目。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            # 至少保留刚放入的条目
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class LayerCache:
+    """
+    图层图像解码结果的磁盘和内存缓存，线程安全
+
+    返回的数组是只读的内存映射，调用方不能修改。同一图像同时被多个线程请求时只解码一次。
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_CACHE_BYTES, memory_bytes=DEFAULT_MEMORY_BYTES):
+        """
+        参数:
+            cache_dir: 缓存目录，为None时使用系统临时目录下的 psd_layer_cache
+            max_bytes: 磁盘缓存的大小上限（字节）
+            memory_bytes: 内存缓存的大小上限（字节）
+        """
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        self.memory = LRUCache(memory_bytes)
+        self.hits = 0
+        self.decodes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # 缓存文件名到大小，按最近使用时间从旧到新排列
+        self._files = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._total_bytes += size
+
+    def _cache_name(self, path, kind):
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}\0{stat.st_mtime_ns}\0{stat.st_size}"
+        return f"{kind}_{hashlib.sha1(key.encode('utf-8')).hexdigest()}.npy"
+
+    def _decode(self, path, kind):
+        image = open_image(path)
+        if kind == 'premultiplied':
+            return psd_blend.to_premultiplied(image)
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        return np.asarray(image)
+
+    def _store(self, name, array):
+        """
+        写出缓存文件并在超出大小上限时淘汰最久未使用的文件
+        """
+        cache_path = os.path.join(self.cache_dir, name)
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(temp_path, cache_path)
+        size = os.path.getsize(cache_path)
+
+        with self._lock:
+            self._total_bytes += size - self._files.pop(name, 0)
+            self._files[name] = size
+            # 至少保留刚写出的文件；已经映射的文件删除后仍然可以读取
+            while self._total_bytes > self.max_bytes and len(self._files) > 1:
+                evicted, evicted_size = self._files.popitem(last=False)
+                self._total_bytes -= evicted_size
+                try:
+                    os.remove(os.path.join(self.cache_dir, evicted))
+                except OSError:
+                    pass
+                logger.debug("淘汰图层缓存: %s", evicted)
+
+    def _touch(self, name):
+        with self._lock:
+            if name in self._files:
+                self._files.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+    def get(self, path, kind='premultiplied'):
+        """
+        读取图层图像的解码结果，缓存中没有时解码并写入缓存
+
+        参数:
+            path: 图层图像路径
+            kind: 'premultiplied'（HxWx4 float32 预乘数组）或 'rgba'（HxWx4 uint8 数组）
+
+        返回:
+            只读数组
+        """
+        if kind not in CACHE_KINDS:
+            raise ValueError(f"不支持的缓存形式: {kind}")
+        if kind == 'rgba' and format_for_path(path) == 'npy':
+            # npy格式的图层本身就是可以映射的RGBA数组
+            return load_array(path)
+
+        name = self._cache_name(path, kind)
+        array = self.memory.get(name)
+        if array is not None:
+            self._touch(name)
+            with self._lock:
+                self.hits += 1
+            return array
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(name, threading.Lock())
+        with key_lock:
+            array = self.memory.get(name)
+            if array is not None:
+                with self._lock:
+                    self.hits += 1
+                return array
+            cache_path = os.path.join(self.cache_dir, name)
+            try:
+                array = np.load(cache_path, mmap_mode='r')
+                self._touch(name)
+                with self._lock:
+                    self.hits += 1
+            except (OSError, ValueError):
+                # 没有缓存文件，或文件不完整（如写出时进程被终止），重新解码
+                decoded = self._decode(path, kind)
+                self._store(name, decoded)
+                del decoded
+                array = np.load(cache_path, mmap_mode='r')
+                with self._lock:
+                    self.decodes += 1
+            self.memory.put(name, array, array.nbytes)
+        return array
+
+    def premultiplied(self, path):
+        """
+        读取图层图像的预乘 float32 数组
+        """
+        return self.get(path, 'premultiplied')
+
+    def open_image(self, path):
+        """
+        读取图层图像，返回RGBA模式的 PIL.Image，与 psd_output.open_image 的结果像素相同
+        """
+        from PIL import Image
+        return Image.fromarray(np.ascontiguousarray(self.get(path, 'rgba')))
+
+    def stats(self):
+        """
+        返回缓存统计：磁盘缓存的文件数和字节数、命中和解码次数，以及内存缓存的统计
+        """
+        with self._lock:
+            return {
+                'files': len(self._files),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'decodes': self.decodes,
+                'memory': self.memory.stats()
+            }
+
+    def clear(self):
+        """
+        删除所有缓存文件并清空内存缓存
+        """
+        with self._lock:
+            for name in self._files:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+            self._files.clear()
+            self._total_bytes = 0
+        self.memory = LRUCache(self.memory.max_bytes)
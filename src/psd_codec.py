@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+PSD通道数据解压
+
+PSD的通道数据有四种压缩方式：RAW、按行的PackBits（RLE）、ZIP和带差分预测的ZIP。
+psd_tools.compression.decompress 每次返回新的 bytes，RLE逐行解压后再拼接，16位的
+差分预测还要经过两次类型转换。本模块把通道直接解压到调用方提供的NumPy数组中:
+    out = np.empty((height, width), np.uint8)
+    decode_channel(data, Compression.RLE, out, depth=8, version=1)
+
+RLE按行批量处理：用NumPy一次找出整行为同一个值的行（透明度通道中大片全透明或全
+不透明的行）直接填充，其余连续的行合并为一次 psd_tools 编译实现的解码调用。ZIP
+数据分块解压到输出数组，差分预测在数组上原地累加还原。
+
+decode_channels() 用线程池并行解压多个通道（可以来自不同图层）；zlib和NumPy
+在处理大块数据时释放GIL，ZIP通道的解压可以在多个核上同时进行。
+
+损坏的数据交给 psd_tools.compression.decompress 处理，与 psd_tools 一样告警并以黑色填充。
+
+本模块用于 psd_lazy 的映射读取：合并图像的RLE行带（export_root 写出PSD合成图像）、
+LazyLayer.read_channel() 和 LazyLayer.topil()。提取图层图像仍由 psd_tools 的
+layer.composite() 渲染，其内部使用 psd_tools 自己的解压；直接解压通道得到的像素与之
+有舍入差异（透明像素的颜色、半透明像素±1），会改变已提取的图像和增量哈希，因此没有替换。
+"""
+
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from psd_tools.compression import decompress, rle_impl
+from psd_tools.constants import Compression
+
+# PackBits一次最多重复或复制128字节
+_RLE_MAX_RUN = 128
+
+# 一次解码调用合并的最大行数，限制解码临时数据的大小
+RLE_BATCH_ROWS = 256
+
+# 流式解压ZIP通道时每次输出的最大字节数
+_ZIP_CHUNK = 1 << 20
+
+
+def _uniform_rows(data, starts, counts, row_size):
+    """
+    找出整行编码为同一个值的重复段的行，返回 (行索引, 值)
+
+    这样的行由 ceil(row_size / 128) 个 [头字节, 值] 组成，前面的段重复128次（头字节129），
+    最后一段重复剩余的次数；剩余1字节时最后一段为长度为1的字面段（头字节0）。
+    长度为0的行与 psd_tools 一样按0填充。
+    """
+    runs = -(-row_size // _RLE_MAX_RUN)
+    empty = np.nonzero(counts == 0)[0]
+    candidates = np.nonzero(counts == 2 * runs)[0]
+    if candidates.size:
+        remainder = row_size - _RLE_MAX_RUN * (runs - 1)
+        expected = np.full(runs, 257 - _RLE_MAX_RUN, dtype=np.uint8)
+        expected[-1] = 257 - remainder if remainder > 1 else 0
+        positions = starts[candidates, None] + 2 * np.arange(runs)
+        headers = data[positions]
+        values = data[positions + 1]
+        matched = (headers == expected).all(axis=1) & (values == values[:, :1]).all(axis=1)
+        candidates = candidates[matched]
+        values = values[matched, 0]
+    else:
+        values = np.empty(0, dtype=np.uint8)
+    return (np.concatenate((candidates, empty)),
+            np.concatenate((values, np.zeros(empty.size, dtype=np.uint8))))
+
+
+def decode_rle_rows(data, counts, out):
+    """
+    解压连续存放的RLE压缩行
+
+    参数:
+        data: 压缩行数据（bytes、memoryview或uint8数组），从第一行开始
+        counts: 每行压缩后的字节数
+        out: 输出数组，形状为 (行数, 每行字节数) 的C连续uint8数组
+    """
+    rows, row_size = out.shape
+    buffer = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.zeros(rows + 1, dtype=np.int64)
+    np.cumsum(counts, out=starts[1:])
+    if starts[-1] > buffer.size:
+        raise ValueError("RLE数据不完整")
+
+    uniform, values = _uniform_rows(buffer, starts, counts, row_size)
+    out[uniform] = values[:, None]
+
+    # 其余的行按连续区间合并解码，每行的编码都在行尾结束，拼接后的输出即各行依次排列
+    pending = np.ones(rows, dtype=bool)
+    pending[uniform] = False
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], pending.view(np.int8), [0]))))
+    view = memoryview(buffer)
+    for first, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+        for top in range(first, end, RLE_BATCH_ROWS):
+            bottom = min(top + RLE_BATCH_ROWS, end)
+            decoded = rle_impl.decode(view[starts[top]:starts[bottom]], (bottom - top) * row_size)
+            out[top:bottom] = np.frombuffer(decoded, dtype=np.uint8).reshape(bottom - top, row_size)
+
+
+def _decode_zip(data, target):
+    decompressor = zlib.decompressobj()
+    tail = data
+    position = 0
+    while position < target.size:
+        chunk = decompressor.decompress(tail, min(_ZIP_CHUNK, target.size - position))
+        if not chunk:
+            raise ValueError("ZIP数据不完整")
+        target[position:position + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+        position += len(chunk)
+        tail = decompressor.unconsumed_tail
+
+
+def undo_prediction(out, depth):
+    """
+    在数组上原地还原ZIP差分预测
+
+    8位和16位数据逐行按样本累加（按位宽回绕）；32位数据每行先按字节平面（各像素的
+    第1字节、第2字节……）累加，再交错还原为大端浮点数。
+    """
+    if depth in (8, 16):
+        np.cumsum(out, axis=1, dtype=out.dtype, out=out)
+    elif depth == 32:
+        height, width = out.shape
+        planes = out.view(np.uint8).reshape(height, 4 * width)
+        np.cumsum(planes, axis=1, dtype=np.uint8, out=planes)
+        planes.reshape(height, width, 4)[:] = planes.reshape(height, 4, width).transpose(0, 2, 1).copy()
+    else:
+        raise ValueError(f"不支持位深为 {depth} 的差分预测")
+
+
+def decode_channel(data, compression, out, depth, version):
+    """
+    把一个通道的压缩数据解压到 out 中
+
+    参数:
+        data: 通道数据，不含2字节的压缩方式
+        compression: 压缩方式（Compression）
+        out: 输出数组，形状为 (height, width)，C连续，类型与位深对应
+        depth: 位深，8、16或32
+        version: 文件版本，1为PSD，2为PSB（RLE行字节数的宽度不同）
+
+    返回:
+        out
+    """
+    height, width = out.shape
+    target = out.reshape(-1).view(np.uint8)
+    try:
+        if compression == Compression.RAW:
+            target[:] = np.frombuffer(data, dtype=np.uint8, count=target.size)
+        elif compression == Compression.RLE:
+            counts = np.frombuffer(data, dtype='>u2' if version == 1 else '>u4', count=height)
+            decode_rle_rows(memoryview(data)[counts.nbytes:], counts, target.reshape(height, -1))
+        else:
+            _decode_zip(data, target)
+            if compression == Compression.ZIP_WITH_PREDICTION:
+                undo_prediction(out, depth)
+    except (ValueError, IndexError, zlib.error):
+        target[:] = np.frombuffer(decompress(bytes(data), compression, width, height, depth, version),
+                                  dtype=np.uint8)
+    return out
+
+
+def decode_channels(jobs, workers=None):
+    """
+    用线程池并行解压多个通道
+
+    参数:
+        jobs: (data, compression, out, depth, version) 的列表，参数与 decode_channel 相同
+        workers: 线程数，为None时使用CPU核数，为1时在当前线程依次解压
+
+    返回:
+        与 jobs 对应的输出数组列表
+    """
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(jobs) <= 1:
+        return [decode_channel(*job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        return list(executor.map(lambda job: decode_channel(*job), jobs))
@@ -2,11 +2,39 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import json
+import math
+import logging
+import numpy as np
 from PIL import Image, ImageChops, ImageMath
 import argparse
+import tempfile
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-def apply_blend_mode(base, top, blend_mode, opacity=1.0):
+import psd_blend
+import psd_trace
+from psd_cache import DEFAULT_CACHE_BYTES, LayerCache
+from psd_log import get_logger
+from psd_manifest import LAYER_MANIFEST_NAME, load_layer_manifest
+from psd_output import (find_image, format_for_path, image_extension, load_array, normalize_image_format, open_image,
+                        open_image_writer, save_image)
+
+logger = get_logger('composer')
+
+# Pillow 10.3 起 ImageMath.eval 更名为 unsafe_eval，并在 Pillow 12 中移除了旧名称
+_image_math_eval = getattr(ImageMath, 'unsafe_eval', None) or ImageMath.eval
+
+# 可选的混合引擎：pil 为逐通道 ImageMath 实现，numpy 为整幅数组的向量化实现
+BLEND_ENGINES = ('pil', 'numpy')
+
+# 分块合成的默认分块大小
+DEFAULT_TILE_SIZE = 1024
+
+def apply_blend_mode(base, top, blend_mode, opacity=1.0, engine='pil'):
     """
     应用混合模式将顶层图像与基础图像混合
     
@@ -15,212 +43,349 @@ def apply_blend_mode(base, top, blend_mode, opacity=1.0):
         top: 顶层图像（PIL.Image）
         blend_mode: 混合模式字符串
         opacity: 不透明度，范围0.0-1.0
+        engine: 混合引擎，'pil' 或 'numpy'
     
     返回:
         混合后的图像
     """
+    if engine == 'numpy':
+        result = psd_blend.blend_premultiplied(psd_blend.to_premultiplied(base),
+                                               psd_blend.to_premultiplied(top),
+                                               blend_mode, opacity)
+        return psd_blend.to_image(result)
+    
+    with psd_trace.span('blend', mode=psd_blend.blend_mode_name(blend_mode), engine='pil'):
+        return _apply_blend_mode_pil(base, top, blend_mode, opacity)
+
+# 各混合模式的 ImageMath 表达式 B(a, b)：a 为基础图像、b 为顶层图像的同一颜色通道，
+# 均为0-255的浮点图像；公式与 psd_blend 相同，NORMAL 与 PASS_THROUGH 直接使用顶层颜色。
+# 表达式只使用 Pillow 12 的 unsafe_eval 允许的运算：min/max 的第一个参数必须是图像，
+# 没有 sqrt，柔光所需的 sqrt(a) 由 _apply_blend_mode_pil 预先查表得到后以 s 传入
+_PIL_BLEND_EXPRESSIONS = {
+    'MULTIPLY': "a*b/255",
+    'SCREEN': "a+b-a*b/255",
+    'OVERLAY': "(a>127.5)*(b+(2*a-255)-b*(2*a-255)/255)+(a<=127.5)*(2*a*b/255)",
+    'SOFT_LIGHT': "(b<=127.5)*(a-(255-2*b)*a*(255-a)/65025)"
+                  "+(b>127.5)*(a+(2*b-255)*((a<=63.75)*((16*a/255-12)*a/255+4)*a+(a>63.75)*s-a)/255)",
+    'HARD_LIGHT': "(b>127.5)*(a+(2*b-255)-a*(2*b-255)/255)+(b<=127.5)*(2*a*b/255)",
+    'COLOR_DODGE': "(a>0)*((b>=255)*255+(b<255)*min(a*255/(255-b+0.001), 255))",
+    'COLOR_BURN': "(a>=255)*255+(a<255)*(b>0)*(255-min((255-a)*255/(b+0.001), 255))",
+    'DARKEN': "min(a, b)",
+    'LIGHTEN': "max(a, b)",
+}
+
+
+def _apply_blend_mode_pil(base, top, blend_mode, opacity):
     # 确保两个图像都是RGBA模式
     if base.mode != 'RGBA':
         base = base.convert('RGBA')
     if top.mode != 'RGBA':
         top = top.convert('RGBA')
     
-    # 提取alpha通道
-    r1, g1, b1, a1 = base.split()
-    r2, g2, b2, a2 = top.split()
+    # 提取各通道
+    base_channels = base.split()
+    top_channels = top.split()
+    alpha = top_channels[3]
     
-    # 如果不透明度不是100%，则调整图像的alpha通道
+    # 如果不透明度不是100%，则调整顶层图像的alpha通道
     if opacity < 1.0:
-        # 调整alpha通道
-        a2 = a2.point(lambda i: int(i * opacity))
-    
-    # 根据混合模式应用不同的混合算法
-    if 'NORMAL' in blend_mode:
-        # 正常模式，直接使用PIL的alpha合成
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将顶层图像与调整后的alpha通道合并
-        top_with_opacity = Image.merge('RGBA', (r2, g2, b2, a2))
-        # 将顶层图像粘贴到结果图像上
-        result.paste(top_with_opacity, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'PASS_THROUGH' in blend_mode:
-        # PASS_THROUGH 模式，保持图层组内部混合模式
-        # 对于图层组，这意味着子图层直接与图层组外部的图层混合
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将顶层图像与调整后的alpha通道合并
-        top_with_opacity = Image.merge('RGBA', (r2, g2, b2, a2))
-        # 将顶层图像粘贴到结果图像上
-        result.paste(top_with_opacity, (0, 0), a2)
-        # 将结果与基础图像合成，使用alpha_composite确保透明度正确处理
-        result = Image.alpha_composite(base, result)
-    elif 'MULTIPLY' in blend_mode:
-        # 正片叠底模式
-        r = ImageMath.eval("convert(a*b/255, 'L')", a=r1, b=r2)
-        g = ImageMath.eval("convert(a*b/255, 'L')", a=g1, b=g2)
-        b = ImageMath.eval("convert(a*b/255, 'L')", a=b1, b=b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'SCREEN' in blend_mode:
-        # 滤色模式
-        r = ImageMath.eval("convert(255 - ((255-a)*(255-b))/255, 'L')", a=r1, b=r2)
-        g = ImageMath.eval("convert(255 - ((255-a)*(255-b))/255, 'L')", a=g1, b=g2)
-        b = ImageMath.eval("convert(255 - ((255-a)*(255-b))/255, 'L')", a=b1, b=b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'OVERLAY' in blend_mode:
-        # 叠加模式
-        r = ImageMath.eval("convert((a>128)*((255-2*(255-a))*(255-b)/255+2*a*b/255)+(a<=128)*(2*a*b/255), 'L')", a=r1, b=r2)
-        g = ImageMath.eval("convert((a>128)*((255-2*(255-a))*(255-b)/255+2*a*b/255)+(a<=128)*(2*a*b/255), 'L')", a=g1, b=g2)
-        b = ImageMath.eval("convert((a>128)*((255-2*(255-a))*(255-b)/255+2*a*b/255)+(a<=128)*(2*a*b/255), 'L')", a=b1, b=b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'SOFT_LIGHT' in blend_mode:
-        # 柔光模式
-        r = ImageMath.eval("convert((b<128)*(2*a*b/255+(a*a/255)*(255-2*b))+(b>=128)*(2*a*(255-b)/255+sqrt(a/255)*(2*b-255))*255, 'L')", a=r1, b=r2)
-        g = ImageMath.eval("convert((b<128)*(2*a*b/255+(a*a/255)*(255-2*b))+(b>=128)*(2*a*(255-b)/255+sqrt(a/255)*(2*b-255))*255, 'L')", a=g1, b=g2)
-        b = ImageMath.eval("convert((b<128)*(2*a*b/255+(a*a/255)*(255-2*b))+(b>=128)*(2*a*(255-b)/255+sqrt(a/255)*(2*b-255))*255, 'L')", a=b1, b=b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'HARD_LIGHT' in blend_mode:
-        # 强光模式
-        r = ImageMath.eval("convert((b<128)*(2*a*b/255)+(b>=128)*(255-2*(255-a)*(255-b)/255), 'L')", a=r1, b=r2)
-        g = ImageMath.eval("convert((b<128)*(2*a*b/255)+(b>=128)*(255-2*(255-a)*(255-b)/255), 'L')", a=g1, b=g2)
-        b = ImageMath.eval("convert((b<128)*(2*a*b/255)+(b>=128)*(255-2*(255-a)*(255-b)/255), 'L')", a=b1, b=b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'COLOR_DODGE' in blend_mode:
-        # 颜色减淡模式
-        def dodge(a, b):
-            return ImageMath.eval("convert((b==255)*255+(b!=255)*(min(255, a*255/(255-b))), 'L')", a=a, b=b)
+        alpha = alpha.point(lambda i: int(i * opacity + 0.5))
+    
+    mode = psd_blend.blend_mode_name(blend_mode)
+    if mode not in psd_blend.BLEND_FUNCS:
+        logger.warning("不支持的混合模式: %s，使用正常模式代替", blend_mode)
+    expression = _PIL_BLEND_EXPRESSIONS.get(mode)
+    
+    if expression is None:
+        # 正常模式和穿透模式：直接按顶层颜色合成
+        colors = top_channels[:3]
+    else:
+        # 混合结果按基础图像的alpha与顶层颜色插值：Cs' = (1 - ab) * Cs + ab * B(Cb, Cs)，
+        # 再以顶层alpha合成到基础图像上，与 psd_blend 的预乘公式等价
+        backdrop_alpha = base_channels[3].convert('F')
+        mix = f"convert((({expression})*c+b*(255-c))/255+0.5, 'L')"
+        colors = []
+        for base_channel, top_channel in zip(base_channels[:3], top_channels[:3]):
+            args = {'a': base_channel.convert('F'), 'b': top_channel.convert('F'), 'c': backdrop_alpha}
+            if mode == 'SOFT_LIGHT':
+                args['s'] = base_channel.point(lambda i: math.sqrt(i / 255) * 255 + 0.5).convert('F')
+            colors.append(_image_math_eval(mix, **args))
+    
+    return Image.alpha_composite(base, Image.merge('RGBA', (*colors, alpha)))
+
+def layer_region(canvas_size, position, layer_size):
+    """
+    计算图层矩形与画布的交集
+    
+    参数:
+        canvas_size: 画布尺寸 (width, height)
+        position: 图层左上角在画布上的位置 (left, top)
+        layer_size: 图层图像尺寸 (width, height)
+    
+    返回:
+        (canvas_box, layer_box)，分别为交集在画布坐标和图层坐标下的 (left, top, right, bottom)；
+        没有交集时返回None
+    """
+    left = max(0, position[0])
+    top = max(0, position[1])
+    right = min(canvas_size[0], position[0] + layer_size[0])
+    bottom = min(canvas_size[1], position[1] + layer_size[1])
+    if right <= left or bottom <= top:
+        return None
+    
+    canvas_box = (left, top, right, bottom)
+    layer_box = (left - position[0], top - position[1], right - position[0], bottom - position[1])
+    return canvas_box, layer_box
+
+def collect_layer_tree(layers_dir, manifest=None):
+    """
+    递归收集 save_layer_images 写出的完整图层目录树
+    
+    每个图层（或图层组）对应一个子目录，其中包含与目录同名的JSON元数据和PNG图像，
+    图层组的子图层位于该目录的下一级子目录中。图层组的PNG可以不存在。
+    有图层清单时直接由清单条目构建图层树，不再逐个目录查找和读取JSON文件。
+    
+    参数:
+        layers_dir: 图层目录路径
+        manifest: load_layer_manifest 读取的图层清单，为None时遍历目录
+    
+    返回:
+        根图层节点列表，按PSD中从下到上的顺序（索引从小到大）排列；
+        图层组节点的 'children' 为其子图层节点列表
+    """
+    if manifest is not None:
+        # 清单中父图层组在子图层之前，按目录即可找到父节点
+        roots = []
+        nodes_by_dir = {}
+        for entry in manifest['layers']:
+            node = {
+                'path': os.path.join(layers_dir, entry['dir']),
+                'png': os.path.join(layers_dir, entry['image']) if entry.get('image') else None,
+                'metadata': entry,
+                'full_path': entry.get('path', entry['dir'])
+            }
+            if entry.get('type') == 'Group':
+                node['children'] = []
+            nodes_by_dir[entry['dir']] = node
+            parent = nodes_by_dir.get(os.path.dirname(entry['dir']))
+            (parent['children'] if parent else roots).append(node)
         
-        r = dodge(r1, r2)
-        g = dodge(g1, g2)
-        b = dodge(b1, b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'COLOR_BURN' in blend_mode:
-        # 颜色加深模式
-        def burn(a, b):
-            return ImageMath.eval("convert((b==0)*0+(b!=0)*(255-min(255, (255-a)*255/b)), 'L')", a=a, b=b)
+        def sort_nodes(nodes):
+            nodes.sort(key=lambda node: node['metadata'].get('index', 0))
+            for node in nodes:
+                if 'children' in node:
+                    sort_nodes(node['children'])
+            return nodes
         
-        r = burn(r1, r2)
-        g = burn(g1, g2)
-        b = burn(b1, b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'DARKEN' in blend_mode:
-        # 变暗模式
-        r = ImageMath.eval("convert(min(a,b), 'L')", a=r1, b=r2)
-        g = ImageMath.eval("convert(min(a,b), 'L')", a=g1, b=g2)
-        b = ImageMath.eval("convert(min(a,b), 'L')", a=b1, b=b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
-    elif 'LIGHTEN' in blend_mode:
-        # 变亮模式
-        r = ImageMath.eval("convert(max(a,b), 'L')", a=r1, b=r2)
-        g = ImageMath.eval("convert(max(a,b), 'L')", a=g1, b=g2)
-        b = ImageMath.eval("convert(max(a,b), 'L')", a=b1, b=b2)
-        # 创建混合结果
-        blend_result = Image.merge('RGB', (r, g, b))
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将混合结果与alpha通道合并
-        result.paste(blend_result, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
+        return sort_nodes(roots)
+    
+    def collect(group_dir):
+        nodes = []
+        for item in os.listdir(group_dir):
+            item_path = os.path.join(group_dir, item)
+            item_json = os.path.join(item_path, f"{item}.json")
+            if not os.path.isdir(item_path) or not os.path.exists(item_json):
+                continue
+            
+            with open(item_json, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            
+            item_png = find_image(item_path, item)
+            node = {
+                'path': item_path,
+                'png': item_png if not metadata.get('empty') else None,
+                'metadata': metadata,
+                'full_path': metadata.get('path', item)
+            }
+            if metadata.get('type') == 'Group':
+                node['children'] = collect(item_path)
+            nodes.append(node)
+        
+        # 在PSD中，图层从下到上的顺序对应索引从小到大
+        nodes.sort(key=lambda node: node['metadata'].get('index', 0))
+        return nodes
+    
+    return collect(layers_dir)
+
+def _node_bbox(node):
+    """
+    计算图层节点在画布坐标下的矩形 (left, top, right, bottom)；图层组取所有子图层矩形的并集
+    """
+    if 'children' in node:
+        boxes = [box for box in (_node_bbox(child) for child in node['children']) if box]
+        if not boxes:
+            return None
+        return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                max(box[2] for box in boxes), max(box[3] for box in boxes))
+    
+    metadata = node['metadata']
+    # 提取时标记为空的图层没有图像，不参与合成
+    if metadata.get('empty') or metadata.get('width', 0) <= 0 or metadata.get('height', 0) <= 0:
+        return None
+    return (metadata['left'], metadata['top'],
+            metadata['left'] + metadata['width'], metadata['top'] + metadata['height'])
+
+def _open_layer_image(path):
+    """
+    打开并解码图层图像，格式按扩展名确定（见 psd_output）
+    """
+    return open_image(path)
+
+def render_layer_tree(nodes, canvas, origin=(0, 0), open_layer=None):
+    """
+    按图层树的嵌套结构将图层合成到预乘画布数组上
+    
+    普通图层组先在独立的缓冲区内合成其子图层，再以组的混合模式和不透明度合成到背景上；
+    穿透（PASS_THROUGH）图层组的子图层直接与背景混合，组的不透明度在合成前后的背景之间插值。
+    叶子图层的PNG由 layer.composite() 渲染，已经包含图层自身的不透明度，因此只应用混合模式。
+    
+    参数:
+        nodes: collect_layer_tree 返回的图层节点列表
+        canvas: 预乘的 float32 画布数组（HxWx4），原地修改
+        origin: canvas[0, 0] 在PSD画布坐标下的位置 (left, top)
+        open_layer: 读取叶子图层像素的函数，参数为图层节点，返回 PIL.Image、HxWx4 的uint8数组
+            或已经预乘的 float32 数组（如 LayerCache.premultiplied 的结果）；为None时直接打开节点的PNG
+    """
+    canvas_size = (canvas.shape[1], canvas.shape[0])
+    if open_layer is None:
+        open_layer = lambda node: _open_layer_image(node['png'])
+    
+    for node in nodes:
+        metadata = node['metadata']
+        if not metadata.get('visible', True):
+            continue
+        
+        blend_mode = metadata.get('blend_mode', 'BlendMode.NORMAL')
+        bbox = _node_bbox(node)
+        if bbox is None:
+            continue
+        
+        region = layer_region(canvas_size, (bbox[0] - origin[0], bbox[1] - origin[1]),
+                              (bbox[2] - bbox[0], bbox[3] - bbox[1]))
+        if region is None:
+            continue
+        left, top, right, bottom = region[0]
+        canvas_view = canvas[top:bottom, left:right]
+        view_origin = (origin[0] + left, origin[1] + top)
+        
+        # 图层组的区间包含其子图层的区间，单独命名，避免汇总时把子图层的耗时重复计入 compose_layer
+        span_name = 'compose_group' if 'children' in node else 'compose_layer'
+        with psd_trace.span(span_name, layer=metadata.get('path', metadata.get('name')),
+                            blend_mode=psd_blend.blend_mode_name(blend_mode)):
+            if 'children' in node:
+                opacity = metadata.get('opacity', 255) / 255.0
+                if psd_blend.blend_mode_name(blend_mode) == 'PASS_THROUGH':
+                    # 穿透：子图层直接与背景混合
+                    backdrop = canvas_view.copy() if opacity < 1.0 else None
+                    render_layer_tree(node['children'], canvas_view, view_origin, open_layer)
+                    if backdrop is not None:
+                        canvas_view -= backdrop
+                        canvas_view *= np.float32(opacity)
+                        canvas_view += backdrop
+                else:
+                    # 隔离：子图层先合成到透明缓冲区，再整体混合到背景上
+                    group_buffer = np.zeros_like(canvas_view)
+                    render_layer_tree(node['children'], group_buffer, view_origin, open_layer)
+                    psd_blend.blend_premultiplied(canvas_view, group_buffer, blend_mode, opacity, out=canvas_view)
+            elif node['png']:
+                layer_image = open_layer(node)
+                if isinstance(layer_image, Image.Image):
+                    layer_size = layer_image.size
+                else:
+                    layer_size = (layer_image.shape[1], layer_image.shape[0])
+                layer_box = region[1]
+                if layer_size != (bbox[2] - bbox[0], bbox[3] - bbox[1]):
+                    # 图像尺寸与元数据不一致时，以图像尺寸为准重新计算交集
+                    region = layer_region(canvas_size, (bbox[0] - origin[0], bbox[1] - origin[1]), layer_size)
+                    if region is None:
+                        continue
+                    left, top, right, bottom = region[0]
+                    canvas_view = canvas[top:bottom, left:right]
+                    layer_box = region[1]
+                if isinstance(layer_image, Image.Image):
+                    layer_crop = layer_image.crop(layer_box)
+                else:
+                    layer_crop = layer_image[layer_box[1]:layer_box[3], layer_box[0]:layer_box[2]]
+                if isinstance(layer_crop, np.ndarray) and layer_crop.dtype == np.float32:
+                    layer_array = layer_crop
+                else:
+                    layer_array = psd_blend.to_premultiplied(layer_crop)
+                psd_blend.blend_premultiplied(canvas_view, layer_array, blend_mode, out=canvas_view)
+
+def _load_psd_metadata(layers_dir):
+    """
+    读取PSD元数据，优先使用图层清单
+    
+    返回:
+        (psd_metadata, manifest)，没有可用的图层清单时manifest为None
+    """
+    # 优先读取图层清单，一次得到PSD元数据和所有图层的元数据
+    manifest = load_layer_manifest(layers_dir)
+    if manifest is not None and manifest.get('root') is None:
+        manifest = None
+    
+    if manifest is not None:
+        psd_metadata = manifest['root']
     else:
-        # 其他混合模式，默认使用正常模式
-        print(f"不支持的混合模式: {blend_mode}，使用正常模式代替")
-        # 创建一个与基础图像大小相同的透明图像
-        result = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        # 将顶层图像与调整后的alpha通道合并
-        top_with_opacity = Image.merge('RGBA', (r2, g2, b2, a2))
-        # 将顶层图像粘贴到结果图像上
-        result.paste(top_with_opacity, (0, 0), a2)
-        # 将结果与基础图像合成
-        result = Image.alpha_composite(base, result)
+        # 获取PSD元数据
+        psd_json_path = None
+        for file in os.listdir(layers_dir):
+            # 跳过以点开头的清单等辅助文件和图层清单
+            if (file.endswith('.json') and not file.startswith('.') and file != LAYER_MANIFEST_NAME
+                    and not os.path.isdir(os.path.join(layers_dir, file))):
+                psd_json_path = os.path.join(layers_dir, file)
+                break
+        
+        if not psd_json_path:
+            raise FileNotFoundError(f"在 {layers_dir} 中找不到PSD元数据文件")
+        
+        # 读取PSD元数据
+        with open(psd_json_path, 'r', encoding='utf-8') as f:
+            psd_metadata = json.load(f)
     
-    return result
+    return psd_metadata, manifest
 
-def compose_layers(layers_dir, output_path=None):
+def compose_layers(layers_dir, output_path=None, engine='pil', recursive=False, tile_size=None, workers=1,
+                   image_format=None, cache=None, skip_root=False):
     """
     根据图层组的JSON元数据将PNG图像拼接成一张完整的图像
     
     参数:
         layers_dir: 图层目录路径，包含图层组的PNG和JSON文件
         output_path: 输出图像的路径，如果为None，则使用layers_dir的父目录和PSD文件名
+        engine: 混合引擎，'pil' 或 'numpy'
+        recursive: 是否从叶子图层递归合成完整的图层树（始终使用numpy引擎），
+            否则只使用根目录和第一层级图层组的预渲染PNG
+        tile_size: 分块大小，指定时使用 compose_tiled 按块递归合成并流式写出
+        workers: 合成线程数，大于1时同样使用 compose_tiled 分块并行合成
+        image_format: 输出格式（见 psd_output），为None时按输出路径的扩展名确定，
+            没有指定输出路径时为PNG
+        cache: psd_cache.LayerCache，指定时从缓存读取解码后的图层，重复合成不再解码图层图像
+        skip_root: 不合成根目录下的PSD合成图像，只混合第一层级的图层组PNG。根图像最后以完全不透明
+            覆盖画布，背景不透明时输出与它相同，测试混合引擎时需要跳过
     
     返回:
         拼接后的图像路径
     """
-    # 获取PSD元数据
-    psd_json_path = None
-    for file in os.listdir(layers_dir):
-        if file.endswith('.json') and not os.path.isdir(os.path.join(layers_dir, file)):
-            psd_json_path = os.path.join(layers_dir, file)
-            break
+    if tile_size or workers > 1:
+        return compose_tiled(layers_dir, output_path, tile_size or DEFAULT_TILE_SIZE, workers, image_format, cache)
     
-    if not psd_json_path:
-        raise FileNotFoundError(f"在 {layers_dir} 中找不到PSD元数据文件")
+    psd_metadata, manifest = _load_psd_metadata(layers_dir)
     
-    # 读取PSD元数据
-    with open(psd_json_path, 'r', encoding='utf-8') as f:
-        psd_metadata = json.load(f)
+    if recursive:
+        # 从叶子图层开始递归合成，不使用预渲染的图层组PNG和PSD合成图像
+        canvas_array = np.zeros((psd_metadata['height'], psd_metadata['width'], 4), dtype=np.float32)
+        render_layer_tree(collect_layer_tree(layers_dir, manifest), canvas_array,
+                          open_layer=_cached_open_layer(cache, 'premultiplied'))
+        return _save_composed(psd_blend.to_image(canvas_array), layers_dir, psd_metadata, output_path, image_format)
     
     # 创建一个空白画布，尺寸与PSD文件相同
     canvas = Image.new('RGBA', (psd_metadata['width'], psd_metadata['height']), (0, 0, 0, 0))
     
+    # numpy引擎在整个合成过程中保持预乘数组，避免每层都在图像和数组之间转换
+    if engine == 'numpy':
+        canvas_array = psd_blend.to_premultiplied(canvas)
+    
     # 收集所有图层组信息
     layer_groups = []
     
@@ -232,7 +397,7 @@ def compose_layers(layers_dir, output_path=None):
         if depth == 0:
             # 处理根目录下的PSD文件本身的PNG和JSON
             for item in items:
-                if item.endswith('.png') and not os.path.isdir(os.path.join(group_dir, item)):
+                if format_for_path(item) and not os.path.isdir(os.path.join(group_dir, item)):
                     # 找到对应的JSON文件
                     json_file = os.path.splitext(item)[0] + '.json'
                     if json_file in items:
@@ -259,10 +424,10 @@ def compose_layers(layers_dir, output_path=None):
                 if os.path.isdir(item_path):
                     # 检查子目录中是否有与目录同名的PNG和JSON文件
                     item_name = os.path.basename(item_path)
-                    item_png = os.path.join(item_path, f"{item_name}.png")
+                    item_png = find_image(item_path, item_name)
                     item_json = os.path.join(item_path, f"{item_name}.json")
                     
-                    if os.path.exists(item_png) and os.path.exists(item_json):
+                    if item_png and os.path.exists(item_json):
                         # 读取图层元数据
                         with open(item_json, 'r', encoding='utf-8') as f:
                             metadata = json.load(f)
@@ -280,8 +445,31 @@ def compose_layers(layers_dir, output_path=None):
                     # 不再递归处理更深层次的子目录
         # 如果不是根目录，则不做任何处理（不收集更深层次的图层）
     
-    # 从根目录开始收集图层组信息
-    collect_groups(layers_dir)
+    if manifest is not None:
+        # 根图层为PSD合成图像，第一层级图层为清单中位于输出目录下一级的条目
+        psd_name = os.path.splitext(psd_metadata['image'])[0]
+        layer_groups.append({
+            'path': layers_dir,
+            'png': os.path.join(layers_dir, psd_metadata['image']),
+            'metadata': psd_metadata,
+            'depth': 0,
+            'full_path': psd_name,
+            'index': psd_metadata.get('index', 0)
+        })
+        for entry in manifest['layers']:
+            if os.path.dirname(entry['dir']) or not entry.get('image'):
+                continue
+            layer_groups.append({
+                'path': os.path.join(layers_dir, entry['dir']),
+                'png': os.path.join(layers_dir, entry['image']),
+                'metadata': entry,
+                'depth': 1,
+                'full_path': entry['dir'],
+                'index': entry.get('index', 0)
+            })
+    else:
+        # 从根目录开始收集图层组信息
+        collect_groups(layers_dir)
     
     # 在PSD中，图层从下到上的顺序对应索引从小到大
     # 我们需要先渲染底层图层，然后是上层图层
@@ -292,19 +480,22 @@ def compose_layers(layers_dir, output_path=None):
     root_layers = [group for group in layer_groups if group['depth'] == 0]
     first_level_layers = [group for group in layer_groups if group['depth'] == 1]
     
-    # 对第一层子图层按索引从大到小排序，确保索引较大的图层后渲染
+    # 对第一层子图层按索引从小到大排序，确保索引较大的图层后渲染
     # 这样可以确保索引较大的图层（在PSD中位于上层）覆盖在索引较小的图层（在PSD中位于下层）上面
-    first_level_layers.sort(key=lambda x: x['metadata'].get('index', 0), reverse=True)
+    first_level_layers.sort(key=lambda x: x['metadata'].get('index', 0))
     
     # 先渲染第一层子图层，然后渲染根图层（如果有）
     # 这样可以确保根图层（通常是PSD合成图像）覆盖在子图层上面
-    sorted_layer_groups = first_level_layers + root_layers
+    sorted_layer_groups = first_level_layers + ([] if skip_root else root_layers)
     
-    print(f"排序后的图层组顺序:")
-    for group in sorted_layer_groups:
-        # 使用full_path或者从png路径中提取名称
-        layer_name = group['full_path'] if 'full_path' in group else os.path.basename(os.path.dirname(group['png']))
-        print(f"  - 图层组: {layer_name}, 深度: {group['depth']}, 索引: {group['metadata'].get('index', 0)}, 可见性: {group['metadata'].get('visible', True)}")
+    # 完整的图层列表只在调试级别输出，默认级别下不遍历
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("排序后的图层组顺序:")
+        for group in sorted_layer_groups:
+            # 使用full_path或者从png路径中提取名称
+            layer_name = group['full_path'] if 'full_path' in group else os.path.basename(os.path.dirname(group['png']))
+            logger.debug("  - 图层组: %s, 深度: %s, 索引: %s, 可见性: %s", layer_name, group['depth'],
+                         group['metadata'].get('index', 0), group['metadata'].get('visible', True))
     
     # 渲染图层组
     # 按照排序后的顺序直接渲染图层
@@ -314,23 +505,19 @@ def compose_layers(layers_dir, output_path=None):
             if visible:
                 try:
                     # 读取图层组图像
-                    layer_image = Image.open(group['png'])
-                    
-                    # 获取不透明度
-                    opacity = group['metadata'].get('opacity', 255) / 255.0
+                    layer_image = cache.open_image(group['png']) if cache is not None else _open_layer_image(group['png'])
                     
-                    # 创建一个与画布大小相同的透明图像
-                    temp = Image.new('RGBA', canvas.size, (0, 0, 0, 0))
+                    # 提取的图层组图像（layer.composite()）已经乘上了不透明度，与递归合成的叶子图层一样不再重复应用
+                    opacity = 1.0
                     
-                    # 将图层组图像粘贴到正确的位置
-                    # 如果是根目录下的PNG文件（如PSD合成图像），则粘贴到(0,0)位置
+                    # 图层在画布上的位置
+                    # 如果是根目录下的PNG文件（如PSD合成图像），则放在(0,0)位置
                     # 否则使用元数据中的位置信息
-                    if 'left' in group['metadata'] and 'top' in group['metadata']:
-                        temp.paste(layer_image, (group['metadata']['left'], group['metadata']['top']), layer_image)
+                    has_position = 'left' in group['metadata'] and 'top' in group['metadata']
+                    if has_position:
+                        position = (group['metadata']['left'], group['metadata']['top'])
                     else:
-                        # 对于根目录下的PNG文件，假设它们应该覆盖整个画布
-                        # 直接使用图像而不使用透明度蒙版
-                        temp.paste(layer_image, (0, 0))
+                        position = (0, 0)
                     
                     # 应用混合模式和不透明度
                     blend_mode = group['metadata'].get('blend_mode', 'BlendMode.NORMAL')
@@ -338,37 +525,345 @@ def compose_layers(layers_dir, output_path=None):
                     # 获取图层名称
                     layer_name = group['full_path'] if 'full_path' in group else os.path.basename(os.path.dirname(group['png']))
                     
+                    # 只处理图层矩形与画布的交集，画布其余部分保持不变
+                    region = layer_region(canvas.size, position, layer_image.size)
+                    if region is None:
+                        logger.debug("跳过画布范围外的图层组: %s", layer_name)
+                        continue
+                    canvas_box, layer_box = region
+                    
+                    # 裁剪出交集区域内的图层组图像；不能以自身为蒙版贴到透明图像上，那样alpha会被平方
+                    temp = layer_image.crop(layer_box)
+                    if temp.mode != 'RGBA':
+                        temp = temp.convert('RGBA')
+                    
                     # 打印图层信息，帮助调试
-                    print(f"正在合成图层组: {layer_name}")
-                    print(f"  - 深度: {group['depth']}, 索引: {group['metadata'].get('index', 0)}")
-                    print(f"  - 混合模式: {blend_mode}, 不透明度: {opacity:.2f}, 可见性: {visible}")
+                    logger.debug("正在合成图层组: %s, 深度: %s, 索引: %s, 混合模式: %s, 不透明度: %.2f",
+                                 layer_name, group['depth'], group['metadata'].get('index', 0), blend_mode, opacity)
                     
-                    # 应用混合模式和不透明度
-                    canvas = apply_blend_mode(canvas, temp, blend_mode, opacity)
+                    # 应用混合模式和不透明度，结果原地写回画布的对应区域
+                    if engine == 'numpy':
+                        left, top, right, bottom = canvas_box
+                        canvas_view = canvas_array[top:bottom, left:right]
+                        psd_blend.blend_premultiplied(canvas_view, psd_blend.to_premultiplied(temp),
+                                                      blend_mode, opacity, out=canvas_view)
+                    else:
+                        blended = apply_blend_mode(canvas.crop(canvas_box), temp, blend_mode, opacity)
+                        canvas.paste(blended, canvas_box[:2])
                     
-                    print(f"已合成图层组: {layer_name}")
+                    logger.debug("已合成图层组: %s", layer_name)
                 except Exception as e:
                     # 获取图层名称
                     layer_name = group['full_path'] if 'full_path' in group else os.path.basename(os.path.dirname(group['png']))
-                    print(f"无法处理图层组 {layer_name}: {e}")
+                    logger.warning("无法处理图层组 %s: %s", layer_name, e, extra={'data': {'layer': layer_name}})
             else:
                 # 获取图层名称
                 layer_name = group['full_path'] if 'full_path' in group else os.path.basename(os.path.dirname(group['png']))
-                print(f"跳过不可见图层组: {layer_name}")
-                print(f"  - 深度: {group['depth']}, 索引: {group['metadata'].get('index', 0)}, 可见性: {visible}")
+                logger.debug("跳过不可见图层组: %s, 深度: %s, 索引: %s", layer_name, group['depth'],
+                             group['metadata'].get('index', 0))
     
-    # 如果没有指定输出路径，则使用PSD文件名
+    if engine == 'numpy':
+        canvas = psd_blend.to_image(canvas_array)
+    
+    return _save_composed(canvas, layers_dir, psd_metadata, output_path, image_format)
+
+def _scale_layer_tree(nodes, crop, scale, output_size):
+    """
+    将图层树变换到感兴趣区域（ROI）的输出坐标系
+    
+    只保留与ROI相交的叶子图层，每个叶子图层的元数据改为其在输出图像中的矩形，
+    并记录对应的源图像区域 'source_box'（图层图像坐标，可为小数）。
+    """
+    scaled = []
+    for node in nodes:
+        if 'children' in node:
+            children = _scale_layer_tree(node['children'], crop, scale, output_size)
+            if children:
+                scaled.append(dict(node, children=children))
+            continue
+        
+        bbox = _node_bbox(node)
+        if bbox is None or not node['png']:
+            continue
+        
+        # 图层与ROI的交集，换算为输出图像中的像素范围
+        left, top = max(bbox[0], crop[0]), max(bbox[1], crop[1])
+        right, bottom = min(bbox[2], crop[2]), min(bbox[3], crop[3])
+        if left >= right or top >= bottom:
+            continue
+        out_left = max(0, math.floor((left - crop[0]) * scale))
+        out_top = max(0, math.floor((top - crop[1]) * scale))
+        out_right = min(output_size[0], math.ceil((right - crop[0]) * scale))
+        out_bottom = min(output_size[1], math.ceil((bottom - crop[1]) * scale))
+        if out_left >= out_right or out_top >= out_bottom:
+            continue
+        
+        # 输出像素范围对应的源图像区域，限制在图层图像范围内
+        layer_width, layer_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        source_box = (
+            min(max(crop[0] + out_left / scale - bbox[0], 0), layer_width),
+            min(max(crop[1] + out_top / scale - bbox[1], 0), layer_height),
+            min(max(crop[0] + out_right / scale - bbox[0], 0), layer_width),
+            min(max(crop[1] + out_bottom / scale - bbox[1], 0), layer_height)
+        )
+        metadata = dict(node['metadata'], left=out_left, top=out_top,
+                        width=out_right - out_left, height=out_bottom - out_top)
+        scaled.append(dict(node, metadata=metadata, source_box=source_box))
+    return scaled
+
+def render_region(nodes, crop, scale=1.0, open_layer=None):
+    """
+    只合成感兴趣区域（ROI）内的图层，并按比例缩放输出
+    
+    每个与ROI相交的叶子图层只读取一次，先把对应区域缩放到输出分辨率再参与混合，
+    因此混合的开销与输出图像的尺寸成正比，与文档尺寸无关。
+    缩小使用BOX（区域平均）重采样，放大使用双三次重采样。
+    
+    参数:
+        nodes: collect_layer_tree 返回的图层节点列表
+        crop: ROI矩形 (left, top, right, bottom)，PSD画布坐标
+        scale: 输出缩放比例
+        open_layer: 读取叶子图层的函数，参数为图层节点，返回 PIL.Image；为None时直接打开节点的PNG
+    
+    返回:
+        预乘的 float32 数组（HxWx4），尺寸为ROI尺寸乘以缩放比例
+    """
+    if open_layer is None:
+        open_layer = lambda node: _open_layer_image(node['png'])
+    
+    output_size = (max(1, round((crop[2] - crop[0]) * scale)), max(1, round((crop[3] - crop[1]) * scale)))
+    resample = Image.Resampling.BOX if scale < 1 else Image.Resampling.BICUBIC
+    
+    def open_scaled(node):
+        layer_image = open_layer(node)
+        if layer_image.mode != 'RGBA':
+            layer_image = layer_image.convert('RGBA')
+        metadata = node['metadata']
+        size = (metadata['width'], metadata['height'])
+        box = node['source_box']
+        if all(float(value).is_integer() for value in box) and size == (box[2] - box[0], box[3] - box[1]):
+            # 不需要缩放时直接裁剪，结果与整幅合成完全相同
+            return layer_image.crop(tuple(int(value) for value in box))
+        return layer_image.resize(size, resample, box=box)
+    
+    canvas = np.zeros((output_size[1], output_size[0], 4), dtype=np.float32)
+    render_layer_tree(_scale_layer_tree(nodes, crop, scale, output_size), canvas, open_layer=open_scaled)
+    return canvas
+
+def compose_region(layers_dir, crop=None, scale=1.0, output_path=None, image_format=None, cache=None):
+    """
+    合成图层目录中指定区域的缩略图或视口预览
+    
+    参数:
+        layers_dir: 图层目录路径
+        crop: ROI矩形 (left, top, width, height)，为None时使用整个画布
+        scale: 输出缩放比例，如0.25生成四分之一尺寸的缩略图
+        output_path: 输出图像的路径，为None时不保存
+        image_format: 输出格式（见 psd_output），为None时按输出路径的扩展名确定
+        cache: psd_cache.LayerCache，指定时从缓存读取解码后的图层
+    
+    返回:
+        合成的 RGBA 模式 PIL.Image
+    """
+    psd_metadata, manifest = _load_psd_metadata(layers_dir)
+    if crop is None:
+        crop = (0, 0, psd_metadata['width'], psd_metadata['height'])
+    left, top, width, height = crop
+    if width <= 0 or height <= 0 or scale <= 0:
+        raise ValueError(f"无效的区域或缩放比例: {crop}, {scale}")
+    
+    canvas = render_region(collect_layer_tree(layers_dir, manifest), (left, top, left + width, top + height), scale,
+                           _cached_open_layer(cache, 'image'))
+    image = psd_blend.to_image(canvas)
+    logger.info("已合成区域 %s，缩放 %s，输出尺寸 %dx%d", crop, scale, image.width, image.height)
+    
+    if output_path:
+        save_image(image, output_path, image_format)
+        logger.info("已保存区域图像到: %s", output_path)
+    return image
+
+class _TiledLayerSource:
+    """
+    分块合成时的叶子图层像素来源
+    
+    图层图像在第一次被分块用到时解码一次，转存为临时目录中的uint8 .npy文件并以内存映射方式读取，
+    之后各分块只访问映射中的对应区域；合成进度越过图层底边后删除临时文件。
+    以npy格式提取的图层不需要解码，直接映射图层文件。
+    每个图层解码时仍整幅读入内存一次，转存后即释放，因此峰值内存包含最大的单个图层图像，
+    此外只有分块缓冲区常驻内存。多个线程可以同时读取，同一图层只会被解码一次。
+    """
+    
+    def __init__(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.arrays = {}
+        self.bottoms = {}
+        self.lock = threading.Lock()
+        self.decode_locks = {}
+        # 临时文件的序号，释放图层后也不会重复
+        self.counter = itertools.count()
+    
+    def __call__(self, node):
+        png = node['png']
+        array = self.arrays.get(png)
+        if array is not None:
+            return array
+        
+        with self.lock:
+            decode_lock = self.decode_locks.setdefault(png, threading.Lock())
+        with decode_lock:
+            if png not in self.arrays and format_for_path(png) == 'npy':
+                array = load_array(png)
+                with self.lock:
+                    self.bottoms[png] = (node['metadata'].get('top', 0) + array.shape[0], None)
+                self.arrays[png] = array
+            elif png not in self.arrays:
+                with psd_trace.span('png_decode', file=png), Image.open(png) as image:
+                    if image.mode != 'RGBA':
+                        image = image.convert('RGBA')
+                    with self.lock:
+                        array_path = os.path.join(self.temp_dir, f"{next(self.counter)}.npy")
+                        self.bottoms[png] = (node['metadata'].get('top', 0) + image.height, array_path)
+                    array = np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8,
+                                                      shape=(image.height, image.width, 4))
+                    array[...] = np.asarray(image)
+                    array.flush()
+                    del array
+                self.arrays[png] = np.load(array_path, mmap_mode='r')
+        return self.arrays[png]
+    
+    def release_above(self, y):
+        """
+        释放底边不超过y的图层，之后的分块不会再用到它们
+        """
+        with self.lock:
+            for png in [png for png in self.arrays if self.bottoms[png][0] <= y]:
+                del self.arrays[png]
+                if self.bottoms[png][1] is not None:
+                    os.remove(self.bottoms[png][1])
+
+class _CachedLayerSource:
+    """
+    分块合成时从 LayerCache 读取叶子图层的预乘数组
+    
+    缓存文件本身就以内存映射方式读取，不需要临时文件，也不在合成进度越过图层后删除。
+    """
+    
+    def __init__(self, cache):
+        self.cache = cache
+    
+    def __call__(self, node):
+        return self.cache.premultiplied(node['png'])
+    
+    def release_above(self, y):
+        pass
+
+def _cached_open_layer(cache, kind):
+    """
+    返回从缓存读取叶子图层的 open_layer 函数，kind为 'premultiplied' 或 'image'；没有缓存时返回None
+    """
+    if cache is None:
+        return None
+    if kind == 'premultiplied':
+        return lambda node: cache.premultiplied(node['png'])
+    return lambda node: cache.open_image(node['png'])
+
+def _render_band(nodes, layer_source, width, band_top, band_height, tile_size):
+    """
+    合成一行分块，返回 band_height x width x 4 的uint8结果
+    """
+    band = np.empty((band_height, width, 4), dtype=np.uint8)
+    for tile_left in range(0, width, tile_size):
+        tile_width = min(tile_size, width - tile_left)
+        tile = np.zeros((band_height, tile_width, 4), dtype=np.float32)
+        render_layer_tree(nodes, tile, (tile_left, band_top), layer_source)
+        band[:, tile_left:tile_left + tile_width] = psd_blend.from_premultiplied(tile)
+    return band
+
+def compose_tiled(layers_dir, output_path=None, tile_size=DEFAULT_TILE_SIZE, workers=1, image_format=None, cache=None):
+    """
+    分块递归合成完整的图层树，并将结果流式写入PNG或TIFF文件
+    
+    画布按 tile_size 大小的分块自上而下、自左而右处理，每个分块只合成与其相交的图层，
+    图层组缓冲区也裁剪到分块范围内；一行分块完成后立即写入编码器。
+    峰值内存约为分块大小乘以图层组嵌套深度，加上一行分块的uint8结果和正在解码的单个图层，
+    与画布尺寸无关。合成结果与 compose --recursive 完全相同。
+    
+    workers大于1时，多行分块在线程池中同时合成（NumPy运算、PNG解码和压缩都会释放GIL），
+    每个分块内仍按图层顺序合成，结果按行的顺序写出，与单线程输出的文件逐字节相同。
+    同时进行的行数限制为工作线程数的两倍。
+    
+    参数:
+        layers_dir: 图层目录路径
+        output_path: 输出图像的路径，扩展名为 .tif/.tiff 时写出未压缩TIFF，否则写出PNG
+        tile_size: 分块的边长（像素）
+        workers: 合成线程数
+        image_format: 输出格式（见 psd_output），为None时按扩展名确定；npy直接写入内存映射的文件，
+            WebP和QOI无法流式编码，整幅结果在内存中汇总后一次编码
+        cache: psd_cache.LayerCache，指定时从缓存映射图层的预乘数组，不再解码图层图像和写出临时文件
+    
+    返回:
+        合成图像的路径
+    """
+    psd_metadata, manifest = _load_psd_metadata(layers_dir)
+    output_path = _composed_path(layers_dir, psd_metadata, output_path, image_format)
+    width, height = psd_metadata['width'], psd_metadata['height']
+    nodes = collect_layer_tree(layers_dir, manifest)
+    band_tops = list(range(0, height, tile_size))
+    
+    logger.info("分块合成: %dx%d, 分块大小 %d, 线程数 %d", width, height, tile_size, workers)
+    with tempfile.TemporaryDirectory(prefix='psd_tiles_') as temp_dir:
+        layer_source = _CachedLayerSource(cache) if cache is not None else _TiledLayerSource(temp_dir)
+        with open_image_writer(output_path, width, height, image_format, tile_size) as writer:
+            def write_band(band_top, band):
+                with psd_trace.span('png_encode', file=output_path, rows=band.shape[0]):
+                    writer.write_rows(band)
+                # 更早的行都已写出，之后的行不会再用到底边在此之上的图层
+                layer_source.release_above(band_top + band.shape[0])
+            
+            if workers <= 1:
+                for band_top in band_tops:
+                    write_band(band_top, _render_band(nodes, layer_source, width, band_top,
+                                                      min(tile_size, height - band_top), tile_size))
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    pending = deque()
+                    for band_top in band_tops:
+                        pending.append((band_top, executor.submit(
+                            _render_band, nodes, layer_source, width, band_top,
+                            min(tile_size, height - band_top), tile_size)))
+                        if len(pending) >= workers * 2:
+                            top, future = pending.popleft()
+                            write_band(top, future.result())
+                    while pending:
+                        top, future = pending.popleft()
+                        write_band(top, future.result())
+    
+    logger.info("已保存拼接图像到: %s", output_path)
+    return output_path
+
+def _composed_path(layers_dir, psd_metadata, output_path=None, image_format=None):
+    """
+    拼接图像的输出路径，没有指定时使用layers_dir的父目录、PSD文件名和输出格式的扩展名
+    """
     if output_path is None:
         psd_name = os.path.splitext(psd_metadata['name'])[0]
-        output_path = os.path.join(os.path.dirname(layers_dir), f"{psd_name}_composed.png")
+        output_path = os.path.join(os.path.dirname(layers_dir), f"{psd_name}_composed{image_extension(image_format)}")
+    return output_path
+
+def _save_composed(canvas, layers_dir, psd_metadata, output_path=None, image_format=None):
+    """
+    保存拼接后的图像，返回图像路径
+    """
+    # 如果没有指定输出路径，则使用PSD文件名
+    output_path = _composed_path(layers_dir, psd_metadata, output_path, image_format)
     
     # 保存拼接后的图像
-    canvas.save(output_path)
-    print(f"已保存拼接图像到: {output_path}")
+    save_image(canvas, output_path, image_format)
+    logger.info("已保存拼接图像到: %s", output_path)
     
     return output_path
 
-def compare_images(image1_path, image2_path, output_path, enhance=True, side_by_side=False):
+def compare_images(image1_path, image2_path, output_path, enhance=True, side_by_side=False, image_format=None):
     """
     比较两个图像并生成差异图像
     
@@ -378,13 +873,14 @@ def compare_images(image1_path, image2_path, output_path, enhance=True, side_by_
         output_path: 输出差异图像的路径
         enhance: 是否增强差异以便更容易看到
         side_by_side: 是否生成并排比较图像
+        image_format: 差异图像的输出格式（见 psd_output），为None时按输出路径的扩展名确定
     
     返回:
         差异图像的路径
     """
-    # 读取图像
-    image1 = Image.open(image1_path)
-    image2 = Image.open(image2_path)
+    # 读取图像，输入可以是任意输出格式
+    image1 = open_image(image1_path)
+    image2 = open_image(image2_path)
     
     # 确保两个图像都是RGBA模式
     if image1.mode != 'RGBA':
@@ -394,7 +890,7 @@ def compare_images(image1_path, image2_path, output_path, enhance=True, side_by_
     
     # 确保两个图像尺寸相同
     if image1.size != image2.size:
-        print(f"警告: 图像尺寸不同 {image1.size} vs {image2.size}，将调整第二个图像的尺寸")
+        logger.warning("图像尺寸不同 %s vs %s，将调整第二个图像的尺寸", image1.size, image2.size)
         image2 = image2.resize(image1.size)
     
     # 创建差异图像
@@ -440,15 +936,232 @@ def compare_images(image1_path, image2_path, output_path, enhance=True, side_by_
         draw.text((image1.width * 2 + 10, 10), "差异图像", fill=(255, 255, 255, 255), font=font)
         
         # 保存并排比较图像
-        comparison.save(output_path)
-        print(f"已保存并排比较图像到: {output_path}")
+        save_image(comparison, output_path, image_format)
+        logger.info("已保存并排比较图像到: %s", output_path)
     else:
         # 保存差异图像
-        diff.save(output_path)
-        print(f"已保存差异图像到: {output_path}")
+        save_image(diff, output_path, image_format)
+        logger.info("已保存差异图像到: %s", output_path)
     
     return output_path
 
+# SSIM的窗口大小和常数（与常用实现一致：7x7均匀窗口，K1=0.01，K2=0.03）
+_SSIM_WINDOW = 7
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+# 比较时每个行带的目标像素数
+_COMPARE_BAND_PIXELS = 1 << 21
+
+def _load_rgba_array(image):
+    """
+    将图像路径、文件对象、PIL图像或数组转换为 HxWx4 的uint8数组
+    """
+    if isinstance(image, np.ndarray):
+        if image.ndim != 3 or image.shape[2] != 4 or image.dtype != np.uint8:
+            raise ValueError(f"数组必须是 HxWx4 的uint8 RGBA数组，实际为 {image.shape} {image.dtype}")
+        return image
+    if isinstance(image, str) and format_for_path(image) == 'npy':
+        return load_array(image)
+    if not isinstance(image, Image.Image):
+        image = open_image(image) if isinstance(image, str) else Image.open(image)
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    return np.asarray(image)
+
+def _window_sums(array, window):
+    """
+    用积分图计算每个完整窗口内的和（valid模式），array 为 HxWxC 的float64数组
+    """
+    integral = np.zeros((array.shape[0] + 1, array.shape[1] + 1, array.shape[2]), dtype=np.float64)
+    np.cumsum(array, axis=0, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return (integral[window:, window:] - integral[:-window, window:]
+            - integral[window:, :-window] + integral[:-window, :-window])
+
+def _ssim_sum(x, y, window):
+    """
+    计算窗口完整落在输入内的所有位置的SSIM之和与位置数（各通道分别计算）
+
+    不包含差异像素的窗口SSIM恰好为1，只对覆盖差异像素外接矩形的窗口计算。
+    """
+    rows_out = x.shape[0] - window + 1
+    columns_out = x.shape[1] - window + 1
+    total = rows_out * columns_out * x.shape[2]
+    changed = np.any(x != y, axis=2)
+    changed_rows = np.flatnonzero(changed.any(axis=1))
+    if not len(changed_rows):
+        return float(total), total
+    changed_columns = np.flatnonzero(changed.any(axis=0))
+    top = max(0, changed_rows[0] - window + 1)
+    bottom = min(rows_out, changed_rows[-1] + 1)
+    left = max(0, changed_columns[0] - window + 1)
+    right = min(columns_out, changed_columns[-1] + 1)
+    x = x[top:bottom + window - 1, left:right + window - 1].astype(np.float64)
+    y = y[top:bottom + window - 1, left:right + window - 1].astype(np.float64)
+    count = window * window
+    mean_x = _window_sums(x, window) / count
+    mean_y = _window_sums(y, window) / count
+    # 样本方差和协方差
+    norm = count / (count - 1) if count > 1 else 1.0
+    var_x = (_window_sums(x * x, window) / count - mean_x * mean_x) * norm
+    var_y = (_window_sums(y * y, window) / count - mean_y * mean_y) * norm
+    cov_xy = (_window_sums(x * y, window) / count - mean_x * mean_y) * norm
+    ssim = ((2 * mean_x * mean_y + _SSIM_C1) * (2 * cov_xy + _SSIM_C2)
+            / ((mean_x * mean_x + mean_y * mean_y + _SSIM_C1) * (var_x + var_y + _SSIM_C2)))
+    return float(ssim.sum()) + (total - ssim.size), total
+
+def _mask_runs(mask, row_offset):
+    """
+    返回掩码中每行连续为真的行程 (行, 起始列, 结束列)，结束列不包含在内
+    """
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows + row_offset, starts, ends
+
+def _connected_regions(rows, starts, ends, width, max_regions):
+    """
+    将行程按8连通合并为连通区域，返回按像素数降序排列的区域列表
+
+    行程按 (行, 列) 有序，同一行内互不相交，因此与上一行相连的行程是一段连续的区间，
+    可以用 searchsorted 一次求出；区域合并使用向量化的最小标签传播和指针跳跃。
+    """
+    count = len(rows)
+    if count == 0:
+        return []
+    stride = width + 2
+    start_keys = rows.astype(np.int64) * stride + starts
+    end_keys = rows.astype(np.int64) * stride + ends
+    # 上一行中满足 end >= start 且 start <= end 的行程与当前行程8连通
+    previous_base = (rows.astype(np.int64) - 1) * stride
+    low = np.searchsorted(end_keys, previous_base + starts, side='left')
+    high = np.searchsorted(start_keys, previous_base + ends, side='right')
+    high = np.maximum(high, low)
+    lengths = high - low
+    u = np.repeat(np.arange(count), lengths)
+    v = np.repeat(low - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    labels = np.arange(count)
+    while True:
+        previous_labels = labels.copy()
+        if len(u):
+            smaller = np.minimum(labels[u], labels[v])
+            np.minimum.at(labels, u, smaller)
+            np.minimum.at(labels, v, smaller)
+        labels = labels[labels]
+        if np.array_equal(labels, previous_labels):
+            break
+
+    unique_labels, inverse = np.unique(labels, return_inverse=True)
+    region_count = len(unique_labels)
+    pixels = np.bincount(inverse, weights=ends - starts, minlength=region_count).astype(np.int64)
+    left = np.full(region_count, width, dtype=np.int64)
+    top = np.full(region_count, np.iinfo(np.int64).max, dtype=np.int64)
+    right = np.zeros(region_count, dtype=np.int64)
+    bottom = np.zeros(region_count, dtype=np.int64)
+    np.minimum.at(left, inverse, starts)
+    np.minimum.at(top, inverse, rows)
+    np.maximum.at(right, inverse, ends)
+    np.maximum.at(bottom, inverse, rows + 1)
+
+    order = np.argsort(-pixels, kind='stable')[:max_regions]
+    return [{
+        'left': int(left[i]),
+        'top': int(top[i]),
+        'width': int(right[i] - left[i]),
+        'height': int(bottom[i] - top[i]),
+        'pixels': int(pixels[i])
+    } for i in order]
+
+def compare_metrics(image1, image2, threshold=0, tolerance=None, max_regions=100):
+    """
+    向量化比较两个图像，返回误差指标和变化区域
+
+    图像按行带处理，每个行带结束后检查差异像素数，超过容差时立即停止，
+    此时指标只覆盖已处理的行（complete 为 False）。
+
+    参数:
+        image1: 第一个图像（路径、文件对象、PIL图像或 HxWx4 的uint8数组）
+        image2: 第二个图像
+        threshold: 像素任一通道的差值大于该值时计为差异像素
+        tolerance: 允许的差异像素数，超过时提前结束，为None时比较完整图像
+        max_regions: 最多返回的变化区域数（按像素数从大到小）
+
+    返回:
+        指标字典：mae、max_error、mse、psnr、ssim（0-255通道值，RGBA四个通道）、
+        diff_pixels、regions（变化区域的外接矩形）、exceeded、complete。
+        图像相同时psnr为None（而不是无穷大），结果可以直接序列化为标准JSON
+    """
+    array1 = _load_rgba_array(image1)
+    array2 = _load_rgba_array(image2)
+    if array1.shape != array2.shape:
+        raise ValueError(f"图像尺寸不同: {array1.shape[1::-1]} vs {array2.shape[1::-1]}")
+
+    height, width = array1.shape[:2]
+    band_rows = max(_SSIM_WINDOW, _COMPARE_BAND_PIXELS // max(width, 1))
+    window = min(_SSIM_WINDOW, height, width)
+    window -= 1 - window % 2
+    half = window // 2
+
+    abs_sum = 0
+    square_sum = 0
+    max_error = 0
+    diff_pixels = 0
+    ssim_sum = 0.0
+    ssim_count = 0
+    runs = []
+    rows_done = 0
+    exceeded = False
+
+    for top in range(0, height, band_rows):
+        bottom = min(height, top + band_rows)
+        band1 = array1[top:bottom]
+        band2 = array2[top:bottom]
+        diff = np.abs(band1.astype(np.int16) - band2.astype(np.int16))
+        abs_sum += int(diff.sum(dtype=np.int64))
+        square_sum += int(np.square(diff, dtype=np.int32).sum(dtype=np.int64))
+        pixel_error = diff.max(axis=2)
+        max_error = max(max_error, int(pixel_error.max()))
+        mask = pixel_error > threshold
+        diff_pixels += int(np.count_nonzero(mask))
+        runs.append(_mask_runs(mask, top))
+
+        # SSIM窗口中心落在本行带内的位置，输入向上下各扩展半个窗口
+        center_top = max(top, half)
+        center_bottom = min(bottom, height - half)
+        if center_bottom > center_top:
+            part_sum, part_count = _ssim_sum(array1[center_top - half:center_bottom + half],
+                                             array2[center_top - half:center_bottom + half], window)
+            ssim_sum += part_sum
+            ssim_count += part_count
+
+        rows_done = bottom
+        if tolerance is not None and diff_pixels > tolerance:
+            exceeded = True
+            break
+
+    samples = rows_done * width * 4
+    mse = square_sum / samples if samples else 0.0
+    rows, starts, ends = (np.concatenate(values) for values in zip(*runs)) if runs else ([], [], [])
+    return {
+        'width': width,
+        'height': height,
+        'mae': abs_sum / samples if samples else 0.0,
+        'max_error': max_error,
+        'mse': mse,
+        'psnr': 10 * math.log10(255 * 255 / mse) if mse > 0 else None,
+        'ssim': ssim_sum / ssim_count if ssim_count else 1.0,
+        'threshold': threshold,
+        'diff_pixels': diff_pixels,
+        'regions': _connected_regions(rows, starts, ends, width, max_regions) if runs else [],
+        'tolerance': tolerance,
+        'exceeded': exceeded,
+        'complete': rows_done == height
+    }
+
 def main():
     # 解析命令行参数
     parser = argparse.ArgumentParser(description='将图层组的PNG图像拼接成一张完整的图像')
@@ -460,14 +1173,41 @@ def main():
     compose_parser = subparsers.add_parser('compose', help='拼接图层组的PNG图像')
     compose_parser.add_argument('layers_dir', help='图层目录路径')
     compose_parser.add_argument('-o', '--output', help='输出图像的路径')
+    compose_parser.add_argument('--engine', choices=BLEND_ENGINES,
+                                help='混合引擎：pil（逐通道ImageMath，默认）或 numpy（向量化预乘数组）；'
+                                     '递归、分块和区域合成始终使用numpy引擎')
+    compose_parser.add_argument('--recursive', action='store_true',
+                                help='从叶子图层递归合成完整的图层树，正确处理嵌套图层组和穿透模式（使用numpy引擎）')
+    compose_parser.add_argument('--tile-size', type=int,
+                                help='分块递归合成并流式写出PNG/TIFF的分块大小，用于超出内存的大画布')
+    compose_parser.add_argument('--workers', type=int, default=1,
+                                help='分块并行合成的线程数，大于1时使用分块合成')
+    compose_parser.add_argument('--crop', type=lambda value: tuple(int(v) for v in value.split(',')),
+                                metavar='LEFT,TOP,WIDTH,HEIGHT', help='只合成画布中的指定区域')
+    compose_parser.add_argument('--scale', type=float, default=1.0,
+                                help='输出缩放比例，与 --crop 一起或单独使用以生成缩略图')
+    compose_parser.add_argument('--format', type=normalize_image_format, dest='image_format',
+                                help='输出格式：png、png:0-9（压缩级别）、webp、webp:0-6、qoi 或 npy，默认按输出路径的扩展名')
+    compose_parser.add_argument('--cache', nargs='?', const='', metavar='DIR',
+                                help='缓存解码后的图层，重复合成时不再解码图层图像；可指定缓存目录，默认为系统临时目录下的 psd_layer_cache')
+    compose_parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_BYTES >> 20, metavar='MB',
+                                help='图层缓存目录的大小上限（MB），超过时淘汰最久未使用的图层')
     
     # 比较子命令
     compare_parser = subparsers.add_parser('compare', help='比较两个图像并生成差异图像')
     compare_parser.add_argument('image1', help='第一个图像的路径')
     compare_parser.add_argument('image2', help='第二个图像的路径')
-    compare_parser.add_argument('-o', '--output', help='差异图像的输出路径', default='diff.png')
+    compare_parser.add_argument('-o', '--output', help='差异图像的输出路径，默认为当前目录下的 diff 加输出格式的扩展名')
     compare_parser.add_argument('--no-enhance', action='store_true', help='不增强差异图像')
     compare_parser.add_argument('--side-by-side', action='store_true', help='生成并排比较图像')
+    compare_parser.add_argument('--metrics', action='store_true',
+                                help='计算MAE、最大误差、PSNR、SSIM和变化区域，而不是生成差异图像')
+    compare_parser.add_argument('--threshold', type=int, default=0, help='差异像素的阈值（通道差值大于该值）')
+    compare_parser.add_argument('--tolerance', type=int,
+                                help='允许的差异像素数，超过时提前结束并以状态码1退出')
+    compare_parser.add_argument('--report', help='比较指标和变化区域的JSON输出路径')
+    compare_parser.add_argument('--format', type=normalize_image_format, dest='image_format',
+                                help='差异图像的输出格式，与 compose --format 相同')
     
     # 为了向后兼容，添加全局参数
     parser.add_argument('--layers-dir', dest='compat_layers_dir', help='图层目录路径（向后兼容）')
@@ -479,11 +1219,43 @@ def main():
     
     # 处理子命令
     if hasattr(args, 'command') and args.command == 'compose':
-        compose_layers(args.layers_dir, args.output)
+        region = args.crop or args.scale != 1.0
+        # 递归、分块和区域合成不使用 --engine，区域合成不分块，明确拒绝会被忽略的参数
+        if args.engine == 'pil' and (args.recursive or args.tile_size or args.workers > 1 or region):
+            parser.error("--engine pil 不能与 --recursive、--tile-size、--workers、--crop 或 --scale 一起使用，"
+                         "这些合成方式始终使用numpy引擎")
+        if region and (args.tile_size or args.workers > 1):
+            parser.error("--crop/--scale 不能与 --tile-size 或 --workers 一起使用，区域合成不分块")
+        cache = LayerCache(args.cache or None, args.cache_size << 20) if args.cache is not None else None
+        if region:
+            compose_region(args.layers_dir, args.crop, args.scale,
+                           args.output or f"region{image_extension(args.image_format)}", args.image_format, cache)
+        else:
+            compose_layers(args.layers_dir, args.output, engine=args.engine or 'pil', recursive=args.recursive,
+                           tile_size=args.tile_size, workers=args.workers, image_format=args.image_format,
+                           cache=cache)
+        if cache is not None:
+            stats = cache.stats()
+            logger.info("图层缓存: 命中 %d, 解码 %d, %d 个文件共 %.1f MB", stats['hits'], stats['decodes'],
+                        stats['files'], stats['bytes'] / (1 << 20))
+    elif hasattr(args, 'command') and args.command == 'compare' and args.metrics:
+        metrics = compare_metrics(args.image1, args.image2, args.threshold, args.tolerance)
+        psnr = f"{metrics['psnr']:.2f} dB" if metrics['psnr'] is not None else "无穷大（图像相同）"
+        print(f"MAE: {metrics['mae']:.4f}, 最大误差: {metrics['max_error']}, PSNR: {psnr}, "
+              f"SSIM: {metrics['ssim']:.6f}")
+        print(f"差异像素: {metrics['diff_pixels']}，变化区域: {len(metrics['regions'])} 个"
+              + ("（超过容差，已提前结束）" if metrics['exceeded'] else ""))
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(metrics, f, ensure_ascii=False, indent=2, allow_nan=False)
+            logger.info("已保存比较报告到: %s", args.report)
+        if metrics['exceeded']:
+            sys.exit(1)
     elif hasattr(args, 'command') and args.command == 'compare':
-        compare_images(args.image1, args.image2, args.output, 
+        compare_images(args.image1, args.image2, args.output or f"diff{image_extension(args.image_format)}", 
                      enhance=not args.no_enhance, 
-                     side_by_side=args.side_by_side)
+                     side_by_side=args.side_by_side,
+                     image_format=args.image_format)
     # 向后兼容的处理
     elif hasattr(args, 'compare') and args.compare:
         # 比较两个图像
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+常驻渲染服务
+
+在本地HTTP端口或Unix套接字上提供PSD解析、单图层渲染、合成和图像比较接口。
+解析后的 PSDImage、遍历结果、渲染出的图层图像和合成结果保存在按字节数限制大小的LRU缓存中，
+同一文档的重复预览直接命中缓存，不再付出解释器启动、psd_tools导入和 PSDImage.open 的开销。
+文件的修改时间或大小变化后缓存自动失效。
+
+接口（GET，参数为查询字符串）:
+    /info?psd=<path>                        parse_psd 的解析信息（JSON）
+    /layer?psd=<path>&layer=<图层路径>       单个图层的PNG（裁剪到不透明区域），
+                                            X-Layer-Left/X-Layer-Top 为其在画布上的位置
+    /compose?psd=<path>[&crop=l,t,w,h][&scale=s]
+                                            从图层递归合成的PNG，可只合成指定区域并缩放
+    /compare?a=<path>&b=<path>[&enhance=0][&side_by_side=1]
+                                            差异图像PNG，路径为 .psd 时使用其合成结果
+    /compare?a=<path>&b=<path>&metrics=1[&threshold=n][&tolerance=n]
+                                            比较指标和变化区域（JSON）
+    /stats                                  缓存统计（JSON）
+"""
+
+import os
+import io
+import json
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from psd_tools import PSDImage
+
+import psd_blend
+from psd_parser import walk_psd, render_layer
+from psd_cache import LRUCache
+from psd_composer import collect_layer_tree, render_layer_tree, render_region, compare_images, compare_metrics
+from psd_log import get_logger
+
+logger = get_logger('daemon')
+
+
+class RenderService:
+    """
+    带缓存的PSD渲染服务，与传输方式无关
+
+    缓存键包含文件的绝对路径、修改时间和大小，文件变化后旧条目不再命中，随后被LRU淘汰。
+    同一文档的渲染串行进行（psd_tools 对象不保证线程安全），不同文档可以并行。
+    """
+
+    def __init__(self, cache_bytes):
+        self.cache = LRUCache(cache_bytes)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _document_key(self, psd_path):
+        psd_path = os.path.abspath(psd_path)
+        stat = os.stat(psd_path)
+        return (psd_path, stat.st_mtime_ns, stat.st_size)
+
+    def _lock_for(self, doc_key):
+        with self._locks_lock:
+            return self._locks.setdefault(doc_key[0], threading.Lock())
+
+    def _document(self, doc_key):
+        """
+        返回缓存的 (psd, walk)，未命中时打开并遍历PSD文件
+        """
+        document = self.cache.get(doc_key)
+        if document is None:
+            psd = PSDImage.open(doc_key[0])
+            document = (psd, walk_psd(psd, doc_key[0]))
+            # PSDImage 主要保存压缩的通道数据，按文件大小的两倍估算
+            self.cache.put(doc_key, document, doc_key[2] * 2)
+        return document
+
+    def _layer(self, doc_key, psd, task):
+        """
+        返回缓存的 (image, metadata)，未命中时渲染图层
+
+        与 export_layer 相同，无法渲染的图层标记为空并记录渲染错误，失败结果同样缓存，
+        合成时跳过该图层，不再重复渲染。
+        """
+        layer_key = doc_key + ('layer', task['info_path'])
+        rendered = self.cache.get(layer_key)
+        if rendered is None:
+            layer = psd
+            for i in task['index_path']:
+                layer = layer[i]
+            try:
+                image, metadata = render_layer(layer, task, render_image=not task['is_group'])
+            except Exception as e:
+                _, metadata = render_layer(layer, task, render_image=False)
+                metadata['empty'] = True
+                metadata['render_error'] = str(e)
+                image = None
+                logger.warning("无法渲染图层 %s，标记为空图层: %s", task['info_path'], e,
+                               extra={'data': {'layer': task['info_path']}})
+            if image is not None and image.mode != 'RGBA':
+                image = image.convert('RGBA')
+            rendered = (image, metadata)
+            self.cache.put(layer_key, rendered, image.width * image.height * 4 if image else 1024)
+        return rendered
+
+    def info(self, psd_path):
+        """
+        parse_psd 的解析信息
+        """
+        doc_key = self._document_key(psd_path)
+        with self._lock_for(doc_key):
+            return self._document(doc_key)[1]['info']
+
+    def layer(self, psd_path, layer_path):
+        """
+        单个图层的图像和元数据，layer_path为解析信息中的图层路径
+        """
+        doc_key = self._document_key(psd_path)
+        with self._lock_for(doc_key):
+            psd, walk = self._document(doc_key)
+            for task in walk['tasks']:
+                if task['info_path'] == layer_path:
+                    return self._layer(doc_key, psd, task)
+        raise KeyError(f"找不到图层: {layer_path}")
+
+    def compose(self, psd_path, crop=None, scale=1.0):
+        """
+        从缓存的图层图像递归合成，返回PNG字节
+        
+        crop为 (left, top, width, height) 时只合成该区域，scale为输出缩放比例
+        """
+        doc_key = self._document_key(psd_path)
+        compose_key = doc_key + ('compose', crop, scale)
+        png = self.cache.get(compose_key)
+        if png is not None:
+            return png
+
+        with self._lock_for(doc_key):
+            psd, walk = self._document(doc_key)
+            # 与图层清单相同的条目结构，图像键为图层路径，由缓存提供像素
+            entries = []
+            images = {}
+            for task in walk['tasks']:
+                image, metadata = self._layer(doc_key, psd, task)
+                entry = dict(metadata)
+                entry['dir'] = task['save_dir']
+                entry['image'] = task['info_path'] if image is not None else None
+                entry['info_path'] = task['info_path']
+                entries.append(entry)
+                if image is not None:
+                    images[task['info_path']] = image
+
+        nodes = collect_layer_tree('', {'layers': entries})
+        if crop is None and scale == 1.0:
+            canvas = np.zeros((psd.height, psd.width, 4), dtype=np.float32)
+            render_layer_tree(nodes, canvas, open_layer=lambda node: images[node['png']])
+        else:
+            left, top, width, height = crop or (0, 0, psd.width, psd.height)
+            canvas = render_region(nodes, (left, top, left + width, top + height), scale,
+                                   open_layer=lambda node: images[node['png']])
+
+        output = io.BytesIO()
+        psd_blend.to_image(canvas).save(output, format='PNG')
+        png = output.getvalue()
+        self.cache.put(compose_key, png, len(png))
+        return png
+
+    def _compare_source(self, path):
+        return io.BytesIO(self.compose(path)) if path.lower().endswith('.psd') else path
+
+    def compare(self, path_a, path_b, enhance=True, side_by_side=False):
+        """
+        比较两个图像，路径为 .psd 时使用其合成结果，返回差异图像的PNG字节
+        """
+        source = self._compare_source
+        with tempfile.TemporaryDirectory(prefix='psd_daemon_') as temp_dir:
+            output_path = os.path.join(temp_dir, 'diff.png')
+            compare_images(source(path_a), source(path_b), output_path, enhance, side_by_side)
+            with open(output_path, 'rb') as f:
+                return f.read()
+
+    def compare_metrics(self, path_a, path_b, threshold=0, tolerance=None):
+        """
+        比较两个图像，返回 compare_metrics 的指标字典
+        """
+        return compare_metrics(self._compare_source(path_a), self._compare_source(path_b), threshold, tolerance)
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    将HTTP请求分派到 RenderService
+    """
+
+    service = None
+
+    def address_string(self):
+        # Unix套接字的客户端地址为空字符串
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data, status=200):
+        self._send(status, json.dumps(data, ensure_ascii=False, allow_nan=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/info':
+                self._send_json(self.service.info(params['psd']))
+            elif url.path == '/layer':
+                image, metadata = self.service.layer(params['psd'], params['layer'])
+                if image is None:
+                    # 空图层或图层组没有图像
+                    self._send(204, b'', 'image/png', {'X-Layer-Empty': 1})
+                    return
+                output = io.BytesIO()
+                image.save(output, format='PNG')
+                self._send(200, output.getvalue(), 'image/png',
+                           {'X-Layer-Left': metadata['left'], 'X-Layer-Top': metadata['top']})
+            elif url.path == '/compose':
+                crop = tuple(int(value) for value in params['crop'].split(',')) if 'crop' in params else None
+                self._send(200, self.service.compose(params['psd'], crop, float(params.get('scale', 1.0))),
+                           'image/png')
+            elif url.path == '/compare' and params.get('metrics') == '1':
+                tolerance = int(params['tolerance']) if 'tolerance' in params else None
+                self._send_json(self.service.compare_metrics(params['a'], params['b'],
+                                                             int(params.get('threshold', 0)), tolerance))
+            elif url.path == '/compare':
+                self._send(200, self.service.compare(params['a'], params['b'],
+                                                     params.get('enhance', '1') != '0',
+                                                     params.get('side_by_side', '0') == '1'), 'image/png')
+            elif url.path == '/stats':
+                self._send_json(self.service.cache.stats())
+            else:
+                self._send_json({'error': f"未知接口: {url.path}"}, 404)
+        except KeyError as e:
+            self._send_json({'error': f"缺少参数或找不到对象: {e}"}, 400)
+        except FileNotFoundError as e:
+            self._send_json({'error': f"文件不存在: {e}"}, 404)
+        except Exception as e:
+            self._send_json({'error': f"{type(e).__name__}: {e}"}, 500)
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """
+    在Unix套接字上提供HTTP服务
+    """
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ''
+
+
+def serve(host='127.0.0.1', port=8765, socket_path=None, cache_mb=1024):
+    """
+    启动渲染服务，直到被中断
+
+    参数:
+        host: 监听地址，默认只接受本机连接
+        port: 监听端口
+        socket_path: Unix套接字路径，指定时不再监听TCP端口
+        cache_mb: 缓存的大小上限（MB）
+    """
+    handler = type('Handler', (RenderRequestHandler,), {'service': RenderService(cache_mb * 1024 * 1024)})
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, handler)
+        print(f"渲染服务已启动: unix:{socket_path}")
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f"渲染服务已启动: http://{host}:{port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("渲染服务已停止")
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='常驻PSD渲染服务')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=8765, help='监听端口')
+    parser.add_argument('--socket', help='Unix套接字路径，指定时不再监听TCP端口')
+    parser.add_argument('--cache-size', type=int, default=1024, help='缓存的大小上限（MB）')
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.socket, args.cache_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,13 @@ import json
 import argparse
 import re
 
+import psd_trace
+from psd_log import get_logger
+from psd_manifest import load_layer_manifest, manifest_entries, manifest_image_format, manifest_sprites
+from psd_output import BROWSER_IMAGE_FORMATS, parse_image_format
+
+logger = get_logger('html')
+
 def sanitize_css_name(name):
     """
     将图层名称转换为有效的CSS类名
@@ -63,9 +70,12 @@ def get_layer_css(layer, parent_path=''):
     
     return css_class_name, css
 
-def get_layer_html(layer, layers_dir, parent_path='', depth=0):
+def get_layer_html(layer, layers_dir, parent_path='', depth=0, entries=None, sprites=None):
     """
     生成图层的HTML代码
+    
+    entries为图层路径到图层清单条目的映射，为None时逐个尝试可能的图片路径；
+    sprites为图层路径到图集切片的映射，有切片的图层用图集的CSS背景位置显示，不再单独引用图片
     """
     indent = '    ' * depth
     layer_name = layer['name']
@@ -100,10 +110,23 @@ def get_layer_html(layer, layers_dir, parent_path='', depth=0):
     
     # 查找第一个存在的图片路径
     img_path = None
-    for path in img_paths:
-        if os.path.exists(path):
-            img_path = path
-            break
+    img_style = ''
+    offset = (0, 0)
+    if entries is not None:
+        # 有图层清单时直接取图像路径，空图层没有图像
+        entry = entries.get(layer_path)
+        if entry is not None and entry.get('image'):
+            img_path = f"{layers_dir}/{entry['image']}"
+            # 图像已裁剪到不透明区域，按裁剪后的矩形相对图层定位
+            offset = (entry['left'] - layer['left'], entry['top'] - layer['top'])
+            if offset != (0, 0) or (entry['width'], entry['height']) != (layer['width'], layer['height']):
+                img_style = (f" style=\"position: absolute; left: {offset[0]}px; top: {offset[1]}px; "
+                             f"width: {entry['width']}px; height: {entry['height']}px;\"")
+    else:
+        for path in img_paths:
+            if os.path.exists(path):
+                img_path = path
+                break
     
     # 生成HTML代码
     html = f"{indent}<div class=\"layer {css_class_name}\" title=\"{layer_name}\">"
@@ -112,17 +135,24 @@ def get_layer_html(layer, layers_dir, parent_path='', depth=0):
     if is_group and 'children' in layer and layer['children']:
         html += "\n"
         for child in layer['children']:
-            html += get_layer_html(child, layers_dir, layer_path, depth + 1)
+            html += get_layer_html(child, layers_dir, layer_path, depth + 1, entries, sprites)
         html += f"{indent}"
+    elif sprites and layer_path in sprites:  # 如果图层在图集中，显示图集切片
+        sprite = sprites[layer_path]
+        html += (f"\n{indent}    <div class=\"sprite\" style=\"left: {offset[0] + sprite['left']}px; top: {offset[1] + sprite['top']}px; "
+                 f"width: {sprite['width']}px; height: {sprite['height']}px; "
+                 f"background: url('{sprite['sheet_image']}') -{sprite['x']}px -{sprite['y']}px no-repeat;\"></div>")
+        html += f"\n{indent}"
     elif img_path:  # 如果找到了图片路径，添加图片
-        html += f"\n{indent}    <img src=\"{img_path}\" alt=\"{layer_name}\" />"
+        html += f"\n{indent}    <img src=\"{img_path}\" alt=\"{layer_name}\"{img_style} />"
         html += f"\n{indent}"
     
     html += "</div>\n"
     
     return html
 
-def generate_psd_html(psd_info_path, layers_dir, output_file):
+@psd_trace.traced('html_emit')
+def generate_psd_html(psd_info_path, layers_dir, output_file, use_atlas=False):
     """
     根据PSD解析结果生成HTML文件
     
@@ -130,6 +160,7 @@ def generate_psd_html(psd_info_path, layers_dir, output_file):
         psd_info_path: PSD信息JSON文件路径
         layers_dir: 图层图片目录路径
         output_file: 输出HTML文件路径
+        use_atlas: 是否使用 psd_atlas 生成的图集，以CSS背景位置切片显示图层
     """
     # 加载PSD信息
     with open(psd_info_path, 'r', encoding='utf-8') as f:
@@ -172,6 +203,10 @@ body {
     object-fit: contain;
 }
 
+.layer .sprite {
+    position: absolute;
+}
+
 /* 控制面板样式 */
 .controls {
     margin-bottom: 20px;
@@ -257,9 +292,21 @@ body {
     <div class="psd-container" style="width: {psd_width}px; height: {psd_height}px;">
 """
     
+    # 有图层清单时直接从清单得到图像路径，不再逐个检查文件是否存在
+    manifest = load_layer_manifest(layers_dir)
+    entries = manifest_entries(manifest) if manifest else None
+    if manifest and parse_image_format(manifest_image_format(manifest))[0] not in BROWSER_IMAGE_FORMATS:
+        logger.warning("图层图像格式为 %s，浏览器无法显示，请使用 png 或 webp 重新提取或使用 --atlas",
+                       manifest_image_format(manifest))
+    sprites = None
+    if use_atlas:
+        sprites = manifest_sprites(manifest, layers_dir) if manifest else {}
+        if not sprites:
+            logger.warning("在 %s 中找不到图集，请先运行 psd_atlas.py，改为逐个引用图层图片", layers_dir)
+    
     # 添加图层HTML
     for layer in psd_info['layers']:
-        html += get_layer_html(layer, layers_dir)
+        html += get_layer_html(layer, layers_dir, entries=entries, sprites=sprites)
     
     # 添加JavaScript交互
     html += """    </div>
@@ -305,7 +352,7 @@ body {
     with open(output_file, 'w', encoding='utf-8') as f:
         f.write(html)
     
-    print(f"已生成HTML文件: {output_file}")
+    logger.info("已生成HTML文件: %s", output_file)
 
 def main():
     # 解析命令行参数
@@ -316,10 +363,12 @@ def main():
                         help='图层图片目录路径')
     parser.add_argument('--output-file', type=str, default='../src/psd_layout_generated.html',
                         help='输出HTML文件路径')
+    parser.add_argument('--atlas', action='store_true',
+                        help='使用 psd_atlas.py 生成的图集，以CSS背景位置切片显示图层')
     args = parser.parse_args()
     
     # 生成HTML
-    generate_psd_html(args.psd_info, args.layers_dir, args.output_file)
+    generate_psd_html(args.psd_info, args.layers_dir, args.output_file, args.atlas)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
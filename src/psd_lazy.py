@@ -0,0 +1,916 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+只读取结构的PSD解析
+
+PSDImage.open 会读入整个文件，包括每个图层压缩后的通道图像数据，而解析图层信息
+只需要名称、位置、不透明度和混合模式。本模块只读取文件头和图层与蒙版信息段中的
+图层记录，记下每个通道数据在文件中的偏移和长度后直接跳过，几百MB的文件也只需读取
+几十KB。
+
+图层树的构建与 psd_tools 一致（图层组分隔记录、图层类名的判断、图层组范围由可见的
+非剪贴子图层合并得到），得到的对象提供 walk_psd 和 print_psd_info 用到的属性和方法:
+    psd = LazyPSD.open('design.psd')
+    for layer in psd.descendants():
+        print(layer.name, layer.bbox, layer.blend_mode)
+    image = layer.topil()   # 这时才读取并解压该图层的通道数据
+
+形状图层、画板等少数需要描述符的图层，只对其用到的附加信息块调用 psd_tools 解析。
+
+以“最大兼容”保存的文件在图层数据之后还保存了合并图像，save_merged_png() 按行带
+解压合并图像数据并流式写出PNG，无需渲染图层，也无需整幅图像驻留内存；
+read_merged_image() 读取同样的像素，用于写出其他格式。
+
+LazyPSD.open(path, use_mmap=True) 以只读方式映射整个文件，之后读取通道不再打开文件:
+未压缩的通道直接返回映射上的只读NumPy视图，不复制数据；RLE和ZIP压缩的通道在读取时
+解压到文档共用的缓冲区中，内存占用只与正在处理的图层有关，与文件大小无关。
+    with LazyPSD.open('design.psd', use_mmap=True) as psd:
+        alpha = layer.read_channel(-1)   # 下一次读取压缩通道时被覆盖，需要保留时传入 out
+"""
+
+import io
+import mmap
+import struct
+
+import numpy as np
+from PIL import Image, ImageCms
+from psd_tools.api import adjustments
+from psd_tools.api.shape import Origination, VectorMask
+from psd_tools.constants import BlendMode, ColorMode, Compression, SectionDivider, Tag
+from psd_tools.psd.tagged_blocks import TYPES as BLOCK_TYPES, TaggedBlock
+
+import psd_trace
+from psd_codec import decode_channel, decode_channels, decode_rle_rows
+from psd_stream import StreamingPNGWriter
+
+# 图层附加信息块的签名
+_BLOCK_SIGNATURES = (b'8BIM', b'8B64')
+
+# PSB文件中长度字段为8字节的附加信息块
+_BIG_KEYS = frozenset(key.value for key in TaggedBlock._BIG_KEYS)
+
+# 需要保留原始数据、按需交给 psd_tools 解析的附加信息块
+_KEPT_KEYS = frozenset(key.value for key in (
+    Tag.UNICODE_LAYER_NAME,
+    Tag.SECTION_DIVIDER_SETTING,
+    Tag.NESTED_SECTION_DIVIDER_SETTING,
+    Tag.VECTOR_MASK_SETTING1,
+    Tag.VECTOR_MASK_SETTING2,
+    Tag.VECTOR_ORIGINATION_DATA,
+    Tag.ARTBOARD_DATA1,
+    Tag.ARTBOARD_DATA2,
+    Tag.ARTBOARD_DATA3,
+))
+
+_TYPE_KEYS = (Tag.TYPE_TOOL_OBJECT_SETTING.value, Tag.TYPE_TOOL_INFO.value)
+_SMART_OBJECT_KEYS = (Tag.SMART_OBJECT_LAYER_DATA1.value, Tag.SMART_OBJECT_LAYER_DATA2.value,
+                      Tag.PLACED_LAYER1.value, Tag.PLACED_LAYER2.value)
+_SHAPE_KEYS = (Tag.VECTOR_ORIGINATION_DATA.value, Tag.VECTOR_MASK_SETTING1.value,
+               Tag.VECTOR_MASK_SETTING2.value, Tag.VECTOR_STROKE_DATA.value,
+               Tag.VECTOR_STROKE_CONTENT_DATA.value)
+_ARTBOARD_KEYS = (Tag.ARTBOARD_DATA1.value, Tag.ARTBOARD_DATA2.value, Tag.ARTBOARD_DATA3.value)
+_FILL_CLASSES = ('SolidColorFill', 'PatternFill', 'GradientFill')
+
+# 调整和填充图层的附加信息块与 psd_tools 类名的对应，保持 psd_tools 的判断顺序
+_ADJUSTMENT_CLASSES = [(key.value, cls.__name__) for key, cls in adjustments.TYPES.items()]
+
+# 合并图像的透明度信息块
+_MERGED_TRANSPARENCY_KEYS = (Tag.SAVING_MERGED_TRANSPARENCY.value, Tag.SAVING_MERGED_TRANSPARENCY16.value,
+                             Tag.SAVING_MERGED_TRANSPARENCY32.value)
+
+# 需要读取的图像资源：ICC配置文件、Alpha通道标识和版本信息（是否保存了合并图像）
+_RESOURCE_ICC_PROFILE = 1039
+_RESOURCE_ALPHA_IDENTIFIERS = 1053
+_RESOURCE_VERSION_INFO = 1057
+_KEPT_RESOURCES = (_RESOURCE_ICC_PROFILE, _RESOURCE_ALPHA_IDENTIFIERS, _RESOURCE_VERSION_INFO)
+_RESOURCE_SIGNATURES = (b'8BIM', b'MeSa', b'AgHg', b'PHUT', b'DCSR')
+
+# 流式写出合并图像时每段的行数
+MERGED_BAND_ROWS = 256
+
+# 通道ID：-1为透明度，-2和-3为图层蒙版
+_ALPHA_CHANNEL = -1
+
+# 各位深通道数据的NumPy类型
+_CHANNEL_DTYPES = {8: np.dtype(np.uint8), 16: np.dtype('>u2'), 32: np.dtype('>f4')}
+
+# 单个通道解压后达到该字节数时，topil() 用多个线程同时解压各通道
+_PARALLEL_CHANNEL_BYTES = 1 << 20
+
+# 支持 topil() 的颜色模式及其颜色通道数
+_PIL_MODES = {
+    ColorMode.RGB: ('RGB', 3),
+    ColorMode.GRAYSCALE: ('L', 1),
+}
+
+
+def _unpack(f, fmt):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("PSD文件不完整")
+    return struct.unpack(fmt, data)
+
+
+def _decode_block(key, raw, version):
+    """
+    用 psd_tools 解析一个附加信息块，返回值与 TaggedBlocks.get_data 相同，解析失败时返回None
+    """
+    kls = BLOCK_TYPES.get(Tag(key))
+    if kls is None:
+        return None
+    try:
+        data = kls.frombytes(raw, version=version)
+    except (OSError, ValueError):
+        return None
+    return getattr(data, 'value', data)
+
+
+class LazyLayer:
+    """
+    只含结构信息的图层或图层组，通道数据在调用 topil() 时才读取
+    """
+
+    def __init__(self, psd, record, parent, is_group=False):
+        self._psd = psd
+        self._record = record
+        self._bbox = None
+        self.parent = parent
+        self.class_name = 'Group' if is_group else 'PixelLayer'
+        if is_group:
+            self.layers = []
+
+    def _block(self, key):
+        raw = self._record['blocks'].get(key)
+        if raw is None:
+            return None
+        return _decode_block(key, raw, self._psd.version)
+
+    @property
+    def name(self):
+        name = self._block(Tag.UNICODE_LAYER_NAME.value)
+        return name if name is not None else self._record['name']
+
+    @property
+    def tagged_block_keys(self):
+        """
+        图层记录中所有附加信息块的键
+        """
+        return self._record['keys']
+
+    @property
+    def visible(self):
+        return self._record['visible']
+
+    def is_visible(self):
+        """
+        考虑父图层组可见性的可见性
+        """
+        if not self.visible:
+            return False
+        return self.parent.is_visible()
+
+    def is_group(self):
+        return self.class_name in ('Group', 'Artboard')
+
+    @property
+    def opacity(self):
+        return self._record['opacity']
+
+    @property
+    def clipping(self):
+        return self._record['clipping'] == 1
+
+    @property
+    def blend_mode(self):
+        if self.is_group():
+            # 图层组的混合模式（包括穿透）记录在分隔设置中
+            for key in (Tag.NESTED_SECTION_DIVIDER_SETTING.value, Tag.SECTION_DIVIDER_SETTING.value):
+                setting = self._block(key)
+                if setting is not None and setting.blend_mode is not None:
+                    return setting.blend_mode
+        return BlendMode(self._record['blend_mode'])
+
+    @property
+    def bbox(self):
+        """
+        (left, top, right, bottom)，与 psd_tools 的计算方式相同
+        """
+        if self._bbox is None:
+            self._bbox = self._compute_bbox()
+        return self._bbox
+
+    def _compute_bbox(self):
+        record = self._record
+        if self.class_name == 'Artboard':
+            bbox = self._artboard_bbox()
+            if bbox is not None:
+                return bbox
+        if self.is_group():
+            return extract_bbox(self.layers)
+        if self.class_name == 'ShapeLayer':
+            return self._shape_bbox()
+        right, bottom = record['right'], record['bottom']
+        if self.class_name in _FILL_CLASSES:
+            # 填充图层没有记录范围时覆盖整个画布
+            right = right or self._psd.width
+            bottom = bottom or self._psd.height
+        return record['left'], record['top'], right, bottom
+
+    def _artboard_bbox(self):
+        data = None
+        for key in _ARTBOARD_KEYS:
+            data = self._block(key) or data
+        rect = data.get(b'artboardRect') if data is not None else None
+        if rect is None:
+            return None
+        try:
+            return tuple(int(rect.get(key)) for key in (b'Left', b'Top ', b'Rght', b'Btom'))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def _shape_bbox(self):
+        record = self._record
+        if self.has_pixels():
+            return record['left'], record['top'], record['right'], record['bottom']
+
+        data = self._block(Tag.VECTOR_ORIGINATION_DATA.value)
+        if data is not None and not data.get(b'keyShapeInvalidated'):
+            origination = [Origination.create(item) for item in data.get(b'keyDescriptorList', [])]
+            if origination and not any(item.invalidated for item in origination) \
+                    and all(item._read_bbox() is not None for item in origination):
+                lefts, tops, rights, bottoms = zip(*[item.bbox for item in origination])
+                return int(min(lefts)), int(min(tops)), int(max(rights)), int(max(bottoms))
+
+        for key in (Tag.VECTOR_MASK_SETTING1.value, Tag.VECTOR_MASK_SETTING2.value):
+            data = self._block(key)
+            if data is not None:
+                # 矢量蒙版的范围为相对画布的比例
+                left, top, right, bottom = VectorMask(data).bbox
+                width, height = self._psd.width, self._psd.height
+                return (int(round(left * width)), int(round(top * height)),
+                        int(round(right * width)), int(round(bottom * height)))
+        return 0, 0, 0, 0
+
+    @property
+    def left(self):
+        return self.bbox[0]
+
+    @property
+    def top(self):
+        return self.bbox[1]
+
+    @property
+    def right(self):
+        return self.bbox[2]
+
+    @property
+    def bottom(self):
+        return self.bbox[3]
+
+    @property
+    def width(self):
+        return self.right - self.left
+
+    @property
+    def height(self):
+        return self.bottom - self.top
+
+    @property
+    def channels(self):
+        """
+        通道列表，每项为 (通道ID, 文件偏移, 长度)，长度包含2字节的压缩方式
+        """
+        return self._record['channels']
+
+    def has_pixels(self):
+        return any(channel_id >= 0 and length > 2 for channel_id, _, length in self._record['channels'])
+
+    @property
+    def clip_layers(self):
+        """
+        剪贴到本图层的图层：紧接在本图层之上的连续剪贴图层，与 psd_tools 相同
+        """
+        if self.clipping:
+            return []
+        siblings = self.parent.layers
+        clip_layers = []
+        for layer in siblings[siblings.index(self) + 1:]:
+            if not layer.clipping:
+                break
+            clip_layers.append(layer)
+        return clip_layers
+
+    def has_clip_layers(self, visible=False):
+        if visible:
+            return any(layer.is_visible() for layer in self.clip_layers)
+        return len(self.clip_layers) > 0
+
+    def __iter__(self):
+        return iter(getattr(self, 'layers', ()))
+
+    def __len__(self):
+        return len(getattr(self, 'layers', ()))
+
+    def __repr__(self):
+        return f"<{self.class_name} '{self.name}' {self.bbox}>"
+
+    def record_data(self):
+        """
+        图层记录在文件中的原始字节（图层组为组结束的记录），映射模式下为不复制的 memoryview
+        """
+        offset, length = self._record['span']
+        return self._psd.read_bytes(offset, length)
+
+    def channel_data(self, channel_id):
+        """
+        通道在文件中的原始数据，包含2字节的压缩方式；没有该通道时返回None
+        """
+        for cid, offset, length in self._record['channels']:
+            if cid == channel_id:
+                return self._psd.read_bytes(offset, length)
+        return None
+
+    def read_channel(self, channel_id, out=None):
+        """
+        读取并解压一个通道，返回 (height, width) 的NumPy数组，数据类型与文档位深对应
+
+        映射模式下未压缩的通道直接返回映射上的只读视图；压缩的通道解压到 out 中，
+        out 为None时解压到文档共用的缓冲区，下一次读取压缩通道时会被覆盖。
+
+        参数:
+            channel_id: 通道ID，0起为颜色通道，-1为透明度
+            out: 接收数据的C连续数组，形状为 (height, width)，类型与位深对应
+
+        返回:
+            通道数据，没有该通道时返回None
+        """
+        record = self._record
+        width, height = record['right'] - record['left'], record['bottom'] - record['top']
+        psd = self._psd
+        dtype = _CHANNEL_DTYPES.get(psd.depth)
+        if dtype is None:
+            raise ValueError(f"不支持读取位深为 {psd.depth} 的通道")
+        for cid, offset, length in record['channels']:
+            if cid == channel_id:
+                break
+        else:
+            return None
+
+        data = psd.read_bytes(offset, length)
+        compression = Compression(struct.unpack_from('>H', data)[0])
+        if compression == Compression.RAW and out is None and psd.is_mapped():
+            return np.frombuffer(psd._map, dtype=dtype, count=width * height,
+                                 offset=offset + 2).reshape(height, width)
+
+        if out is None:
+            out = psd._scratch((height, width), dtype)
+        return decode_channel(data[2:], compression, out, psd.depth, psd.version)
+
+    def _channel_job(self, channel_id, out):
+        """
+        返回 decode_channel 的参数，没有该通道时返回None
+        """
+        data = self.channel_data(channel_id)
+        if data is None:
+            return None
+        return data[2:], Compression(struct.unpack_from('>H', data)[0]), out, self._psd.depth, self._psd.version
+
+    def topil(self):
+        """
+        解压图层的颜色和透明度通道并返回PIL图像，不含蒙版和图层效果；没有像素时返回None
+
+        只支持RGB和灰度文档，8、16和32位数据都转换为8位。
+        """
+        record = self._record
+        if not self.has_pixels() or record['right'] <= record['left'] or record['bottom'] <= record['top']:
+            return None
+        color_mode = self._psd.color_mode
+        if color_mode not in _PIL_MODES:
+            raise ValueError(f"不支持解压颜色模式为 {color_mode} 的图层")
+        mode, color_count = _PIL_MODES[color_mode]
+
+        channel_ids = list(range(color_count))
+        if any(cid == _ALPHA_CHANNEL for cid, _, _ in record['channels']):
+            channel_ids.append(_ALPHA_CHANNEL)
+            mode += 'A'
+        shape = (record['bottom'] - record['top'], record['right'] - record['left'])
+
+        with psd_trace.span('layer_decode', layer=self.name):
+            # 每个通道解压到各自的数组，避免共用缓冲区被下一个通道覆盖；缺少的颜色通道以0填充
+            dtype = _CHANNEL_DTYPES[self._psd.depth]
+            planes = [np.zeros(shape, dtype) for _ in channel_ids]
+            jobs = [job for job in (self._channel_job(channel_id, plane)
+                                    for channel_id, plane in zip(channel_ids, planes)) if job is not None]
+            workers = 1 if shape[0] * shape[1] * dtype.itemsize < _PARALLEL_CHANNEL_BYTES else None
+            decode_channels(jobs, workers)
+            planes = [_to_uint8(plane) for plane in planes]
+        return Image.fromarray(np.dstack(planes) if len(planes) > 1 else planes[0], mode)
+
+
+def _to_uint8(plane):
+    if plane.dtype == np.uint8:
+        return plane
+    if plane.dtype.kind == 'f':
+        return (np.clip(plane, 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+    return (plane >> 8).astype(np.uint8)
+
+
+def _remove_white_matte(color, alpha):
+    """
+    合并图像以白色为背景保存半透明像素，按 psd_tools 的方式还原颜色: (x + a - 255) * 255 / a
+    """
+    x = color.astype(np.float32)
+    a = alpha[..., None].astype(np.float32)
+    restored = np.where(a > 0, (x + a - 255.0) * 255.0 / np.maximum(a, 1.0), x)
+    return np.clip(restored, 0, 255).astype(np.uint8)
+
+
+def extract_bbox(layers):
+    """
+    合并可见的非剪贴图层的范围，与 psd_tools 的 Group.extract_bbox 相同；没有范围时返回 (0, 0, 0, 0)
+    """
+    bboxes = []
+    for layer in layers:
+        if not layer.is_visible() or layer.clipping:
+            continue
+        bbox = extract_bbox(layer.layers) if layer.is_group() else layer.bbox
+        if bbox != (0, 0, 0, 0):
+            bboxes.append(bbox)
+    if not bboxes:
+        return 0, 0, 0, 0
+    lefts, tops, rights, bottoms = zip(*bboxes)
+    return min(lefts), min(tops), max(rights), max(bottoms)
+
+
+class LazyPSD:
+    """
+    只读取结构的PSD文档，用法与 PSDImage 的只读部分相同:
+        psd = LazyPSD.open(path)
+        psd.width, psd.height, psd.color_mode
+        for layer in psd: ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.layers = []
+        self._records = []
+        self.layer_count = None
+        self.resources = {}
+        self.global_keys = frozenset()
+        self.image_data_offset = None
+        self._map = None
+        self._buffer = None
+
+    @classmethod
+    def open(cls, path, use_mmap=False):
+        """
+        读取PSD文件的结构
+
+        参数:
+            path: PSD或PSB文件路径
+            use_mmap: 是否以只读方式映射文件，之后读取通道数据不再打开文件，未压缩的通道不复制
+        """
+        with psd_trace.span('open', file=path, mode='mmap' if use_mmap else 'structure'):
+            psd = cls(path)
+            with open(path, 'rb') as f:
+                if use_mmap:
+                    psd._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    psd._read(psd._map)
+                else:
+                    psd._read(f)
+            psd._build_tree()
+        return psd
+
+    def is_mapped(self):
+        return self._map is not None
+
+    def close(self):
+        """
+        关闭文件映射；仍有通道视图引用映射时留给垃圾回收关闭
+        """
+        if self._map is None:
+            return
+        try:
+            self._map.close()
+        except BufferError:
+            return
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_bytes(self, offset, length):
+        """
+        读取文件中的一段字节，映射模式下返回不复制的 memoryview
+        """
+        if self._map is not None:
+            return memoryview(self._map)[offset:offset + length]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def _scratch(self, shape, dtype):
+        """
+        返回文档共用的解压缓冲区上的数组，容量不足时按需扩大
+        """
+        size = int(np.prod(shape)) * dtype.itemsize
+        if self._buffer is None or self._buffer.size < size:
+            self._buffer = np.empty(size, dtype=np.uint8)
+        return self._buffer[:size].view(dtype).reshape(shape)
+
+    def is_visible(self):
+        return True
+
+    def is_group(self):
+        return True
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __len__(self):
+        return len(self.layers)
+
+    def descendants(self):
+        """
+        按先序遍历返回所有图层和图层组
+        """
+        stack = list(reversed(self.layers))
+        while stack:
+            layer = stack.pop()
+            yield layer
+            if layer.is_group():
+                stack.extend(reversed(layer.layers))
+
+    def has_preview(self):
+        """
+        文件是否保存了合并图像（版本信息资源中的 hasRealMergedData），没有版本信息时视为已保存
+        """
+        version_info = self.resources.get(_RESOURCE_VERSION_INFO)
+        if version_info and len(version_info) >= 5:
+            return bool(version_info[4])
+        return True
+
+    def transparency_index(self):
+        """
+        合并图像中透明度通道的索引，没有透明度时返回None，判断方式与 psd_tools 相同
+        """
+        expected = _PIL_MODES.get(self.color_mode, (None, None))[1]
+        has_transparency = any(key in self.global_keys for key in _MERGED_TRANSPARENCY_KEYS)
+        if not has_transparency and expected is not None and self.channel_count > expected:
+            alpha_ids = self._alpha_identifiers()
+            has_transparency = not (alpha_ids and all(x > 0 for x in alpha_ids)) \
+                and not (self.layer_count is not None and self.layer_count > 0)
+        if not has_transparency:
+            return None
+
+        # 图层数为负时第一个额外通道为透明度，否则按Alpha通道标识查找ID为0的通道
+        if self.layer_count is not None and self.layer_count < 0 and expected is not None \
+                and self.channel_count > expected:
+            return expected
+        alpha_ids = self._alpha_identifiers()
+        if 0 in alpha_ids:
+            return self.channel_count - len(alpha_ids) + alpha_ids.index(0)
+        return self.channel_count - 1
+
+    def _alpha_identifiers(self):
+        data = self.resources.get(_RESOURCE_ALPHA_IDENTIFIERS, b'')
+        return list(struct.unpack(f'>{len(data) // 4}I', data[:len(data) // 4 * 4]))
+
+    def merged_compression(self):
+        """
+        合并图像数据的压缩方式，没有合并图像数据时返回None
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.image_data_offset)
+            data = f.read(2)
+        if len(data) < 2:
+            return None
+        try:
+            return Compression(struct.unpack('>H', data)[0])
+        except ValueError:
+            return None
+
+    def iter_merged_bands(self, channel_indices, band_rows=MERGED_BAND_ROWS):
+        """
+        按行带读取并解压合并图像的指定通道，自上而下依次返回 hxWxN 的uint8数组
+
+        只支持8位的RAW和RLE数据（Photoshop保存合并图像时使用的方式），RLE数据按每行的
+        字节数定位，每段只读取和解压该段的行。
+
+        参数:
+            channel_indices: 通道索引列表，如 [0, 1, 2, 3]
+            band_rows: 每段的行数
+        """
+        if self.depth != 8:
+            raise ValueError(f"不支持位深为 {self.depth} 的合并图像")
+        width, height = self.width, self.height
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.image_data_offset)
+            compression = Compression(_unpack(f, '>H')[0])
+            data_offset = f.tell()
+
+            if compression == Compression.RAW:
+                def read_rows(channel, top, rows):
+                    f.seek(data_offset + (channel * height + top) * width)
+                    return np.frombuffer(f.read(rows * width), dtype=np.uint8).reshape(rows, width)
+            elif compression == Compression.RLE:
+                # 所有通道每一行压缩后的字节数，之后为依次存放的压缩行
+                counts = np.frombuffer(f.read(self.channel_count * height * (2 if self.version == 1 else 4)),
+                                       dtype='>u2' if self.version == 1 else '>u4')
+                starts = data_offset + counts.nbytes + np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+
+                # 各通道的行带解压到复用的缓冲区
+                planes = np.empty((len(channel_indices), band_rows, width), dtype=np.uint8)
+
+                def read_rows(channel, top, rows):
+                    first = channel * height + top
+                    f.seek(int(starts[first]))
+                    data = f.read(int(starts[first + rows] - starts[first]))
+                    out = planes[channel_indices.index(channel), :rows]
+                    decode_rle_rows(data, counts[first:first + rows], out)
+                    return out
+            else:
+                raise ValueError(f"不支持压缩方式为 {compression} 的合并图像")
+
+            for top in range(0, height, band_rows):
+                rows = min(band_rows, height - top)
+                yield np.dstack([read_rows(channel, top, rows) for channel in channel_indices])
+
+    def _can_read_merged(self):
+        return self.has_preview() and self.color_mode == ColorMode.RGB and self.depth == 8 \
+            and self.channel_count >= 3 and self.merged_compression() in (Compression.RAW, Compression.RLE)
+
+    def _iter_merged_pixels(self, band_rows, apply_icc):
+        """
+        按行带返回转换到sRGB、去除白色背景后的合并图像像素，hxWx3 或 hxWx4 的uint8数组
+        """
+        alpha_index = self.transparency_index()
+        channel_indices = [0, 1, 2] + ([alpha_index] if alpha_index is not None else [])
+
+        transform = None
+        icc_profile = self.resources.get(_RESOURCE_ICC_PROFILE) if apply_icc else None
+        if icc_profile:
+            try:
+                transform = ImageCms.buildTransform(ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                                                    ImageCms.createProfile('sRGB'), 'RGB', 'RGB')
+            except ImageCms.PyCMSError:
+                # 与 psd_tools 相同，配置文件无效时不转换
+                transform = None
+
+        for band in self.iter_merged_bands(channel_indices, band_rows):
+            color = band[..., :3]
+            if transform is not None:
+                color = np.asarray(ImageCms.applyTransform(Image.fromarray(np.ascontiguousarray(color), 'RGB'),
+                                                           transform))
+            if alpha_index is not None:
+                alpha = band[..., 3]
+                yield np.dstack([_remove_white_matte(color, alpha), alpha])
+            else:
+                yield color
+
+    def save_merged_png(self, path, band_rows=MERGED_BAND_ROWS, apply_icc=True, compress_level=6):
+        """
+        把文件中保存的合并图像流式写出为PNG，结果与 PSDImage.composite() 使用合并图像时相同
+
+        与 psd_tools 一样按ICC配置文件转换到sRGB，有透明度时去除白色背景。
+
+        参数:
+            path: 输出PNG路径
+            band_rows: 每段的行数
+            apply_icc: 是否应用文件中的ICC配置文件
+            compress_level: zlib压缩级别
+
+        返回:
+            是否已写出；没有合并图像、或颜色模式、位深和压缩方式不支持时返回False，由调用方渲染图层
+        """
+        if not self._can_read_merged():
+            return False
+
+        channels = 3 if self.transparency_index() is None else 4
+        with psd_trace.span('merged_decode', file=path), \
+                StreamingPNGWriter(path, self.width, self.height, compress_level, channels) as writer:
+            for band in self._iter_merged_pixels(band_rows, apply_icc):
+                writer.write_rows(band)
+        return True
+
+    def read_merged_image(self, band_rows=MERGED_BAND_ROWS, apply_icc=True):
+        """
+        读取文件中保存的合并图像，像素与 save_merged_png 写出的相同，供写出其他格式使用
+
+        返回:
+            RGB或RGBA模式的 PIL.Image；不支持时与 save_merged_png 一样返回None
+        """
+        if not self._can_read_merged():
+            return None
+        with psd_trace.span('merged_decode'):
+            return Image.fromarray(np.concatenate(list(self._iter_merged_pixels(band_rows, apply_icc))))
+
+    def _read(self, f):
+        signature, version = _unpack(f, '>4sH')
+        if signature != b'8BPS' or version not in (1, 2):
+            raise ValueError(f"不是PSD或PSB文件: {self.path}")
+        self.version = version
+        _, self.channel_count, self.height, self.width, self.depth, color_mode = _unpack(f, '>6sHIIHH')
+        self.color_mode = ColorMode(color_mode)
+        self._length_fmt = '>I' if version == 1 else '>Q'
+
+        # 跳过颜色模式数据，图像资源只保留合并图像用到的几项
+        length, = _unpack(f, '>I')
+        f.seek(length, 1)
+        length, = _unpack(f, '>I')
+        self._read_resources(f, f.tell() + length)
+
+        length, = _unpack(f, self._length_fmt)
+        section_end = f.tell() + length
+        # 合并图像数据紧接在图层与蒙版信息段之后
+        self.image_data_offset = section_end
+        if length == 0:
+            return
+
+        info_length, = _unpack(f, self._length_fmt)
+        info_end = f.tell() + info_length
+        if info_length:
+            self._read_layer_info(f)
+        f.seek(info_end)
+
+        # 全局图层蒙版信息
+        if f.tell() + 4 <= section_end:
+            marker = f.read(4)
+            if marker not in _BLOCK_SIGNATURES:
+                f.seek(struct.unpack('>I', marker)[0], 1)
+            else:
+                f.seek(-4, 1)
+
+        # 全局附加信息，16位和32位文档的图层记录保存在 Lr16/Lr32 块中
+        global_keys = []
+        while f.tell() + 12 <= section_end:
+            signature, key = _unpack(f, '>4s4s')
+            if signature not in _BLOCK_SIGNATURES:
+                break
+            global_keys.append(key)
+            fmt = '>Q' if version == 2 and key in _BIG_KEYS else '>I'
+            block_length, = _unpack(f, fmt)
+            block_end = f.tell() + block_length + (-block_length % 4)
+            if key in (Tag.LAYER_16.value, Tag.LAYER_32.value) and not self._records:
+                self._read_layer_info(f)
+            f.seek(block_end)
+        self.global_keys = frozenset(global_keys)
+
+    def _read_resources(self, f, end):
+        while f.tell() + 12 <= end:
+            signature, resource_id, name_length = _unpack(f, '>4sHB')
+            if signature not in _RESOURCE_SIGNATURES:
+                break
+            # 名称为Pascal字符串，连同长度字节补齐到偶数
+            f.seek(name_length + (1 + name_length) % 2, 1)
+            size, = _unpack(f, '>I')
+            if resource_id in _KEPT_RESOURCES:
+                self.resources[resource_id] = f.read(size)
+                f.seek(size % 2, 1)
+            else:
+                f.seek(size + size % 2, 1)
+        f.seek(end)
+
+    def _read_layer_info(self, f):
+        """
+        读取图层记录，记下每个通道数据的偏移后跳过通道数据
+        """
+        layer_count, = _unpack(f, '>h')
+        self.layer_count = layer_count
+        channel_fmt = '>hI' if self.version == 1 else '>hQ'
+        channel_size = struct.calcsize(channel_fmt)
+
+        records = []
+        for _ in range(abs(layer_count)):
+            start = f.tell()
+            top, left, bottom, right, channel_count = _unpack(f, '>4iH')
+            channel_data = f.read(channel_size * channel_count)
+            channels = [struct.unpack_from(channel_fmt, channel_data, i * channel_size)
+                        for i in range(channel_count)]
+            _, blend_mode, opacity, clipping, flags, _, extra_length = _unpack(f, '>4s4sBBBBI')
+            record = {
+                'top': top, 'left': left, 'bottom': bottom, 'right': right,
+                'channels': channels,
+                'blend_mode': blend_mode,
+                'opacity': opacity,
+                'clipping': clipping,
+                'visible': not flags & 2,
+                'pixel_data_irrelevant': bool(flags & 16)
+            }
+            self._read_extra(f.read(extra_length), record)
+            record['span'] = (start, f.tell() - start)
+            records.append(record)
+
+        # 通道数据按图层记录和通道的顺序依次存放
+        offset = f.tell()
+        for record in records:
+            located = []
+            for channel_id, length in record['channels']:
+                located.append((channel_id, offset, length))
+                offset += length
+            record['channels'] = located
+        f.seek(offset)
+        self._records = records
+
+    def _read_extra(self, data, record):
+        # 跳过蒙版数据和混合范围
+        position = 0
+        for _ in range(2):
+            length, = struct.unpack_from('>I', data, position)
+            position += 4 + length
+        name_length = data[position]
+        record['name'] = data[position + 1:position + 1 + name_length].decode('macroman', 'replace')
+        position += 1 + name_length
+        position += -position % 4
+
+        keys = []
+        blocks = {}
+        while position + 12 <= len(data):
+            signature, key = struct.unpack_from('>4s4s', data, position)
+            if signature not in _BLOCK_SIGNATURES:
+                break
+            position += 8
+            if self.version == 2 and key in _BIG_KEYS:
+                length, = struct.unpack_from('>Q', data, position)
+                position += 8
+            else:
+                length, = struct.unpack_from('>I', data, position)
+                position += 4
+            keys.append(key)
+            if key in _KEPT_KEYS:
+                blocks[key] = data[position:position + length]
+            position += length
+        record['keys'] = frozenset(keys)
+        record['blocks'] = blocks
+
+    def _divider_kind(self, record):
+        divider = None
+        for key in (Tag.SECTION_DIVIDER_SETTING.value, Tag.NESTED_SECTION_DIVIDER_SETTING.value):
+            raw = record['blocks'].get(key)
+            if raw is not None:
+                divider = _decode_block(key, raw, self.version)
+        return divider.kind if divider is not None else None
+
+    def _build_tree(self):
+        """
+        按 psd_tools 的规则由图层记录（自下而上）构建图层树
+        """
+        kinds = [self._divider_kind(record) for record in self._records]
+
+        # 不成对的分隔记录按普通图层处理
+        opened = []
+        unmatched = set()
+        for index, kind in enumerate(kinds):
+            if kind == SectionDivider.BOUNDING_SECTION_DIVIDER:
+                opened.append(index)
+            elif kind in (SectionDivider.OPEN_FOLDER, SectionDivider.CLOSED_FOLDER):
+                if opened:
+                    opened.pop()
+                else:
+                    unmatched.add(index)
+        unmatched.update(opened)
+
+        group_stack = [self]
+        for index, record in enumerate(self._records):
+            current = group_stack[-1]
+            kind = None if index in unmatched or kinds[index] == SectionDivider.OTHER else kinds[index]
+            if kind == SectionDivider.BOUNDING_SECTION_DIVIDER:
+                # 图层组的属性在组结束的记录中，先以分隔记录占位
+                group = LazyLayer(self, record, current, is_group=True)
+                current.layers.append(group)
+                group_stack.append(group)
+            elif kind in (SectionDivider.OPEN_FOLDER, SectionDivider.CLOSED_FOLDER):
+                group = group_stack.pop()
+                group._record = record
+                if any(key in record['keys'] for key in _ARTBOARD_KEYS):
+                    group.class_name = 'Artboard'
+            else:
+                layer = LazyLayer(self, record, current)
+                layer.class_name = self._layer_class_name(record)
+                current.layers.append(layer)
+
+    @staticmethod
+    def _layer_class_name(record):
+        keys = record['keys']
+        class_name = None
+        if any(key in keys for key in _TYPE_KEYS):
+            class_name = 'TypeLayer'
+        elif any(key in keys for key in _SMART_OBJECT_KEYS):
+            class_name = 'SmartObjectLayer'
+        else:
+            for key, name in _ADJUSTMENT_CLASSES:
+                if key in keys:
+                    class_name = name
+                    break
+
+        # 不属于以上类型或为填充图层时，按矢量数据判断是否为形状图层
+        is_shape = record['pixel_data_irrelevant'] and any(key in keys for key in _SHAPE_KEYS)
+        if (class_name is None or class_name in _FILL_CLASSES) and is_shape:
+            class_name = 'ShapeLayer'
+        return class_name or 'PixelLayer'
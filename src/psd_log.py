@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+日志输出
+
+解析、合成和HTML生成模块通过本模块取得以 'psd.' 开头的日志记录器，替代直接的 print:
+    from psd_log import get_logger
+    logger = get_logger('parser')
+    logger.debug("已保存图层元数据到: %s", path)
+
+级别约定:
+    DEBUG    每个图层、每个文件的进度（默认不输出）
+    INFO     每个阶段的结果，如保存了合成图像或图层清单
+    WARNING  可以继续处理的问题，如图层无法渲染
+    ERROR    导致本次处理失败的问题
+
+默认级别为INFO，按图层输出的消息使用DEBUG级别和 %s 形式的延迟格式化，
+未开启时 logger.debug() 在级别检查后立即返回，不做字符串格式化和终端输出。
+控制台输出写到当前的 sys.stdout（与之前的 print 相同，可以被 redirect_stdout 重定向）。
+
+环境变量:
+    PSD_LOG_LEVEL   日志级别：DEBUG、INFO、WARNING、ERROR，默认INFO
+    PSD_LOG_JSON    JSON Lines日志文件路径，每条日志写出一行JSON，包含时间、级别、模块、消息和附加字段
+
+附加字段通过 extra={'data': {...}} 传入，只写入JSON日志。
+"""
+
+import os
+import sys
+import json
+import logging
+
+# 所有模块日志记录器的父记录器
+ROOT_LOGGER_NAME = 'psd'
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """
+    写到当前 sys.stdout 的处理器，sys.stdout 被替换后仍然跟随
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """
+    每条日志格式化为一行JSON
+    """
+
+    def format(self, record):
+        item = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        data = getattr(record, 'data', None)
+        if data:
+            item.update(data)
+        if record.exc_info:
+            item['exception'] = self.formatException(record.exc_info)
+        return json.dumps(item, ensure_ascii=False, default=str)
+
+
+def get_logger(name):
+    """
+    返回模块的日志记录器，名称为 'psd.<name>'，如 'psd.parser'
+    """
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+
+
+def configure(level=None, json_path=None, console=True):
+    """
+    配置日志级别和输出，替换之前的配置
+
+    参数:
+        level: 日志级别名称或数值，为None时使用环境变量 PSD_LOG_LEVEL，默认INFO
+        json_path: JSON Lines日志文件路径，为None时使用环境变量 PSD_LOG_JSON，都没有时不写出
+        console: 是否输出到控制台
+    """
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+    level = level or os.environ.get('PSD_LOG_LEVEL', 'INFO')
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    # 不传给Python根记录器，避免使用本工具集的程序配置了日志时重复输出
+    root.propagate = False
+
+    if console:
+        handler = _StdoutHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        root.addHandler(handler)
+
+    json_path = json_path or os.environ.get('PSD_LOG_JSON')
+    if json_path:
+        handler = logging.FileHandler(json_path, encoding='utf-8')
+        handler.setFormatter(JSONLinesFormatter())
+        root.addHandler(handler)
+
+
+configure()
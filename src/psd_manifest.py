@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+图层清单
+
+save_layer_images 在输出目录中写出一个汇总所有图层元数据和图像位置的JSON文件，
+psd_composer 和HTML生成器一次读取即可，不必逐个目录查找和读取单个图层的JSON文件。
+
+清单结构:
+    version: 清单格式版本
+    root: PSD元数据，'image' 为合成图像文件
+    layers: 按先序遍历排列的图层条目（父图层组在子图层之前），每个条目为图层元数据加上
+        'image'（图像文件，没有图像时为None）、'dir'（图层目录）和
+        'info_path'（parse_psd 解析信息中的图层路径）。图像裁剪到不透明区域，元数据中的矩形为裁剪后的矩形，
+        完全透明的图层 'empty' 为True。生成图集后叶子图层还有 'atlas'（见 psd_atlas）
+    atlases: 图集列表，仅在生成图集后存在
+    image_format: 图层和合成图像的输出格式（见 psd_output），没有时为PNG
+所有文件路径都相对于输出目录，图层的父图层组目录即 os.path.dirname(entry['dir'])。
+"""
+
+import os
+import json
+
+import psd_trace
+from psd_log import get_logger
+from psd_output import DEFAULT_IMAGE_FORMAT
+
+logger = get_logger('manifest')
+
+# 图层清单文件名
+LAYER_MANIFEST_NAME = 'layers_manifest.json'
+
+# 图层清单格式版本
+LAYER_MANIFEST_VERSION = 1
+
+
+def write_layer_manifest(output_dir, root, layers, atlases=None, image_format=None):
+    """
+    写出图层清单
+
+    参数:
+        output_dir: 图层输出目录
+        root: PSD元数据条目
+        layers: 图层条目列表
+        atlases: 图集列表，为None时不写出
+        image_format: 图像的输出格式，为None时不写出
+    """
+    manifest = {
+        'version': LAYER_MANIFEST_VERSION,
+        'root': root,
+        'layers': layers
+    }
+    if atlases is not None:
+        manifest['atlases'] = atlases
+    if image_format is not None:
+        manifest['image_format'] = image_format
+    with psd_trace.span('json_write', file=LAYER_MANIFEST_NAME), \
+            open(os.path.join(output_dir, LAYER_MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    logger.info("已保存图层清单到: %s", LAYER_MANIFEST_NAME)
+
+
+def load_layer_manifest(layers_dir):
+    """
+    读取图层清单
+
+    参数:
+        layers_dir: 图层目录路径
+
+    返回:
+        图层清单字典；清单不存在或版本不兼容时返回None
+    """
+    manifest_path = os.path.join(layers_dir, LAYER_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    if manifest.get('version') != LAYER_MANIFEST_VERSION:
+        logger.warning("图层清单版本不兼容: %s，忽略清单", manifest.get('version'))
+        return None
+    return manifest
+
+
+def manifest_image_format(manifest):
+    """
+    图层清单中记录的图像输出格式，之前写出的清单没有记录时为PNG
+    """
+    return manifest.get('image_format', DEFAULT_IMAGE_FORMAT)
+
+
+def manifest_entries(manifest):
+    """
+    由图层清单得到解析信息中的图层路径到图层条目的映射
+
+    参数:
+        manifest: load_layer_manifest 读取的图层清单
+
+    返回:
+        {info_path: 图层条目} 字典
+    """
+    return {entry['info_path']: entry for entry in manifest['layers']}
+
+
+def manifest_sprites(manifest, prefix):
+    """
+    由图层清单得到解析信息中的图层路径到图集切片的映射
+
+    参数:
+        manifest: load_layer_manifest 读取的图层清单
+        prefix: 图集路径前缀，通常为HTML中引用的图层目录
+
+    返回:
+        {info_path: 切片} 字典，切片为图层条目的 'atlas' 加上图集路径 'sheet_image'；
+        清单中没有图集时返回空字典
+    """
+    atlases = manifest.get('atlases', [])
+    sprites = {}
+    for entry in manifest['layers']:
+        if 'atlas' in entry:
+            sprite = dict(entry['atlas'])
+            sprite['sheet_image'] = f"{prefix}/{atlases[sprite['sheet']]['image']}"
+            sprites[entry['info_path']] = sprite
+    return sprites
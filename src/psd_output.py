@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+图层图像的输出格式
+
+提取、合成和比较写出的图像默认为Pillow默认压缩级别的PNG。格式用字符串表示，
+冒号后可以附加级别:
+    png        PNG，压缩级别6（与之前的输出逐字节相同）
+    png:1      PNG，zlib压缩级别0-9，级别越低编码越快、文件越大
+    webp       无损WebP，webp:0 到 webp:6 为编码速度与压缩率的取舍（默认4）
+    qoi        QOI，编码和解码都比PNG快得多，文件比PNG大
+    npy        未压缩的 HxWx4 uint8 RGBA数组，供后续合成的中间结果使用，可以内存映射读取
+
+WebP以 exact 模式保存，完全透明的像素也保留原来的颜色，与PNG解码结果相同。
+浏览器不能直接显示QOI和npy，需要生成HTML或图集时使用png或webp。
+
+save_image() 按格式写出图像，open_image() 按扩展名选择解码方式，open_image_writer()
+按行带写出（PNG流式压缩，npy直接写入内存映射的文件）；ImageEncoder 在后台线程池中编码，zlib、libwebp在编码时释放GIL，调用方可以同时渲染下一个图层:
+    with ImageEncoder() as encoder:
+        for layer in layers:
+            encoder.submit(render(layer), path, 'png:1')
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import psd_trace
+from psd_log import get_logger
+from psd_stream import StreamingPNGWriter, StreamingTIFFWriter
+
+logger = get_logger('output')
+
+# 格式名称到文件扩展名
+IMAGE_FORMATS = {
+    'png': '.png',
+    'webp': '.webp',
+    'qoi': '.qoi',
+    'npy': '.npy'
+}
+
+# 默认输出格式
+DEFAULT_IMAGE_FORMAT = 'png'
+
+# 浏览器可以直接显示的格式
+BROWSER_IMAGE_FORMATS = ('png', 'webp')
+
+# 各格式可用的级别范围，None表示不支持级别
+_FORMAT_LEVELS = {
+    'png': range(0, 10),
+    'webp': range(0, 7),
+    'qoi': None,
+    'npy': None
+}
+
+# 无损WebP的默认编码方法（Pillow的默认值）
+_WEBP_DEFAULT_METHOD = 4
+
+
+def parse_image_format(image_format=None):
+    """
+    解析输出格式字符串
+
+    参数:
+        image_format: 格式字符串，如 'png'、'png:1'、'webp:6'，为None时使用默认格式
+
+    返回:
+        (名称, 级别)，没有指定级别时级别为None
+    """
+    name, _, level = (image_format or DEFAULT_IMAGE_FORMAT).lower().partition(':')
+    if name not in IMAGE_FORMATS:
+        raise ValueError(f"不支持的图像格式: {image_format}，可选 {', '.join(IMAGE_FORMATS)}")
+    if not level:
+        return name, None
+    levels = _FORMAT_LEVELS[name]
+    if levels is None or not level.isdigit() or int(level) not in levels:
+        raise ValueError(f"图像格式 {name} 不支持级别: {level}")
+    return name, int(level)
+
+
+def normalize_image_format(image_format=None):
+    """
+    返回规范化的格式字符串，用于记录到清单中和比较提取选项
+    """
+    name, level = parse_image_format(image_format)
+    return name if level is None else f"{name}:{level}"
+
+
+def image_extension(image_format=None):
+    """
+    返回格式对应的文件扩展名（包含点）
+    """
+    return IMAGE_FORMATS[parse_image_format(image_format)[0]]
+
+
+def format_for_path(path):
+    """
+    按扩展名推断输出格式，扩展名不在 IMAGE_FORMATS 中时返回None（交给Pillow按扩展名保存）
+    """
+    extension = os.path.splitext(path)[1].lower()
+    for name, format_extension in IMAGE_FORMATS.items():
+        if extension == format_extension:
+            return name
+    return None
+
+
+def save_image(image, path, image_format=None):
+    """
+    按输出格式写出图像
+
+    参数:
+        image: PIL.Image
+        path: 输出路径
+        image_format: 格式字符串，为None时按扩展名推断，无法推断时由Pillow按扩展名保存
+    """
+    if image_format is None:
+        image_format = format_for_path(path)
+        if image_format is None:
+            with psd_trace.span('png_encode', file=path):
+                image.save(path)
+            return
+
+    name, level = parse_image_format(image_format)
+    with psd_trace.span('png_encode', file=path, format=name):
+        if name == 'png':
+            if level is None:
+                image.save(path, format='PNG')
+            else:
+                image.save(path, format='PNG', compress_level=level)
+        elif name == 'npy':
+            if image.mode != 'RGBA':
+                image = image.convert('RGBA')
+            np.save(path, np.asarray(image))
+        else:
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            if name == 'webp':
+                image.save(path, format='WEBP', lossless=True, exact=True,
+                           method=_WEBP_DEFAULT_METHOD if level is None else level)
+            else:
+                image.save(path, format='QOI')
+
+
+def load_array(path):
+    """
+    读取npy格式的RGBA数组，以只读方式内存映射
+    """
+    array = np.load(path, mmap_mode='r')
+    if array.ndim != 3 or array.shape[2] != 4 or array.dtype != np.uint8:
+        raise ValueError(f"{path} 不是 HxWx4 的uint8 RGBA数组")
+    return array
+
+
+def open_image(path):
+    """
+    打开并解码图像，npy文件转换为RGBA图像，其他格式和文件对象交给Pillow
+
+    返回:
+        已解码的 PIL.Image
+    """
+    with psd_trace.span('png_decode', file=path):
+        if isinstance(path, str) and format_for_path(path) == 'npy':
+            return Image.fromarray(np.ascontiguousarray(load_array(path)))
+        image = Image.open(path)
+        image.load()
+    return image
+
+
+def find_image(directory, basename):
+    """
+    在目录中查找任意输出格式的同名图像，按 IMAGE_FORMATS 的顺序优先，找不到时返回None
+    """
+    for extension in IMAGE_FORMATS.values():
+        path = os.path.join(directory, f"{basename}{extension}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class ArrayImageWriter:
+    """
+    按行带写出不能流式编码的格式，接口与 psd_stream.StreamingPNGWriter 相同
+
+    npy格式直接写入内存映射的输出文件；WebP和QOI先把各行写入内存中的数组，
+    close() 时一次编码，需要整幅图像驻留内存。
+    """
+
+    def __init__(self, path, width, height, image_format):
+        self.path = path
+        self.image_format = image_format
+        self.rows_written = 0
+        if parse_image_format(image_format)[0] == 'npy':
+            self._array = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 4))
+        else:
+            self._array = np.empty((height, width, 4), dtype=np.uint8)
+
+    def write_rows(self, rows):
+        """
+        写入若干行像素，rows为 hxWx4 的uint8数组
+        """
+        if self.rows_written + rows.shape[0] > self._array.shape[0]:
+            raise ValueError("写入的行数超过图像高度")
+        self._array[self.rows_written:self.rows_written + rows.shape[0]] = rows
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        """
+        写出图像；npy格式时刷新内存映射
+        """
+        if self._array is None:
+            return
+        try:
+            if self.rows_written != self._array.shape[0]:
+                raise ValueError(f"只写入了 {self.rows_written}/{self._array.shape[0]} 行")
+            if isinstance(self._array, np.memmap):
+                self._array.flush()
+            else:
+                save_image(Image.fromarray(self._array), self.path, self.image_format)
+        finally:
+            self._array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def open_image_writer(path, width, height, image_format=None, rows_per_strip=256):
+    """
+    创建按行带写出RGBA图像的写出器
+
+    参数:
+        path: 输出路径
+        width, height: 图像尺寸
+        image_format: 格式字符串，为None时按扩展名推断：.tif/.tiff 写出未压缩TIFF，
+            IMAGE_FORMATS 中的扩展名写出对应格式，其他写出PNG
+        rows_per_strip: TIFF每个条带的行数
+    """
+    if image_format is None:
+        if path.lower().endswith(('.tif', '.tiff')):
+            return StreamingTIFFWriter(path, width, height, rows_per_strip)
+        image_format = format_for_path(path) or DEFAULT_IMAGE_FORMAT
+    name, level = parse_image_format(image_format)
+    if name == 'png':
+        return StreamingPNGWriter(path, width, height, 6 if level is None else level)
+    return ArrayImageWriter(path, width, height, image_format)
+
+
+class ImageEncoder:
+    """
+    在后台线程池中编码并写出图像
+
+    submit() 立即返回，编码与调用方的渲染同时进行；等待编码的图像数量限制为线程数的两倍，
+    超过时 submit() 阻塞，内存中驻留的图像数量有上限。编码失败不抛出异常，
+    由 close() 返回失败的文件，调用方据此修正元数据。
+
+    workers为0时不使用线程，submit() 直接在当前线程编码。
+    """
+
+    def __init__(self, workers=None):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.failed = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        if self.workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image_encode')
+            self._slots = threading.BoundedSemaphore(self.workers * 2)
+
+    def _encode(self, image, path, image_format):
+        try:
+            save_image(image, path, image_format)
+        except Exception as e:
+            logger.error("无法写出图像 %s: %s", path, e)
+            with self._lock:
+                self.failed[path] = str(e)
+
+    def _encode_async(self, image, path, image_format):
+        try:
+            self._encode(image, path, image_format)
+        finally:
+            self._slots.release()
+
+    def submit(self, image, path, image_format=None):
+        """
+        提交一个编码任务
+
+        参数:
+            image: PIL.Image，提交后调用方不应再修改
+            path: 输出路径
+            image_format: 格式字符串，与 save_image 相同
+        """
+        if self._executor is None:
+            self._encode(image, path, image_format)
+            return
+        self._slots.acquire()
+        self._executor.submit(self._encode_async, image, path, image_format)
+
+    def close(self):
+        """
+        等待所有编码完成
+
+        返回:
+            {路径: 错误信息}，编码失败的文件
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        return self.failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,290 +1,683 @@
 from psd_tools import PSDImage
 import os
 import json
+import struct
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import numpy as np
-import psd_tools.api.layers
 
-def parse_psd(psd_path):
-    """解析PSD文件，提取所有图层信息"""
-    # 打开PSD文件
-    psd = PSDImage.open(psd_path)
+import psd_lazy
+import psd_trace
+from psd_atlas import remove_atlas_files
+from psd_log import get_logger
+from psd_manifest import load_layer_manifest, write_layer_manifest
+from psd_output import (DEFAULT_IMAGE_FORMAT, ImageEncoder, image_extension, normalize_image_format,
+                        parse_image_format, save_image)
+
+logger = get_logger('parser')
+
+# 调整图层的类名关键字，用于统计调整图层数量
+ADJUSTMENT_TYPE_KEYWORDS = ['Adjustment', 'Hue', 'Brightness', 'Levels', 'Curves', 'Exposure', 'Vibrance', 'ColorBalance']
+
+def _layer_class_name(layer):
+    """图层的 psd_tools 类名，只解析结构得到的图层由 class_name 属性给出"""
+    return getattr(layer, 'class_name', None) or layer.__class__.__name__
+
+@psd_trace.traced('walk')
+def walk_psd(psd, psd_path):
+    """一次遍历PSD图层树，同时得到解析信息、提取任务和统计信息
     
-    # 获取基本信息
-    info = {
-        'name': os.path.basename(psd_path),
-        'width': psd.width,
-        'height': psd.height,
-        'layers': []
-    }
+    psd为已打开的PSDImage或 psd_lazy.LazyPSD，psd_path只用于记录文件名。返回的字典包含:
+        info: 与 parse_psd 相同结构的图层信息
+        tasks: 与 plan_layer_exports 相同的提取任务列表（先序遍历，父图层组在子图层之前）
+        records: 按先序遍历排列的图层记录，包含图层对象、深度和打印统计所需的属性
+        stats: 统计信息，见 _collect_stats
+    """
+    tasks = []
+    records = []
     
-    # 递归提取图层信息
-    def extract_layer_info(layers, parent_group=None, parent_path='', used_names=None):
+    def walk(layers, depth=0, info_parent_path='', info_used_names=None,
+             parent_path='', parent_dir='', index_path=(), used_names=None):
         layer_info_list = []
         
-        # 初始化已使用名称字典
-        if used_names is None:
-            used_names = {}
-        
         for i, layer in enumerate(layers):
-            # 构建图层路径
-            layer_name = layer.name
+            is_group = layer.is_group()
+            class_name = _layer_class_name(layer)
+            
+            # parse_psd 的图层路径和保存名称：使用原始图层名称
+            info_name = layer.name
+            if info_parent_path:
+                info_path = f"{info_parent_path}/{info_name}"
+            else:
+                info_path = info_name
+            
+            # 检查是否与父层同名，如果是则添加后缀
+            info_save_name = info_name
+            if info_parent_path:
+                parent_basename = info_parent_path.split('/')[-1] if '/' in info_parent_path else info_parent_path
+                if info_save_name == parent_basename:
+                    # 获取当前路径下已使用的后缀数
+                    names = info_used_names.setdefault(info_parent_path, {})
+                    names[info_save_name] = names.get(info_save_name, 0) + 1
+                    info_save_name = f"{info_name}_sub_{names[info_save_name]}"
+                    # 更新图层路径以包含后缀
+                    info_path = f"{info_parent_path}/{info_save_name}"
+            
+            # save_layer_images 的图层路径和保存名称：替换路径分隔符
+            layer_name = layer.name.replace('/', '_').replace('\\', '_')
             if parent_path:
                 layer_path = f"{parent_path}/{layer_name}"
             else:
                 layer_path = layer_name
-                
-            # 检查是否与父层同名，如果是则添加后缀
+            
+            # 检查是否与父目录同名，如果是则添加后缀
             save_name = layer_name
-            if parent_path:
-                parent_basename = parent_path.split('/')[-1] if '/' in parent_path else parent_path
-                if save_name == parent_basename:
-                    # 获取当前路径下已使用的后缀数
-                    parent_key = parent_path if parent_path else ''
-                    if parent_key not in used_names:
-                        used_names[parent_key] = {}
-                    
-                    if save_name not in used_names[parent_key]:
-                        used_names[parent_key][save_name] = 0
-                    
-                    suffix_num = used_names[parent_key][save_name] + 1
-                    used_names[parent_key][save_name] = suffix_num
-                    save_name = f"{layer_name}_sub_{suffix_num}"
-                    # 更新图层路径以包含后缀
-                    if parent_path:
-                        layer_path = f"{parent_path}/{save_name}"
-                    else:
-                        layer_path = save_name
-                
+            if parent_dir and save_name == os.path.basename(parent_dir):
+                names = used_names.setdefault(parent_dir, {})
+                names[save_name] = names.get(save_name, 0) + 1
+                save_name = f"{layer_name}_sub_{names[save_name]}"
+            
+            # 创建文件系统保存路径
+            if parent_dir:
+                save_dir = os.path.join(parent_dir, save_name)
+            else:
+                save_dir = save_name
+            
+            visible = layer.is_visible()
+            blend_mode = str(layer.blend_mode)
+            has_pixels = None
+            if hasattr(layer, 'has_pixels') and callable(layer.has_pixels):
+                has_pixels = layer.has_pixels()
+            
             layer_info = {
                 'name': layer.name,
-                'save_name': save_name,  # 添加保存名称，可能包含后缀
-                'visible': layer.is_visible(),
+                'save_name': info_save_name,  # 添加保存名称，可能包含后缀
+                'visible': visible,
                 'opacity': layer.opacity,
-                'blend_mode': str(layer.blend_mode),  # 将BlendMode转换为字符串
+                'blend_mode': blend_mode,  # 将BlendMode转换为字符串
                 'top': layer.top,
                 'left': layer.left,
                 'bottom': layer.bottom,
                 'right': layer.right,
                 'width': layer.width,
                 'height': layer.height,
-                'type': layer.__class__.__name__,
-                'path': layer_path,  # 添加图层路径，确保唯一标识
+                'type': class_name,
+                'path': info_path,  # 添加图层路径，确保唯一标识
                 'index': i  # 添加图层索引，用于保留原始图层顺序
             }
             
+            task = {
+                'index_path': index_path + (i,),
+                'layer_name': layer_name,
+                'layer_path': layer_path,
+                'info_path': info_path,
+                'save_name': save_name,
+                'save_dir': save_dir,
+                'is_group': is_group,
+                'index': i
+            }
+            tasks.append(task)
+            
+            records.append({
+                'layer': layer,
+                'depth': depth,
+                'is_group': is_group,
+                'class_name': class_name,
+                'visible': visible,
+                'has_pixels': has_pixels,
+                'blend_mode': blend_mode,
+                'info': layer_info,
+                'task': task
+            })
+            
             # 如果是图层组，递归处理子图层
-            if isinstance(layer, psd_tools.api.layers.Group):
+            if is_group:
                 layer_info['type'] = 'Group'
-                layer_info['children'] = extract_layer_info(layer, layer, layer_path, used_names)
+                layer_info['children'] = walk(layer, depth + 1, info_path, info_used_names,
+                                              layer_path, save_dir, index_path + (i,), used_names)
             
             layer_info_list.append(layer_info)
         
         return layer_info_list
     
-    # 提取所有图层信息
-    info['layers'] = extract_layer_info(psd, None, '', {})
+    info = {
+        'name': os.path.basename(psd_path),
+        'width': psd.width,
+        'height': psd.height,
+        'layers': walk(psd, 0, '', {}, '', '', (), {})
+    }
     
-    return info
+    return {
+        'info': info,
+        'tasks': tasks,
+        'records': records,
+        'stats': _collect_stats(records)
+    }
 
-def save_layer_images(psd_path, output_dir):
-    """将PSD文件的每个图层保存为单独的图片，包括图层组和子图层"""
-    # 确保输出目录存在
-    os.makedirs(output_dir, exist_ok=True)
+def _collect_stats(records):
+    """根据 walk_psd 的图层记录一次性计算所有统计信息"""
+    stats = {
+        'total_layers': len(records),
+        'visible_layers': 0,
+        'pixel_layers': 0,
+        'group_count': 0,
+        'adjustment_layer_count': 0,
+        'smart_object_count': 0,
+        'text_layer_count': 0,
+        'shape_layer_count': 0,
+        'depth_stats': {},
+        'layer_types': set(),
+        'blend_modes': set(),
+        'adjustment_layers': []
+    }
+    
+    for record in records:
+        class_name = record['class_name']
+        
+        stats['depth_stats'][record['depth']] = stats['depth_stats'].get(record['depth'], 0) + 1
+        stats['layer_types'].add(class_name)
+        stats['blend_modes'].add(record['blend_mode'])
+        
+        if record['visible']:
+            stats['visible_layers'] += 1
+        if record['has_pixels']:
+            stats['pixel_layers'] += 1
+        if record['is_group']:
+            stats['group_count'] += 1
+        if any(adj_type in class_name for adj_type in ADJUSTMENT_TYPE_KEYWORDS):
+            stats['adjustment_layer_count'] += 1
+        if class_name == 'SmartObjectLayer':
+            stats['smart_object_count'] += 1
+        elif class_name == 'TypeLayer':
+            stats['text_layer_count'] += 1
+        elif class_name == 'ShapeLayer':
+            stats['shape_layer_count'] += 1
+        
+        # 调整图层或无像素图层
+        if 'adjustment' in class_name.lower() or record['has_pixels'] is None or not record['has_pixels']:
+            stats['adjustment_layers'].append(record)
+    
+    stats['max_depth'] = max(stats['depth_stats'].keys()) if stats['depth_stats'] else 0
+    return stats
+
+
+def parse_psd(psd_path, structure_only=True):
+    """解析PSD文件，提取所有图层信息
     
+    structure_only为True时只读取图层记录、跳过通道图像数据（见 psd_lazy），
+    结果与完整打开PSD文件时相同；为False时使用 PSDImage.open 读入整个文件。
+    """
     # 打开PSD文件
-    psd = PSDImage.open(psd_path)
+    psd = open_psd_reader(psd_path) if structure_only else _open_psd(psd_path)
+    
+    return walk_psd(psd, psd_path)['info']
+
+def plan_layer_exports(psd):
+    """遍历图层树，预先确定每个图层和图层组的保存目录、保存名称和图层路径
+    
+    返回按先序遍历排列的任务列表，父图层组总在其子图层之前。每个任务的 'index_path'
+    为从根开始逐级的图层索引，用于在其他进程中重新定位同一个图层。
+    """
+    return walk_psd(psd, '')['tasks']
+
+
+# 增量提取的清单文件，保存在输出目录中，记录每个图层的内容哈希
+EXTRACT_MANIFEST_NAME = '.extract_manifest.json'
+
+# PSD文件头的字节数
+PSD_HEADER_SIZE = 26
+
+def compute_layer_hashes(psd_path, psd=None, walk=None):
+    """计算每个提取任务的内容哈希，以及整个PSD合成图像的哈希
+    
+    图层哈希覆盖图层记录（名称、位置、混合模式、标记块等属性）、所有通道的压缩数据、
+    继承自父图层组的可见性和输出路径；图层组还包含所有子图层的哈希，
+    被剪贴的基底图层包含其剪贴图层的哈希，因为它们都会影响 layer.composite() 的结果。
+    
+    哈希总是对 psd_lazy.LazyPSD 映射的文件内容计算，不读入通道数据。psd和walk为已打开的
+    LazyPSD 及其 walk_psd 遍历结果，未传入或psd为PSDImage时以映射模式打开psd_path并遍历。
+    
+    返回:
+        (layer_hashes, root_hash)，layer_hashes 以图层路径为键
+    
+    异常:
+        文件无法按结构解析时抛出 ValueError、IndexError 或 struct.error
+    """
+    if not isinstance(psd, psd_lazy.LazyPSD):
+        with psd_lazy.LazyPSD.open(psd_path, use_mmap=True) as lazy:
+            return compute_layer_hashes(psd_path, lazy, walk_psd(lazy, psd_path))
+    
+    layer_hashes = {}
+    hashes_by_layer = {}
+    
+    # 逆先序遍历，子图层和剪贴图层（位于基底图层之上）总在其父图层和基底图层之前计算
+    for record in reversed(walk['records']):
+        layer = record['layer']
+        task = record['task']
+        
+        digest = hashlib.sha1()
+        digest.update(json.dumps([task['save_dir'], task['layer_path'], task['index'], record['visible']],
+                                 ensure_ascii=False).encode('utf-8'))
+        for data in _layer_raw_data(layer):
+            digest.update(data)
+        if record['is_group']:
+            for child in layer:
+                digest.update(hashes_by_layer[id(child)].encode('ascii'))
+        for clip_layer in layer.clip_layers if layer.has_clip_layers() else []:
+            digest.update(hashes_by_layer[id(clip_layer)].encode('ascii'))
+        
+        hashes_by_layer[id(layer)] = digest.hexdigest()
+        layer_hashes[task['layer_path']] = hashes_by_layer[id(layer)]
+    
+    # 整个PSD的合成图像取决于文件头、合并图像数据和所有根图层
+    root_digest = hashlib.sha1()
+    for data in _root_raw_data(psd):
+        root_digest.update(data)
+    for layer in psd:
+        root_digest.update(hashes_by_layer[id(layer)].encode('ascii'))
+    
+    return layer_hashes, root_digest.hexdigest()
+
+def _layer_raw_data(layer):
+    """依次返回图层记录和各通道压缩数据（不含压缩方式）的原始字节"""
+    yield layer.record_data()
+    for channel_id, _, _ in layer.channels:
+        yield layer.channel_data(channel_id)[2:]
+
+def _root_raw_data(psd):
+    """依次返回文件头和合并图像压缩数据（不含压缩方式）的原始字节"""
+    yield psd.read_bytes(0, PSD_HEADER_SIZE)
+    offset = psd.image_data_offset + 2
+    yield psd.read_bytes(offset, max(os.path.getsize(psd.path) - offset, 0))
+
+def _extract_options(render_groups, write_layer_json, image_format):
+    """增量提取清单中记录的提取选项，选项改变时所有图层都需要重新提取"""
+    options = {'render_groups': render_groups, 'write_layer_json': write_layer_json}
+    # 默认格式不记录，之前写出的增量提取清单仍然有效
+    if image_format != DEFAULT_IMAGE_FORMAT:
+        options['image_format'] = image_format
+    return options
+
+def _task_files(task, options):
+    """提取任务写出的图像和JSON文件（相对于输出目录）"""
+    save_basename = os.path.basename(task['save_dir'])
+    files = []
+    if not task['is_group'] or options['render_groups']:
+        extension = image_extension(options.get('image_format'))
+        files.append(os.path.join(task['save_dir'], f"{save_basename}{extension}"))
+    if options['write_layer_json']:
+        files.append(os.path.join(task['save_dir'], f"{save_basename}.json"))
+    return files
+
+def _entry_files(entry, options):
+    """图层清单条目对应的实际写出的文件（相对于输出目录）"""
+    files = [entry['image']] if entry.get('image') else []
+    if options['write_layer_json']:
+        files.append(os.path.join(entry['dir'], f"{os.path.basename(entry['dir'])}.json"))
+    return files
+
+def _root_files(psd_path, image_format=None):
+    """整个PSD的合成图像和元数据文件（相对于输出目录）"""
+    psd_name = os.path.basename(psd_path).replace('.psd', '')
+    return [f"{psd_name}{image_extension(image_format)}", f"{psd_name}.json"]
+
+def _load_extract_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, EXTRACT_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("无法读取增量提取清单，将重新提取所有图层: %s", e)
+        return {}
+
+def _plan_incremental(psd, psd_path, output_dir, walk, options, old_entries, old_root_entry):
+    """对比增量提取清单，找出需要重新提取的任务和需要删除的过期文件
+    
+    old_entries和old_root_entry为上次写出的图层清单中的条目，跳过的图层沿用其中的元数据，
+    因此没有对应条目的图层也需要重新提取。
+    
+    返回:
+        (stale_tasks, export_root_needed, removed_files, manifest)，manifest为本次提取后的新清单，
+        无法计算哈希时为None
+    """
+    try:
+        layer_hashes, root_hash = compute_layer_hashes(psd_path, psd, walk)
+    except (ValueError, IndexError, struct.error) as e:
+        # 无法按结构解析的文件不能计算哈希，重新提取所有图层，也不写出新的增量提取清单
+        logger.warning("无法计算图层哈希，将重新提取所有图层: %s (%s)", psd_path, e)
+        layer_hashes, root_hash = None, None
+    old_manifest = _load_extract_manifest(output_dir)
+    
+    # 提取选项改变时，所有图层都需要重新提取
+    old_layers = old_manifest.get('layers', {}) if old_manifest.get('options') == options else {}
+    
+    def is_fresh(entry, digest, files, old_entry):
+        return (digest is not None and entry is not None and entry.get('hash') == digest and old_entry is not None and
+                all(os.path.exists(os.path.join(output_dir, file)) for file in files))
+    
+    stale_tasks = []
+    layers = {}
+    for task in walk['tasks']:
+        digest = layer_hashes[task['layer_path']] if layer_hashes is not None else None
+        files = _task_files(task, options)
+        old_entry = old_entries.get(task['save_dir'])
+        # 空图层没有图像，按上次实际写出的文件检查
+        expected_files = _entry_files(old_entry, options) if old_entry else files
+        if not is_fresh(old_layers.get(task['layer_path']), digest, expected_files, old_entry):
+            stale_tasks.append(task)
+        layers[task['layer_path']] = {'hash': digest, 'files': files}
+    
+    # 不再存在的图层删除其文件，提取选项改变后不再写出的文件同样删除
+    removed_files = []
+    for layer_path, entry in old_manifest.get('layers', {}).items():
+        new_files = layers[layer_path]['files'] if layer_path in layers else []
+        removed_files.extend(file for file in entry.get('files', []) if file not in new_files)
+    
+    root_files = _root_files(psd_path, options.get('image_format'))
+    removed_files.extend(file for file in old_manifest.get('root', {}).get('files', []) if file not in root_files)
+    old_root = old_manifest.get('root') if old_manifest.get('options') == options else None
+    export_root_needed = not is_fresh(old_root, root_hash, root_files, old_root_entry)
+    
+    manifest = {
+        'options': options,
+        'root': {'hash': root_hash, 'files': root_files},
+        'layers': layers
+    } if layer_hashes is not None else None
+    return stale_tasks, export_root_needed, removed_files, manifest
+
+def _remove_stale_files(output_dir, files, keep_dirs):
+    """删除过期的图层文件，并删除因此变空的图层目录"""
+    dirs = set()
+    for file in files:
+        path = os.path.join(output_dir, file)
+        if os.path.exists(path):
+            os.remove(path)
+            logger.debug("已删除过期文件: %s", file)
+        dirs.add(os.path.dirname(file))
+    
+    # 先删除较深的目录
+    for directory in sorted(dirs, key=lambda d: d.count(os.sep), reverse=True):
+        if directory and directory not in keep_dirs:
+            try:
+                os.rmdir(os.path.join(output_dir, directory))
+            except OSError:
+                pass
+
+def _find_layer(psd, index_path):
+    """根据逐级的图层索引定位图层"""
+    layer = psd
+    for i in index_path:
+        layer = layer[i]
+    return layer
+
+def _layer_metadata(layer, task, layer_type=None):
+    """提取图层或图层组的元数据，键的顺序与历史JSON文件保持一致"""
+    metadata = {
+        'name': layer.name,
+        'save_name': task['save_name'],  # 添加保存名称到元数据
+        'visible': layer.is_visible(),
+        'opacity': layer.opacity,
+        'blend_mode': str(layer.blend_mode),
+        'top': layer.top,
+        'left': layer.left,
+        'bottom': layer.bottom,
+        'right': layer.right,
+        'width': layer.width,
+        'height': layer.height,
+        'type': layer_type or layer.__class__.__name__,
+        'path': task['layer_path'],
+        'index': task['index']  # 添加图层索引，用于保留原始图层顺序
+    }
+    if task['is_group']:
+        # 图层组的JSON中子图层数量位于类型之后，保存名称位于最后
+        for key in ('save_name', 'path', 'index'):
+            del metadata[key]
+        metadata['type'] = 'Group'
+        metadata['children_count'] = len(list(layer))
+        metadata['path'] = task['layer_path']
+        metadata['index'] = task['index']
+        metadata['save_name'] = task['save_name']
+    return metadata
+
+def _remove_file(output_dir, file):
+    path = os.path.join(output_dir, file)
+    if os.path.exists(path):
+        os.remove(path)
+
+def _trim_layer_image(image, metadata):
+    """将渲染结果裁剪到不透明区域，并相应调整元数据中的位置和尺寸
+    
+    返回:
+        裁剪后的图像；图像完全透明时返回None，元数据标记为 'empty'
+    """
+    if 'A' in image.getbands():
+        bbox = image.getchannel('A').getbbox()
+    else:
+        # 没有透明通道的图像整体不透明
+        bbox = (0, 0, image.width, image.height) if image.width and image.height else None
+    
+    if bbox is None:
+        metadata['empty'] = True
+        return None
+    
+    if bbox != (0, 0, image.width, image.height):
+        image = image.crop(bbox)
+    
+    # 元数据记录裁剪后的图像在画布上的矩形
+    metadata['left'] += bbox[0]
+    metadata['top'] += bbox[1]
+    metadata['width'] = bbox[2] - bbox[0]
+    metadata['height'] = bbox[3] - bbox[1]
+    metadata['right'] = metadata['left'] + metadata['width']
+    metadata['bottom'] = metadata['top'] + metadata['height']
+    return image
+
+def _save_trimmed(image, output_dir, image_file, metadata, image_format=None, encoder=None):
+    """将渲染结果裁剪到不透明区域后保存，并相应调整元数据中的位置和尺寸
+    
+    完全透明的图像不保存（并删除上次留下的同名文件），元数据标记为 'empty'。
+    encoder为 psd_output.ImageEncoder 时在后台线程中编码，返回时文件可能尚未写完。
+    
+    返回:
+        保存的图像文件（相对于输出目录）；图像完全透明时返回None
+    """
+    image = _trim_layer_image(image, metadata)
+    if image is None:
+        _remove_file(output_dir, image_file)
+        return None
     
-    # 递归保存图层
-    def save_layers(layers, parent_path='', parent_dir='', used_names=None):
-        # 初始化已使用名称字典
-        if used_names is None:
-            used_names = {}
+    if encoder is not None:
+        encoder.submit(image, os.path.join(output_dir, image_file), image_format)
+    else:
+        save_image(image, os.path.join(output_dir, image_file), image_format)
+    return image_file
+
+def render_layer(layer, task, render_image=True):
+    """渲染单个图层或图层组但不写出文件，裁剪方式和元数据与 export_layer 相同
+    
+    参数:
+        layer: 图层或图层组
+        task: walk_psd 返回的提取任务
+        render_image: 是否渲染图像，为False时只提取元数据
+    
+    返回:
+        (image, metadata)，图像完全透明或未渲染时image为None
+    """
+    metadata = _layer_metadata(layer, task)
+    if not render_image:
+        return None, metadata
+    return _trim_layer_image(_composite_layer(layer, task), metadata), metadata
+
+def _composite_layer(layer, task):
+    with psd_trace.span('layer_composite', layer=task['info_path']):
+        return layer.composite()
+
+def _open_psd(psd_path):
+    with psd_trace.span('open', file=psd_path):
+        return PSDImage.open(psd_path)
+
+def open_psd_reader(psd_path):
+    """以映射模式打开PSD文件，只读取图层结构，通道数据按需从映射中读取
+    
+    无法按结构解析时回退到 PSDImage.open。返回的对象可以直接用于 walk_psd、
+    print_psd_info、compute_layer_hashes 和 export_psd_layers。
+    """
+    try:
+        return psd_lazy.LazyPSD.open(psd_path, use_mmap=True)
+    except (ValueError, IndexError, struct.error) as e:
+        logger.debug("按结构解析失败，读取整个文件: %s (%s)", psd_path, e)
+        return _open_psd(psd_path)
+
+def _full_psd(psd, psd_path):
+    """渲染图层需要 PSDImage，传入的是 psd_lazy.LazyPSD 时才读入整个文件"""
+    if isinstance(psd, psd_lazy.LazyPSD):
+        return _open_psd(psd_path)
+    return psd
+
+def _write_layer_json(output_dir, json_file, metadata):
+    with psd_trace.span('json_write', file=json_file), \
+            open(os.path.join(output_dir, json_file), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+def export_layer(layer, task, output_dir, render_groups=True, write_layer_json=True, image_format=None,
+                 encoder=None):
+    """渲染单个图层或图层组，保存其图像和JSON元数据
+    
+    图像裁剪到不透明区域，元数据中的 left/top/right/bottom/width/height 为裁剪后的矩形；
+    完全透明或无法渲染的图层不保存图像，元数据中标记 'empty'。
+    
+    task为 plan_layer_exports 返回的任务，串行和并行提取都通过本函数写出文件，保证输出一致。
+    write_layer_json为False时不再写出单个图层的JSON文件，元数据只记录在图层清单中。
+    image_format为 psd_output 的输出格式，encoder不为None时图像交给它在后台编码。
+    
+    返回:
+        图层清单条目，即元数据加上图像文件、图层目录和解析信息中的图层路径；无法生成元数据时返回None
+    """
+    layer_name = task['layer_name']
+    save_dir = task['save_dir']
+    save_basename = os.path.basename(save_dir)
+    image_file = os.path.join(save_dir, f"{save_basename}{image_extension(image_format)}")
+    json_file = os.path.join(save_dir, f"{save_basename}.json")
+    
+    # 为图层或图层组创建目录
+    os.makedirs(os.path.join(output_dir, save_dir), exist_ok=True)
+    
+    metadata = None
+    image = None
+    
+    # 如果是图层组，保存合成图像和元数据
+    if task['is_group']:
+        try:
+            metadata = _layer_metadata(layer, task)
+            if render_groups:
+                # 渲染图层组合成图像，裁剪到不透明区域后使用可能添加了后缀的名称保存
+                image = _save_trimmed(_composite_layer(layer, task), output_dir, image_file, metadata,
+                                      image_format, encoder)
+                if image:
+                    logger.debug("已保存图层组合成图像到: %s", image)
             
-        for i, layer in enumerate(layers):
-            # 创建图层保存路径
-            layer_name = layer.name.replace('/', '_').replace('\\', '_')
-            if parent_path:
-                layer_path = f"{parent_path}/{layer_name}"
-            else:
-                layer_path = layer_name
-                
-            # 检查是否与父层同名，如果是则添加后缀
-            save_name = layer_name
-            if parent_dir:
-                parent_basename = os.path.basename(parent_dir)
-                if save_name == parent_basename:
-                    # 获取当前路径下已使用的后缀数
-                    parent_key = parent_dir if parent_dir else ''
-                    if parent_key not in used_names:
-                        used_names[parent_key] = {}
-                    
-                    if save_name not in used_names[parent_key]:
-                        used_names[parent_key][save_name] = 0
-                    
-                    suffix_num = used_names[parent_key][save_name] + 1
-                    used_names[parent_key][save_name] = suffix_num
-                    save_name = f"{layer_name}_sub_{suffix_num}"
+            # 保存图层组元数据
+            if write_layer_json:
+                _write_layer_json(output_dir, json_file, metadata)
+                logger.debug("已保存图层组元数据到: %s", json_file)
             
-            # 创建文件系统保存路径
-            if parent_dir:
-                save_dir = os.path.join(parent_dir, save_name)
-            else:
-                save_dir = save_name
+            if not layer.is_visible():
+                logger.debug("已保存不可见图层组: %s", layer_name)
+        except Exception as e:
+            metadata = None
+            logger.warning("无法渲染图层组 %s: %s", layer_name, e, extra={'data': {'layer': task['info_path']}})
+    else:
+        # 非图层组，只处理最深层的图层
+        try:
+            # 尝试直接渲染图层，忽略可见性，裁剪到不透明区域后保存，保留透明度
+            metadata = _layer_metadata(layer, task)
+            image = _save_trimmed(_composite_layer(layer, task), output_dir, image_file, metadata,
+                                  image_format, encoder)
+            if not image:
+                logger.debug("图层 %s 完全透明，不保存图像", layer_name)
             
-            # 检查是否是图层组
-            is_group = isinstance(layer, psd_tools.api.layers.Group)
+            # 保存图层元数据
+            if write_layer_json:
+                _write_layer_json(output_dir, json_file, metadata)
+                logger.debug("已保存图层元数据到: %s", json_file)
             
-            # 如果是图层组，创建目录并保存合成图像和元数据
-            if is_group:
-                # 为图层组创建目录
-                group_dir = os.path.join(output_dir, save_dir)
-                os.makedirs(group_dir, exist_ok=True)
-                
-                try:
-                    # 渲染图层组合成图像
-                    layer_image = layer.composite()
-                    
-                    # 保存合成图像到图层组目录，使用可能添加了后缀的名称
-                    save_basename = os.path.basename(save_dir)
-                    composite_path = os.path.join(group_dir, f"{save_basename}.png")
-                    layer_image.save(composite_path)
-                    print(f"已保存图层组合成图像到: {save_dir}/{save_basename}.png")
-                    
-                    # 提取并保存图层组元数据
-                    metadata = {
-                        'name': layer.name,
-                        'visible': layer.is_visible(),
-                        'opacity': layer.opacity,
-                        'blend_mode': str(layer.blend_mode),
-                        'top': layer.top,
-                        'left': layer.left,
-                        'bottom': layer.bottom,
-                        'right': layer.right,
-                        'width': layer.width,
-                        'height': layer.height,
-                        'type': 'Group',
-                        'children_count': len(list(layer)),
-                        'path': layer_path,
-                        'index': i  # 添加图层索引，用于保留原始图层顺序
-                    }
-                    
-                    # 保存元数据到JSON文件，使用可能添加了后缀的名称
-                    save_basename = os.path.basename(save_dir)
-                    metadata['save_name'] = save_basename  # 添加保存名称到元数据
-                    metadata_path = os.path.join(group_dir, f"{save_basename}.json")
-                    with open(metadata_path, 'w', encoding='utf-8') as f:
-                        json.dump(metadata, f, ensure_ascii=False, indent=2)
-                    print(f"已保存图层组元数据到: {save_dir}/{save_basename}.json")
-                    
-                    if not layer.is_visible():
-                        print(f"已保存不可见图层组: {layer_name}")
-                except Exception as e:
-                    print(f"无法渲染图层组 {layer_name}: {e}")
-                    
-                # 递归处理子图层
-                save_layers(layer, layer_path, save_dir, used_names)
-            else:
-                # 非图层组，只处理最深层的图层
-                # 为非图层组创建目录
-                layer_dir = os.path.join(output_dir, save_dir)
-                os.makedirs(layer_dir, exist_ok=True)
+            if not layer.is_visible():
+                logger.debug("已保存不可见图层: %s", layer_name)
+        except Exception as e:
+            # 如果无法渲染，不保存图像，将图层标记为空并记录渲染错误信息
+            try:
+                layer_type = layer.__class__.__name__
+                metadata = _layer_metadata(layer, task, layer_type)
+                metadata['empty'] = True
+                metadata['render_error'] = str(e)
+                _remove_file(output_dir, image_file)
+                image = None
+                if write_layer_json:
+                    _write_layer_json(output_dir, json_file, metadata)
+                    logger.debug("已保存无法渲染图层的元数据到: %s", json_file)
                 
-                try:
-                    # 尝试直接渲染图层，忽略可见性
-                    layer_image = layer.composite()
-                    
-                    # 保存为PNG，保留透明度
-                    save_basename = os.path.basename(save_dir)
-                    image_path = os.path.join(layer_dir, f"{save_basename}.png")
-                    layer_image.save(image_path)
-                    
-                    # 保存图层元数据
-                    metadata = {
-                        'name': layer.name,
-                        'save_name': save_name,  # 添加保存名称到元数据
-                        'visible': layer.is_visible(),
-                        'opacity': layer.opacity,
-                        'blend_mode': str(layer.blend_mode),
-                        'top': layer.top,
-                        'left': layer.left,
-                        'bottom': layer.bottom,
-                        'right': layer.right,
-                        'width': layer.width,
-                        'height': layer.height,
-                        'type': layer.__class__.__name__,
-                        'path': layer_path,
-                        'index': i
-                    }
-                    
-                    # 保存元数据到JSON文件
-                    metadata_path = os.path.join(layer_dir, f"{save_basename}.json")
-                    with open(metadata_path, 'w', encoding='utf-8') as f:
-                        json.dump(metadata, f, ensure_ascii=False, indent=2)
-                    print(f"已保存图层元数据到: {save_dir}/{save_basename}.json")
-                    
-                    if not layer.is_visible():
-                        print(f"已保存不可见图层: {layer_name}")
-                except Exception as e:
-                    # 如果无法渲染，创建一个空白图像，标记图层类型
-                    try:
-                        # 创建一个带有图层信息的空白图像
-                        width = max(1, layer.width)
-                        height = max(1, layer.height)
-                        empty_image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-                        
-                        # 添加图层类型文本
-                        layer_type = layer.__class__.__name__
-                        
-                        # 确保图层目录存在
-                        layer_dir = os.path.join(output_dir, save_dir)
-                        os.makedirs(layer_dir, exist_ok=True)
-                        
-                        # 保存空白图像
-                        save_basename = os.path.basename(save_dir)
-                        image_path = os.path.join(layer_dir, f"{save_basename}.png")
-                        empty_image.save(image_path)
-                        
-                        # 保存图层元数据
-                        metadata = {
-                            'name': layer.name,
-                            'save_name': save_name,  # 添加保存名称到元数据
-                            'visible': layer.is_visible(),
-                            'opacity': layer.opacity,
-                            'blend_mode': str(layer.blend_mode),
-                            'top': layer.top,
-                            'left': layer.left,
-                            'bottom': layer.bottom,
-                            'right': layer.right,
-                            'width': layer.width,
-                            'height': layer.height,
-                            'type': layer_type,
-                            'path': layer_path,
-                            'index': i,
-                            'render_error': str(e)  # 记录渲染错误信息
-                        }
-                        
-                        # 保存元数据到JSON文件
-                        save_basename = os.path.basename(save_dir)
-                        metadata_path = os.path.join(layer_dir, f"{save_basename}.json")
-                        with open(metadata_path, 'w', encoding='utf-8') as f:
-                            json.dump(metadata, f, ensure_ascii=False, indent=2)
-                        print(f"已保存无法渲染图层的元数据到: {save_dir}/{save_basename}.json")
-                        
-                        print(f"已创建空白图像代替无法渲染的图层 {layer_name} (类型: {layer_type}): {e}")
-                    except Exception as inner_e:
-                        print(f"无法为图层 {layer_name} 创建空白图像: {inner_e}")
-    
-    # 保存所有图层
-    save_layers(psd, '', '', {})
-    
-    # 保存整个PSD的合成图像和元数据
+                logger.warning("无法渲染图层 %s (类型: %s)，标记为空图层: %s", layer_name, layer_type, e,
+                               extra={'data': {'layer': task['info_path']}})
+            except Exception as inner_e:
+                metadata = None
+                logger.error("无法保存图层 %s 的元数据: %s", layer_name, inner_e,
+                             extra={'data': {'layer': task['info_path']}})
+    
+    if metadata is None:
+        return None
+    
+    entry = dict(metadata)
+    entry['image'] = image
+    entry['dir'] = save_dir
+    entry['info_path'] = task['info_path']
+    return entry
+
+def _save_merged_image(psd, psd_path, output_path, image_format=None):
+    """把PSD文件中保存的合并图像直接解压并写出，PNG格式时流式写出
+    
+    psd为 psd_lazy.LazyPSD 时直接使用，否则按路径重新读取文件结构。
+    返回是否已写出；文件没有保存合并图像（未开启“最大兼容”）或格式不支持时返回False。
+    """
+    name, level = parse_image_format(image_format)
+    try:
+        reader = psd if isinstance(psd, psd_lazy.LazyPSD) else psd_lazy.LazyPSD.open(psd_path)
+        if name == 'png':
+            return reader.save_merged_png(output_path, compress_level=6 if level is None else level)
+        image = reader.read_merged_image()
+        if image is None:
+            return False
+        save_image(image, output_path, image_format)
+        return True
+    except (ValueError, IndexError, struct.error) as e:
+        logger.debug("无法读取合并图像，改为渲染图层: %s (%s)", psd_path, e)
+        return False
+
+def export_root(psd, psd_path, output_dir, stats=None, image_format=None):
+    """保存整个PSD的合成图像和元数据
+    
+    合成图像优先使用文件中保存的合并图像，没有时才渲染所有图层（psd为 psd_lazy.LazyPSD
+    时这时才读入整个文件）。stats为 walk_psd 返回的统计信息，为None时重新遍历图层树计算。
+    image_format为 psd_output 的输出格式。
+    
+    返回:
+        图层清单中的根条目，即PSD元数据加上合成图像文件；保存失败时返回None
+    """
+    if stats is None:
+        stats = walk_psd(psd, psd_path)['stats']
+    
     try:
-        composite = psd.composite()
         psd_name = os.path.basename(psd_path).replace('.psd', '')
-        composite_path = os.path.join(output_dir, f"{psd_name}.png")
-        composite.save(composite_path)
-        print(f"已保存PSD合成图像到: {psd_name}.png")
+        image_file = f"{psd_name}{image_extension(image_format)}"
+        composite_path = os.path.join(output_dir, image_file)
+        if not _save_merged_image(psd, psd_path, composite_path, image_format):
+            # 文件中没有可用的合并图像，渲染所有图层
+            with psd_trace.span('layer_composite', layer=''):
+                composite = _full_psd(psd, psd_path).composite()
+            save_image(composite, composite_path, image_format)
+        logger.info("已保存PSD合成图像到: %s", image_file)
         
         # 保存整个PSD的元数据
         root_metadata = {
@@ -292,22 +685,204 @@ def save_layer_images(psd_path, output_dir):
             'width': psd.width,
             'height': psd.height,
             'color_mode': str(psd.color_mode),
-            'layer_count': len(list(psd.descendants())),
-            'visible_layer_count': len([l for l in psd.descendants() if l.is_visible()]),
-            'group_count': len([l for l in psd.descendants() if isinstance(l, psd_tools.api.layers.Group)])
+            'layer_count': stats['total_layers'],
+            'visible_layer_count': stats['visible_layers'],
+            'group_count': stats['group_count']
         }
         
         metadata_path = os.path.join(output_dir, f"{psd_name}.json")
-        with open(metadata_path, 'w', encoding='utf-8') as f:
+        with psd_trace.span('json_write', file=f"{psd_name}.json"), open(metadata_path, 'w', encoding='utf-8') as f:
             json.dump(root_metadata, f, ensure_ascii=False, indent=2)
-        print(f"已保存PSD元数据到: {psd_name}.json")
+        logger.info("已保存PSD元数据到: %s.json", psd_name)
     except Exception as e:
-        print(f"无法保存PSD合成图像或元数据: {e}")
+        logger.error("无法保存PSD合成图像或元数据: %s", e)
+        return None
+    
+    entry = dict(root_metadata)
+    entry['image'] = image_file
+    return entry
+
+# 并行提取时每个工作进程各自打开一次PSD文件
+_worker_psd = None
+_worker_psd_path = None
+
+def _init_export_worker(psd_path, trace=False):
+    global _worker_psd, _worker_psd_path
+    # 以fork方式启动的工作进程会继承主进程已记录的区间
+    psd_trace.reset()
+    if trace:
+        psd_trace.enable()
+    _worker_psd = _open_psd(psd_path)
+    _worker_psd_path = psd_path
+
+def _run_export_task(task, output_dir, render_groups, write_layer_json, root_stats, image_format):
+    """在工作进程中执行一个提取任务，返回 (条目, 本任务记录的区间)"""
+    if task is None:
+        entry = export_root(_worker_psd, _worker_psd_path, output_dir, root_stats, image_format)
+    else:
+        entry = export_layer(_find_layer(_worker_psd, task['index_path']), task, output_dir,
+                             render_groups, write_layer_json, image_format)
+    return entry, psd_trace.drain()
+
+def save_layer_images(psd_path, output_dir, render_groups=True, workers=1, incremental=False,
+                      write_layer_json=True, image_format=DEFAULT_IMAGE_FORMAT):
+    """将PSD文件的每个图层保存为单独的图片，包括图层组和子图层
+    
+    所有图层的元数据和图像位置同时汇总到输出目录中的图层清单（见 psd_manifest），
+    write_layer_json为False时不再写出单个图层的JSON文件。
+    
+    render_groups为False时不再调用 layer.composite() 渲染图层组合成图像，只保存图层组元数据，
+    之后可以使用 psd_composer.py compose --recursive 从叶子图层重新合成。
+    
+    workers大于1时，先串行规划所有输出路径，再把图层渲染和图像编码分发到进程池，
+    输出文件与串行提取完全相同。串行提取时图像在后台线程中编码，与下一个图层的渲染同时进行。
+    
+    image_format为图像的输出格式（见 psd_output），如 'png:1'、'webp'、'qoi' 或 'npy'，
+    记录在图层清单的 'image_format' 中。
+    
+    incremental为True时，根据输出目录中的清单跳过内容未变化的图层，只重写或删除过期的文件。
+    
+    PSD文件以映射模式打开，遍历和增量哈希不读入通道数据，需要渲染图层时才读入整个文件。
+    """
+    # 打开PSD文件
+    psd = open_psd_reader(psd_path)
+    
+    export_psd_layers(psd, psd_path, output_dir, walk_psd(psd, psd_path), render_groups, workers,
+                      incremental, write_layer_json, image_format)
+
+def _mark_encode_failures(output_dir, entries, failed, write_layer_json):
+    """后台编码失败的图层与无法渲染的图层一样标记为空，并重写其JSON文件
+    
+    返回:
+        编码失败的图层目录集合
+    """
+    failed_dirs = set()
+    for entry in entries:
+        if entry is None or not entry.get('image'):
+            continue
+        error = failed.get(os.path.join(output_dir, entry['image']))
+        if error is None:
+            continue
+        _remove_file(output_dir, entry['image'])
+        entry['image'] = None
+        entry['empty'] = True
+        entry['render_error'] = error
+        failed_dirs.add(entry['dir'])
+        if write_layer_json:
+            metadata = {key: value for key, value in entry.items() if key not in ('image', 'dir', 'info_path')}
+            _write_layer_json(output_dir, os.path.join(entry['dir'], f"{os.path.basename(entry['dir'])}.json"),
+                              metadata)
+    return failed_dirs
+
+def export_psd_layers(psd, psd_path, output_dir, walk, render_groups=True, workers=1, incremental=False,
+                      write_layer_json=True, image_format=DEFAULT_IMAGE_FORMAT):
+    """根据 walk_psd 的遍历结果保存所有图层、图层组、整个PSD的合成图像和元数据以及图层清单
+    
+    psd可以是PSDImage或 open_psd_reader 返回的 psd_lazy.LazyPSD；后者只在串行提取有图层
+    需要渲染时才读入整个文件，并行提取时由各工作进程自行打开。
+    """
+    # 确保输出目录存在
+    os.makedirs(output_dir, exist_ok=True)
+    image_format = normalize_image_format(image_format)
+    
+    tasks = walk['tasks']
+    export_root_needed = True
+    extract_manifest = None
+    old_entries = {}
+    old_root_entry = None
+    if incremental:
+        old_layer_manifest = load_layer_manifest(output_dir) or {}
+        old_entries = {entry['dir']: entry for entry in old_layer_manifest.get('layers', [])}
+        old_root_entry = old_layer_manifest.get('root')
+        
+        options = _extract_options(render_groups, write_layer_json, image_format)
+        stale_tasks, export_root_needed, removed_files, extract_manifest = _plan_incremental(
+            psd, psd_path, output_dir, walk, options, old_entries, old_root_entry)
+        _remove_stale_files(output_dir, removed_files, {task['save_dir'] for task in tasks})
+        logger.info("增量提取: %d/%d 个图层需要重新提取，删除 %d 个过期文件",
+                    len(stale_tasks), len(tasks), len(removed_files))
+        tasks = stale_tasks
+    
+    # 按规划好的保存路径预先创建目录
+    for task in tasks:
+        os.makedirs(os.path.join(output_dir, task['save_dir']), exist_ok=True)
+    
+    # 根元数据只需要计数，避免把图层对象传给工作进程
+    stats = walk['stats']
+    root_stats = {key: stats[key] for key in ('total_layers', 'visible_layers', 'group_count')}
+    
+    if workers > 1:
+        # 整个PSD的合成图像通常最耗时，最先提交以便与图层渲染重叠
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_export_worker,
+                                 initargs=(psd_path, psd_trace.is_enabled())) as executor:
+            root_future = None
+            if export_root_needed:
+                root_future = executor.submit(_run_export_task, None, output_dir, render_groups,
+                                              write_layer_json, root_stats, image_format)
+            futures = [executor.submit(_run_export_task, task, output_dir, render_groups,
+                                       write_layer_json, root_stats, image_format)
+                       for task in tasks]
+            entries = []
+            for future in futures:
+                entry, spans = future.result()
+                entries.append(entry)
+                psd_trace.merge(spans)
+            failed_dirs = set()
+            root_entry = old_root_entry
+            if root_future:
+                root_entry, spans = root_future.result()
+                psd_trace.merge(spans)
+    else:
+        # 保存所有图层，图层在两种图层树中的逐级索引相同；图像在后台线程中编码，
+        # 与下一个图层的渲染同时进行
+        render_psd = _full_psd(psd, psd_path) if tasks else psd
+        encoder = ImageEncoder()
+        try:
+            entries = [export_layer(_find_layer(render_psd, task['index_path']), task, output_dir,
+                                    render_groups, write_layer_json, image_format, encoder)
+                       for task in tasks]
+            
+            # 保存整个PSD的合成图像和元数据
+            root_entry = export_root(render_psd, psd_path, output_dir, root_stats, image_format) \
+                if export_root_needed else old_root_entry
+        finally:
+            failed = encoder.close()
+        failed_dirs = _mark_encode_failures(output_dir, entries, failed, write_layer_json)
+    
+    # 汇总图层清单，跳过的图层沿用上次的条目
+    exported = {id(task): entry for task, entry in zip(tasks, entries)}
+    layer_entries = []
+    for task in walk['tasks']:
+        entry = exported[id(task)] if id(task) in exported else old_entries.get(task['save_dir'])
+        if entry is not None:
+            # 新的清单不记录图集，旧的图集矩形和图集文件已经过期
+            entry.pop('atlas', None)
+            layer_entries.append(entry)
+    write_layer_manifest(output_dir, root_entry, layer_entries, image_format=image_format)
+    if remove_atlas_files(output_dir):
+        logger.info("已删除过期的图集，需要时重新运行 psd_atlas.py 生成")
+    
+    # 所有文件写完后再更新增量提取清单，中途失败时下次会重新提取
+    if extract_manifest is not None:
+        # 图像编码失败的图层不记录，下次重新提取
+        for task in tasks:
+            if task['save_dir'] in failed_dirs:
+                del extract_manifest['layers'][task['layer_path']]
+        with open(os.path.join(output_dir, EXTRACT_MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(extract_manifest, f, ensure_ascii=False, indent=2)
 
-def print_psd_info(psd_path):
-    """打印PSD文件的详细信息，包括所有图层的结构和属性"""
+def print_psd_info(psd_path, psd=None, walk=None):
+    """打印PSD文件的详细信息，包括所有图层的结构和属性
+    
+    psd和walk为已打开的PSD（PSDImage或 psd_lazy.LazyPSD）及其 walk_psd 遍历结果，传入时
+    不再重复打开和遍历；未传入时只读取图层结构，不读取通道图像数据。
+    """
     # 打开PSD文件
-    psd = PSDImage.open(psd_path)
+    if psd is None:
+        psd = open_psd_reader(psd_path)
+    if walk is None:
+        walk = walk_psd(psd, psd_path)
+    stats = walk['stats']
     
     # 打印基本信息
     print("\n" + "=" * 50)
@@ -316,23 +891,17 @@ def print_psd_info(psd_path):
     print(f"颜色模式: {psd.color_mode}")
     print("=" * 50)
     
-    # 初始化深度统计
-    depth_stats = {}
-    
-    # 递归打印图层信息
-    def print_layer(layer, indent=0, depth=0):
-        # 更新深度统计
-        depth_stats[depth] = depth_stats.get(depth, 0) + 1
-            
-        # 图层基本信息
-        visibility = "可见" if layer.is_visible() else "隐藏"
-        opacity_percent = round(layer.opacity / 2.55) if hasattr(layer, 'opacity') else 100
-        layer_type = layer.__class__.__name__
+    # 按先序遍历的顺序打印图层信息
+    print("\n图层结构:")
+    for record in walk['records']:
+        layer = record['layer']
+        info = record['info']
+        indent = record['depth']
         
-        # 检查是否是图层组
-        is_group = isinstance(layer, psd_tools.api.layers.Group)
-        if is_group:
-            layer_type = "Group"
+        # 图层基本信息
+        visibility = "可见" if record['visible'] else "隐藏"
+        opacity_percent = round(info['opacity'] / 2.55)
+        layer_type = "Group" if record['is_group'] else info['type']
         
         # 打印图层信息
         prefix = "  " * indent
@@ -340,69 +909,34 @@ def print_psd_info(psd_path):
         
         # 打印图层详细属性
         detail_prefix = "  " * (indent + 1)
-        print(f"{detail_prefix}位置: 左={layer.left}, 上={layer.top}, 右={layer.right}, 下={layer.bottom}")
-        print(f"{detail_prefix}尺寸: {layer.width} x {layer.height} 像素")
-        print(f"{detail_prefix}混合模式: {layer.blend_mode}")
+        print(f"{detail_prefix}位置: 左={info['left']}, 上={info['top']}, 右={info['right']}, 下={info['bottom']}")
+        print(f"{detail_prefix}尺寸: {info['width']} x {info['height']} 像素")
+        print(f"{detail_prefix}混合模式: {record['blend_mode']}")
         
         # 打印其他可用属性
-        if hasattr(layer, 'has_pixels') and callable(layer.has_pixels):
-            has_pixels = layer.has_pixels()
-            print(f"{detail_prefix}包含像素数据: {'是' if has_pixels else '否'}")
-        
-        # 如果是图层组，递归打印子图层
-        if is_group:
-            # 使用正确的方法访问子图层
-            for child_layer in layer:
-                print_layer(child_layer, indent + 1, depth + 1)
-    
-    # 打印所有图层
-    print("\n图层结构:")
-    for layer in psd:
-        print_layer(layer, 0, 0)
+        if record['has_pixels'] is not None:
+            print(f"{detail_prefix}包含像素数据: {'是' if record['has_pixels'] else '否'}")
     
     # 打印统计信息
-    total_layers = len(list(psd.descendants()))
-    visible_layers = len([l for l in psd.descendants() if l.is_visible()])
-    pixel_layers = len([l for l in psd.descendants() if hasattr(l, 'has_pixels') and callable(l.has_pixels) and l.has_pixels()])
-    
-    # 修复图层组计数 - 使用更可靠的方法
-    group_count = 0
-    for layer in psd.descendants():
-        # 检查图层类型是否为Group
-        if isinstance(layer, psd_tools.api.layers.Group):
-            group_count += 1
-    
-    # 计算调整图层数量
-    adjustment_layer_count = len([l for l in psd.descendants() if any(adj_type in l.__class__.__name__ for adj_type in ['Adjustment', 'Hue', 'Brightness', 'Levels', 'Curves', 'Exposure', 'Vibrance', 'ColorBalance'])])
-    
-    # 计算智能对象数量
-    smart_object_count = len([l for l in psd.descendants() if l.__class__.__name__ == 'SmartObjectLayer'])
-    
-    # 计算文本图层数量
-    text_layer_count = len([l for l in psd.descendants() if l.__class__.__name__ == 'TypeLayer'])
-    
-    # 计算形状图层数量
-    shape_layer_count = len([l for l in psd.descendants() if l.__class__.__name__ == 'ShapeLayer'])
-    
-    # 计算最大嵌套深度
-    max_depth = max(depth_stats.keys()) if depth_stats else 0
+    total_layers = stats['total_layers']
+    visible_layers = stats['visible_layers']
     
     print("\n" + "=" * 50)
     print(f"统计信息:")
     print(f"总图层数: {total_layers}")
     print(f"可见图层数: {visible_layers}")
     print(f"不可见图层数: {total_layers - visible_layers}")
-    print(f"包含像素的图层数: {pixel_layers}")
-    print(f"图层组数: {group_count}")
-    print(f"调整图层数: {adjustment_layer_count}")
-    print(f"智能对象数: {smart_object_count}")
-    print(f"文本图层数: {text_layer_count}")
-    print(f"形状图层数: {shape_layer_count}")
-    print(f"最大嵌套深度: {max_depth}")
+    print(f"包含像素的图层数: {stats['pixel_layers']}")
+    print(f"图层组数: {stats['group_count']}")
+    print(f"调整图层数: {stats['adjustment_layer_count']}")
+    print(f"智能对象数: {stats['smart_object_count']}")
+    print(f"文本图层数: {stats['text_layer_count']}")
+    print(f"形状图层数: {stats['shape_layer_count']}")
+    print(f"最大嵌套深度: {stats['max_depth']}")
     
     # 打印深度统计
     print("\n图层深度分布:")
-    for depth, count in sorted(depth_stats.items()):
+    for depth, count in sorted(stats['depth_stats'].items()):
         print(f"  深度 {depth}: {count} 个图层")
     
     print("=" * 50 + "\n")
@@ -412,46 +946,75 @@ def print_psd_info(psd_path):
     print("=" * 50)
     
     # 获取所有图层类型
-    layer_types = set(l.__class__.__name__ for l in psd.descendants())
-    print(f"图层类型: {', '.join(layer_types)}")
+    print(f"图层类型: {', '.join(stats['layer_types'])}")
     
     # 获取所有混合模式
-    blend_modes = set(str(l.blend_mode) for l in psd.descendants() if hasattr(l, 'blend_mode'))
-    print(f"混合模式: {', '.join(blend_modes)}")
+    print(f"混合模式: {', '.join(stats['blend_modes'])}")
     
     # 打印调整图层信息
-    adjustment_layers = [l for l in psd.descendants() if 'adjustment' in l.__class__.__name__.lower() or not hasattr(l, 'has_pixels') or (hasattr(l, 'has_pixels') and callable(l.has_pixels) and not l.has_pixels())]
+    adjustment_layers = stats['adjustment_layers']
     print(f"\n调整图层或无像素图层数量: {len(adjustment_layers)}")
     if adjustment_layers:
         print("调整图层列表:")
-        for i, layer in enumerate(adjustment_layers[:10], 1):  # 只显示前10个
-            layer_type = "Group" if hasattr(layer, 'layers') and layer.layers else layer.__class__.__name__
+        for i, record in enumerate(adjustment_layers[:10], 1):  # 只显示前10个
+            layer = record['layer']
+            layer_type = "Group" if hasattr(layer, 'layers') and layer.layers else record['class_name']
             print(f"  {i}. {layer.name} [{layer_type}]")
         if len(adjustment_layers) > 10:
             print(f"  ... 还有 {len(adjustment_layers) - 10} 个调整图层")
     
     print("=" * 50 + "\n")
 
-def main():
-    # 设置PSD文件路径
-    psd_path = "/Users/zhouke/Documents/project/fairy/data/psd/武将觐见617.psd"
-    output_dir = "/Users/zhouke/Documents/project/fairy/data/image/layers"
+def run_pipeline(psd_path, output_dir, info_path=None, render_groups=True, workers=1, show_info=True,
+                 incremental=False, write_layer_json=True, image_format=DEFAULT_IMAGE_FORMAT):
+    """单次打开、单次遍历的PSD处理流程
     
-    # 打印PSD详细信息
-    print_psd_info(psd_path)
+    只打开一次PSD文件并只遍历一次图层树，由同一次遍历的结果打印PSD信息和统计、
+    写出图层信息JSON，并提取所有图层图像和元数据。
     
-    # 解析PSD文件
-    psd_info = parse_psd(psd_path)
+    参数:
+        psd_path: PSD文件路径
+        output_dir: 图层图像输出目录
+        info_path: 图层信息JSON的输出路径，为None时不写出
+        render_groups: 是否渲染图层组合成图像
+        workers: 提取图层时的工作进程数
+        show_info: 是否打印PSD详细信息
+        incremental: 是否只重新提取内容有变化的图层
+        write_layer_json: 是否在图层清单之外为每个图层写出单独的JSON文件
+        image_format: 图层图像的输出格式（见 psd_output）
     
-    # 将解析结果保存为JSON文件
-    with open("/Users/zhouke/Documents/project/fairy/data/image/psd_info.json", 'w', encoding='utf-8') as f:
-        json.dump(psd_info, f, ensure_ascii=False, indent=2)
+    返回:
+        图层信息（与 parse_psd 的返回值相同）
+    """
+    # 以映射模式打开PSD文件并遍历图层树，渲染图层时才读入整个文件
+    psd = open_psd_reader(psd_path)
+    walk = walk_psd(psd, psd_path)
     
-    print(f"PSD信息已保存到 psd_info.json")
+    # 打印PSD详细信息
+    if show_info:
+        print_psd_info(psd_path, psd, walk)
+    
+    # 将解析结果保存为JSON文件
+    if info_path:
+        with psd_trace.span('json_write', file=info_path), open(info_path, 'w', encoding='utf-8') as f:
+            json.dump(walk['info'], f, ensure_ascii=False, indent=2)
+        logger.info("PSD信息已保存到 %s", info_path)
     
     # 保存图层为单独的图片
-    save_layer_images(psd_path, output_dir)
-    print(f"图层已保存到 {output_dir}")
+    export_psd_layers(psd, psd_path, output_dir, walk, render_groups, workers, incremental, write_layer_json,
+                      image_format)
+    logger.info("图层已保存到 %s", output_dir)
+    
+    return walk['info']
+
+def main():
+    # 设置PSD文件路径
+    psd_path = "/Users/zhouke/Documents/project/fairy/data/psd/武将觐见617.psd"
+    output_dir = "/Users/zhouke/Documents/project/fairy/data/image/layers"
+    info_path = "/Users/zhouke/Documents/project/fairy/data/image/psd_info.json"
+    
+    # 打印PSD详细信息、解析PSD文件并保存图层为单独的图片
+    run_pipeline(psd_path, output_dir, info_path)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+多分辨率瓦片金字塔（DeepZoom）导出
+
+把合成结果切成固定大小的瓦片，按DeepZoom格式写出每一级分辨率:
+    <name>.dzi                    金字塔描述（XML）
+    <name>_files/<level>/<col>_<row>.png
+    <name>.html                   只加载可见瓦片的查看器
+第 max_level 级为原始分辨率，每低一级宽高减半（向上取整），第0级为1x1像素。
+
+最高一级由 compose_tiled 分块合成到临时的未压缩TIFF，再以内存映射的方式读取，
+整幅画布无需驻留内存；每一级由上一级按2x2像素在预乘空间内平均得到，
+瓦片的PNG编码在线程池中并行进行。
+"""
+
+import os
+import math
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import psd_blend
+from psd_composer import DEFAULT_TILE_SIZE, compose_tiled, _load_psd_metadata
+from psd_log import get_logger
+
+logger = get_logger('pyramid')
+
+# 每次缩小处理的行数，限制临时浮点数组的大小
+_DOWNSAMPLE_ROWS = 512
+
+
+def _memmap_tiff(tiff_path):
+    """
+    以内存映射方式读取 StreamingTIFFWriter 写出的未压缩RGBA TIFF，条带在文件中连续存放
+    """
+    with Image.open(tiff_path) as image:
+        width, height = image.size
+        offset = image.tile[0][2]
+    return np.memmap(tiff_path, dtype=np.uint8, mode='r', offset=offset, shape=(height, width, 4))
+
+
+def downsample_half(array):
+    """
+    将uint8 RGBA数组的宽高减半（向上取整），每个输出像素为对应2x2像素在预乘空间内的平均值
+
+    按行分段处理，输入可以是内存映射数组。
+    """
+    height, width = array.shape[:2]
+    out_height, out_width = (height + 1) // 2, (width + 1) // 2
+    result = np.empty((out_height, out_width, 4), dtype=np.uint8)
+
+    for top in range(0, height, _DOWNSAMPLE_ROWS):
+        block = psd_blend.to_premultiplied(np.asarray(array[top:top + _DOWNSAMPLE_ROWS]))
+        # 奇数尺寸时复制最后一行或一列，使其单独取平均
+        if block.shape[0] % 2:
+            block = np.concatenate([block, block[-1:]], axis=0)
+        if block.shape[1] % 2:
+            block = np.concatenate([block, block[:, -1:]], axis=1)
+        averaged = (block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2]) * np.float32(0.25)
+        result[top // 2:top // 2 + averaged.shape[0]] = psd_blend.from_premultiplied(averaged)
+    return result
+
+
+def _write_level(array, level_dir, tile_size, overlap, tile_format, executor):
+    """
+    把一级分辨率切成瓦片并写出，返回瓦片数量
+    """
+    os.makedirs(level_dir, exist_ok=True)
+    height, width = array.shape[:2]
+    columns = math.ceil(width / tile_size)
+    rows = math.ceil(height / tile_size)
+
+    def write_tile(column, row):
+        # DeepZoom的重叠：瓦片向相邻瓦片方向各扩展overlap个像素
+        left = max(0, column * tile_size - overlap)
+        top = max(0, row * tile_size - overlap)
+        right = min(width, (column + 1) * tile_size + overlap)
+        bottom = min(height, (row + 1) * tile_size + overlap)
+        tile = Image.fromarray(np.ascontiguousarray(array[top:bottom, left:right]), 'RGBA')
+        if tile_format == 'jpg':
+            tile = tile.convert('RGB')
+        tile.save(os.path.join(level_dir, f"{column}_{row}.{tile_format}"))
+
+    futures = [executor.submit(write_tile, column, row) for row in range(rows) for column in range(columns)]
+    for future in futures:
+        future.result()
+    return len(futures)
+
+
+def export_pyramid(layers_dir, output_dir, tile_size=256, overlap=0, tile_format='png', workers=4,
+                   compose_tile_size=DEFAULT_TILE_SIZE, name=None):
+    """
+    合成图层目录并导出DeepZoom瓦片金字塔和查看器
+
+    参数:
+        layers_dir: 图层目录路径
+        output_dir: 金字塔输出目录
+        tile_size: 瓦片边长
+        overlap: 相邻瓦片的重叠像素数
+        tile_format: 瓦片格式，'png' 或 'jpg'（不透明文档可以使用jpg减小体积）
+        workers: 合成和瓦片编码的线程数
+        compose_tile_size: 合成最高一级时的分块大小
+        name: 输出文件名，为None时使用PSD文件名
+
+    返回:
+        .dzi 文件的路径
+    """
+    psd_metadata, _ = _load_psd_metadata(layers_dir)
+    name = name or os.path.splitext(psd_metadata['name'])[0]
+    width, height = psd_metadata['width'], psd_metadata['height']
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    files_dir = os.path.join(output_dir, f"{name}_files")
+    os.makedirs(output_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix='psd_pyramid_') as temp_dir:
+        # 最高一级：分块合成到未压缩TIFF，再按内存映射读取
+        composed_path = compose_tiled(layers_dir, os.path.join(temp_dir, 'composed.tif'), compose_tile_size, workers)
+        level_array = _memmap_tiff(composed_path)
+
+        total_tiles = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for level in range(max_level, -1, -1):
+                count = _write_level(level_array, os.path.join(files_dir, str(level)), tile_size, overlap,
+                                     tile_format, executor)
+                total_tiles += count
+                logger.debug("已写出第 %d 级: %dx%d, %d 个瓦片", level, level_array.shape[1], level_array.shape[0], count)
+                if level > 0:
+                    # 下一级由本级缩小得到
+                    level_array = downsample_half(level_array)
+        del level_array
+
+    dzi_path = os.path.join(output_dir, f"{name}.dzi")
+    with open(dzi_path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{tile_format}" '
+                f'Overlap="{overlap}" TileSize="{tile_size}">\n'
+                f'  <Size Width="{width}" Height="{height}"/>\n'
+                '</Image>\n')
+
+    viewer_path = os.path.join(output_dir, f"{name}.html")
+    with open(viewer_path, 'w', encoding='utf-8') as f:
+        f.write(_viewer_html(name, width, height, tile_size, overlap, tile_format, max_level))
+
+    logger.info("已导出瓦片金字塔: %s，共 %d 级 %d 个瓦片", dzi_path, max_level + 1, total_tiles)
+    logger.info("查看器: %s", viewer_path)
+    return dzi_path
+
+
+def _viewer_html(name, width, height, tile_size, overlap, tile_format, max_level):
+    """
+    生成金字塔查看器：拖动平移、滚轮缩放，只为视口内可见的瓦片创建图片
+    """
+    return f"""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{name} - 瓦片查看器</title>
+    <style>
+        html, body {{ margin: 0; height: 100%; overflow: hidden; background: #333; }}
+        #viewport {{ position: absolute; inset: 0; cursor: grab; }}
+        #viewport img {{ position: absolute; image-rendering: auto; user-select: none; -webkit-user-drag: none; }}
+        #status {{ position: absolute; left: 10px; bottom: 10px; color: #fff; font: 12px Arial, sans-serif; }}
+    </style>
+</head>
+<body>
+    <div id="viewport"></div>
+    <div id="status"></div>
+    <script>
+        const WIDTH = {width}, HEIGHT = {height}, TILE = {tile_size}, OVERLAP = {overlap};
+        const MAX_LEVEL = {max_level}, FORMAT = '{tile_format}', FILES = '{name}_files';
+        const viewport = document.getElementById('viewport');
+        const status = document.getElementById('status');
+        const tiles = new Map();
+        // 视图状态：scale 为屏幕像素与原图像素之比，(x, y) 为原图左上角在屏幕上的位置
+        let scale = Math.min(window.innerWidth / WIDTH, window.innerHeight / HEIGHT);
+        let x = (window.innerWidth - WIDTH * scale) / 2, y = (window.innerHeight - HEIGHT * scale) / 2;
+
+        function render() {{
+            // 选择分辨率不低于屏幕显示所需的最低一级
+            const level = Math.max(0, Math.min(MAX_LEVEL, MAX_LEVEL + Math.ceil(Math.log2(scale))));
+            const levelScale = Math.pow(2, level - MAX_LEVEL);
+            const levelWidth = Math.ceil(WIDTH * levelScale), levelHeight = Math.ceil(HEIGHT * levelScale);
+            const tileScale = scale / levelScale;
+            // 视口在本级坐标下的范围
+            const left = Math.max(0, -x / tileScale), top = Math.max(0, -y / tileScale);
+            const right = Math.min(levelWidth, (window.innerWidth - x) / tileScale);
+            const bottom = Math.min(levelHeight, (window.innerHeight - y) / tileScale);
+            const wanted = new Set();
+            for (let row = Math.floor(top / TILE); row * TILE < bottom; row++) {{
+                for (let col = Math.floor(left / TILE); col * TILE < right; col++) {{
+                    const key = level + '/' + col + '_' + row;
+                    wanted.add(key);
+                    let img = tiles.get(key);
+                    if (!img) {{
+                        img = document.createElement('img');
+                        img.src = FILES + '/' + key + '.' + FORMAT;
+                        tiles.set(key, img);
+                        viewport.appendChild(img);
+                    }}
+                    const tileLeft = Math.max(0, col * TILE - OVERLAP), tileTop = Math.max(0, row * TILE - OVERLAP);
+                    const tileRight = Math.min(levelWidth, (col + 1) * TILE + OVERLAP);
+                    const tileBottom = Math.min(levelHeight, (row + 1) * TILE + OVERLAP);
+                    img.style.left = (x + tileLeft * tileScale) + 'px';
+                    img.style.top = (y + tileTop * tileScale) + 'px';
+                    img.style.width = ((tileRight - tileLeft) * tileScale) + 'px';
+                    img.style.height = ((tileBottom - tileTop) * tileScale) + 'px';
+                }}
+            }}
+            // 移除不可见的瓦片
+            for (const [key, img] of tiles) {{
+                if (!wanted.has(key)) {{
+                    img.remove();
+                    tiles.delete(key);
+                }}
+            }}
+            status.textContent = '级别 ' + level + '/' + MAX_LEVEL + '，缩放 ' + (scale * 100).toFixed(1) + '%，瓦片 ' + tiles.size;
+        }}
+
+        let dragging = null;
+        viewport.addEventListener('mousedown', e => {{ dragging = {{ x: e.clientX - x, y: e.clientY - y }}; }});
+        window.addEventListener('mouseup', () => {{ dragging = null; }});
+        window.addEventListener('mousemove', e => {{
+            if (!dragging) return;
+            x = e.clientX - dragging.x;
+            y = e.clientY - dragging.y;
+            render();
+        }});
+        viewport.addEventListener('wheel', e => {{
+            e.preventDefault();
+            const factor = e.deltaY < 0 ? 1.25 : 0.8;
+            x = e.clientX - (e.clientX - x) * factor;
+            y = e.clientY - (e.clientY - y) * factor;
+            scale *= factor;
+            render();
+        }}, {{ passive: false }});
+        window.addEventListener('resize', render);
+        render();
+    </script>
+</body>
+</html>
+"""
+
+
+def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='导出合成结果的DeepZoom瓦片金字塔和查看器')
+    parser.add_argument('layers_dir', help='图层目录路径')
+    parser.add_argument('-o', '--output-dir', default='pyramid', help='输出目录')
+    parser.add_argument('--tile-size', type=int, default=256, help='瓦片边长')
+    parser.add_argument('--overlap', type=int, default=0, help='相邻瓦片的重叠像素数')
+    parser.add_argument('--format', choices=('png', 'jpg'), default='png', help='瓦片格式')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='合成和瓦片编码的线程数')
+    args = parser.parse_args()
+
+    export_pyramid(args.layers_dir, args.output_dir, args.tile_size, args.overlap, args.format, args.workers)
+
+
+if __name__ == '__main__':
+    main()
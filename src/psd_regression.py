@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+合成结果的回归测试（精度与耗时）
+
+在本地生成一组确定性的合成PSD文档（每种混合模式、不同不透明度、不同嵌套深度和不同画布大小各一个，
+以及剪贴蒙版、图层蒙版和隐藏图层），对每个文档依次执行解析、图层提取和各种合成方式，
+与 psd_tools 的合成结果（psd.composite(ignore_preview=True)）逐像素比较，报告每个阶段的耗时和像素误差。
+pil 和 numpy 只混合第一层级的图层组PNG，不使用根目录下的PSD合成图像，误差反映的是混合引擎本身；
+第一层级有可见的穿透图层组的文档无法只用图层组PNG合成，这两种方式跳过。
+每种合成方式的最大误差超过 --max-error、PSNR低于 --min-psnr，或合成时有图层因异常被跳过
+（compose_layers 捕获异常后只输出警告）时，以状态码1退出。
+
+每个文档还另存为PSB，检查 psd_lazy 的结构解析与 psd_tools 是否一致：walk_psd 的解析信息、
+提取任务和统计，每个像素图层的 topil() 像素，以及增量提取的图层哈希是否覆盖每个提取任务。
+psd_lazy 按 psd_tools 的规则重新实现了图层树的构建，psd_tools 升级后规则不同时在这里发现，
+任何一项不一致时以状态码1退出。
+结果可以保存为JSON，之后用 --baseline 与之前的结果对比，同时判断优化对速度和精度的影响。
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.constants import BlendMode
+
+import psd_blend
+import psd_lazy
+from psd_parser import compute_layer_hashes, walk_psd, export_psd_layers
+from psd_composer import compose_layers, compose_tiled, compare_metrics
+from psd_log import ROOT_LOGGER_NAME
+from psd_manifest import load_layer_manifest
+
+# 参与比较的合成方式
+COMPOSE_ENGINES = ('pil', 'numpy', 'recursive', 'tiled')
+
+# 各类文档的参数
+FIXTURE_OPACITIES = (255, 192, 128, 64)
+FIXTURE_DEPTHS = (1, 2, 4, 6)
+FIXTURE_SIZES = (512, 1024, 2048)
+FIXTURE_FEATURES = ('clipping', 'mask', 'hidden')
+
+# 每种合成方式与 psd_tools 合成结果之间允许的最大误差和最低PSNR（dB）。
+# pil 每合成一个图层都把画布量化为8位，颜色减淡/加深会放大量化误差，允许的最大误差更大
+ERROR_LIMITS = {
+    'pil': (32, 40.0),
+    'numpy': (16, 40.0),
+    'recursive': (16, 40.0),
+    'tiled': (16, 40.0),
+}
+
+# 与基准结果对比时允许的耗时增长比例和误差增长
+TIME_TOLERANCE = 0.2
+MAE_TOLERANCE = 0.05
+
+
+def _fixture_image(rng, width, height):
+    """
+    生成渐变加噪声、中间为半透明圆形的测试图像，顶部四分之一完全不透明
+    """
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., 0] = x * 255 // max(1, width - 1)
+    pixels[..., 1] = y * 255 // max(1, height - 1)
+    pixels[..., 2] = rng.integers(0, 256, (height, width), dtype=np.uint8)
+    inside = (x - width / 2) ** 2 + (y - height / 2) ** 2 < (min(width, height) / 2) ** 2
+    pixels[..., 3] = np.where(inside, rng.integers(96, 256), 0)
+    pixels[:height // 4, :, 3] = 255
+    return Image.fromarray(pixels, 'RGBA')
+
+
+def _new_document(rng, width, height):
+    """
+    创建带有不透明背景图层的文档
+    """
+    psd = PSDImage.new('RGB', (width, height), color=(255, 255, 255))
+    background = _fixture_image(rng, width, height)
+    background.putalpha(255)
+    psd.create_pixel_layer(background.convert('RGB'), name='background')
+    return psd
+
+
+def _blend_fixture(mode):
+    def build(rng):
+        psd = _new_document(rng, 256, 256)
+        psd.create_pixel_layer(_fixture_image(rng, 192, 192), name='top', left=32, top=32,
+                               blend_mode=BlendMode[mode])
+        psd.create_pixel_layer(_fixture_image(rng, 128, 160), name='top_2', left=100, top=60,
+                               blend_mode=BlendMode[mode], opacity=160)
+        return psd
+    return build
+
+
+def _opacity_fixture(opacity):
+    def build(rng):
+        psd = _new_document(rng, 256, 256)
+        psd.create_pixel_layer(_fixture_image(rng, 160, 160), name='normal', left=16, top=16, opacity=opacity)
+        group = psd.create_group(name='group', blend_mode=BlendMode.NORMAL, opacity=opacity)
+        group.create_pixel_layer(_fixture_image(rng, 160, 160), name='multiply', left=80, top=80,
+                                 blend_mode=BlendMode.MULTIPLY, opacity=opacity)
+        return psd
+    return build
+
+
+def _depth_fixture(depth):
+    modes = [mode for mode in psd_blend.BLEND_FUNCS if mode not in ('NORMAL', 'PASS_THROUGH')]
+
+    def build(rng):
+        psd = _new_document(rng, 256, 256)
+        parent = psd
+        for level in range(depth):
+            # 交替使用穿透和普通（隔离）图层组
+            blend_mode = BlendMode.PASS_THROUGH if level % 2 == 0 else BlendMode.NORMAL
+            parent = parent.create_group(name=f"group_{level}", blend_mode=blend_mode, opacity=230)
+            parent.create_pixel_layer(_fixture_image(rng, 128, 128), name=f"layer_{level}",
+                                      left=16 + level * 16, top=16 + level * 12,
+                                      blend_mode=BlendMode[modes[level % len(modes)]])
+        return psd
+    return build
+
+
+def _size_fixture(size):
+    modes = [mode for mode in psd_blend.BLEND_FUNCS if mode != 'PASS_THROUGH']
+
+    def build(rng):
+        psd = _new_document(rng, size, size)
+        for i in range(8):
+            layer_width = int(rng.integers(size // 8, size // 2))
+            layer_height = int(rng.integers(size // 8, size // 2))
+            psd.create_pixel_layer(_fixture_image(rng, layer_width, layer_height), name=f"layer_{i}",
+                                   left=int(rng.integers(0, size - layer_width)),
+                                   top=int(rng.integers(0, size - layer_height)),
+                                   blend_mode=BlendMode[modes[i % len(modes)]])
+        return psd
+    return build
+
+
+def _gradient_mask(width, height):
+    """
+    从左到右由不透明渐变到透明的灰度蒙版
+    """
+    row = np.linspace(255, 0, width).astype(np.uint8)
+    return Image.fromarray(np.tile(row, (height, 1)), 'L')
+
+
+def _feature_fixture(feature):
+    def build(rng):
+        psd = _new_document(rng, 256, 256)
+        if feature == 'clipping':
+            # 剪贴到基底图层的两个图层，其中一个使用正片叠底
+            psd.create_pixel_layer(_fixture_image(rng, 160, 160), name='base', left=48, top=48)
+            clipped = psd.create_pixel_layer(_fixture_image(rng, 192, 96), name='clipped', left=16, top=80,
+                                             blend_mode=BlendMode.MULTIPLY)
+            clipped.clipping = True
+            clipped = psd.create_pixel_layer(_fixture_image(rng, 96, 192), name='clipped_2', left=96, top=16,
+                                             opacity=192)
+            clipped.clipping = True
+        elif feature == 'mask':
+            # 带渐变蒙版的图层，以及图层组中蒙版小于图层、位置偏移的图层（蒙版以外的区域被遮住）。
+            # psd_tools 新建的像素图层自带全白蒙版，需要先移除；它为图层组写出的蒙版无法再读取，因此不测试图层组蒙版
+            layer = psd.create_pixel_layer(_fixture_image(rng, 192, 192), name='masked', left=32, top=32,
+                                           blend_mode=BlendMode.SCREEN)
+            layer.remove_mask()
+            layer.create_mask(_gradient_mask(192, 192))
+            group = psd.create_group(name='group', blend_mode=BlendMode.NORMAL)
+            layer = group.create_pixel_layer(_fixture_image(rng, 160, 128), name='inner', left=64, top=96,
+                                             blend_mode=BlendMode.OVERLAY)
+            layer.remove_mask()
+            layer.create_mask(_gradient_mask(96, 96).transpose(Image.Transpose.ROTATE_90), top=112, left=80)
+        else:
+            # 隐藏的图层和图层组，以及隐藏图层组中的可见图层
+            psd.create_pixel_layer(_fixture_image(rng, 160, 160), name='visible', left=16, top=16,
+                                   blend_mode=BlendMode.DARKEN)
+            psd.create_pixel_layer(_fixture_image(rng, 160, 160), name='hidden', left=64, top=64).visible = False
+            group = psd.create_group(name='hidden_group')
+            group.create_pixel_layer(_fixture_image(rng, 128, 128), name='inner', left=96, top=32)
+            group.visible = False
+        return psd
+    return build
+
+
+def regression_fixtures(sizes=FIXTURE_SIZES):
+    """
+    返回回归测试文档的列表 [(名称, 生成函数)]，生成函数接收随机数生成器并返回 PSDImage
+    """
+    fixtures = [(f"blend_{mode.lower()}", _blend_fixture(mode))
+                for mode in psd_blend.BLEND_FUNCS if mode != 'PASS_THROUGH']
+    fixtures += [(f"opacity_{opacity}", _opacity_fixture(opacity)) for opacity in FIXTURE_OPACITIES]
+    fixtures += [(f"depth_{depth}", _depth_fixture(depth)) for depth in FIXTURE_DEPTHS]
+    fixtures += [(f"size_{size}", _size_fixture(size)) for size in sizes]
+    fixtures += [(feature, _feature_fixture(feature)) for feature in FIXTURE_FEATURES]
+    return fixtures
+
+
+def _generate_fixture(fixtures_dir, name, build):
+    """
+    生成（或复用已有的）测试文档及其PSB版本，随机种子由名称确定
+
+    返回:
+        (PSD路径, PSB路径)
+    """
+    psd_path = os.path.join(fixtures_dir, f"{name}.psd")
+    psb_path = os.path.join(fixtures_dir, f"{name}.psb")
+    if not os.path.exists(psd_path) or not os.path.exists(psb_path):
+        seed = sum(name.encode('utf-8'))
+        psd = build(np.random.default_rng(seed))
+        psd.save(psd_path)
+        # psd_tools 没有公开另存为PSB的接口，修改文件头的版本后保存即为PSB格式
+        psd = PSDImage.open(psd_path)
+        psd._record.header.version = 2
+        psd.save(psb_path)
+    return psd_path, psb_path
+
+
+def _layer_pairs(lazy_group, group):
+    """
+    同时先序遍历 psd_lazy 和 psd_tools 的图层树，返回对应的图层对
+    """
+    for lazy_layer, layer in zip(lazy_group, group):
+        yield lazy_layer, layer
+        if layer.is_group():
+            yield from _layer_pairs(lazy_layer, layer)
+
+
+def check_structure(psd_path):
+    """
+    检查 psd_lazy 与 psd_tools 对同一文件的结构解析是否一致
+
+    比较 walk_psd 的解析信息、提取任务、统计和图层类名，每个像素图层 topil() 的像素，
+    以及 compute_layer_hashes 的图层哈希是否覆盖 psd_tools 遍历得到的所有提取任务。
+
+    返回:
+        不一致项目的描述列表，一致时为空
+    """
+    mismatches = []
+    psd = PSDImage.open(psd_path)
+    with psd_lazy.LazyPSD.open(psd_path, use_mmap=True) as lazy:
+        walk = walk_psd(psd, psd_path)
+        lazy_walk = walk_psd(lazy, psd_path)
+        for key in ('info', 'tasks'):
+            if lazy_walk[key] != walk[key]:
+                mismatches.append(f"walk_psd {key}")
+        # 统计中的调整图层列表包含图层对象，按图层路径比较
+        stats, lazy_stats = (dict(item['stats'], adjustment_layers=[record['task']['info_path']
+                                                                   for record in item['stats']['adjustment_layers']])
+                             for item in (walk, lazy_walk))
+        if lazy_stats != stats:
+            mismatches.append("walk_psd stats")
+        class_names = [record['class_name'] for record in walk['records']]
+        if [record['class_name'] for record in lazy_walk['records']] != class_names:
+            mismatches.append("图层类名")
+
+        if len(list(lazy.descendants())) != len(list(psd.descendants())):
+            mismatches.append("图层数")
+        for lazy_layer, layer in _layer_pairs(lazy, psd):
+            if layer.is_group() or not layer.has_pixels():
+                continue
+            lazy_image, image = lazy_layer.topil(), layer.topil()
+            if lazy_image is None or image is None:
+                if (lazy_image is None) != (image is None):
+                    mismatches.append(f"topil {layer.name}: 一方没有像素")
+            elif lazy_image.mode != image.mode or not np.array_equal(np.asarray(lazy_image), np.asarray(image)):
+                mismatches.append(f"topil {layer.name}: 像素不同")
+
+        # 增量提取总是用 psd_lazy 计算哈希，哈希必须覆盖 psd_tools 遍历得到的每个提取任务
+        layer_hashes, _ = compute_layer_hashes(psd_path)
+        if set(layer_hashes) != {task['layer_path'] for task in walk['tasks']}:
+            mismatches.append("图层哈希的图层路径")
+    return mismatches
+
+
+class _WarningCollector(logging.Handler):
+    """
+    收集合成过程中的警告和错误日志，如无法处理而被跳过的图层
+    """
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def _has_root_pass_through(layers_dir):
+    """
+    第一层级是否有可见的穿透图层组：它的PNG是隔离合成的结果，只混合第一层级的PNG无法得到正确结果
+    """
+    manifest = load_layer_manifest(layers_dir) or {'layers': []}
+    return any(entry.get('type') == 'Group' and not os.path.dirname(entry['dir']) and entry.get('visible', True)
+               and psd_blend.blend_mode_name(entry.get('blend_mode', '')) == 'PASS_THROUGH'
+               for entry in manifest['layers'])
+
+
+def _timed(func):
+    """
+    运行函数并屏蔽其输出，返回 (结果, 耗时秒数)
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func()
+    return result, time.perf_counter() - start
+
+
+def run_fixture(psd_path, work_dir, engines=COMPOSE_ENGINES, tile_size=256):
+    """
+    对一个文档执行解析、提取和合成，并与 psd_tools 的合成结果比较
+
+    参数:
+        psd_path: PSD文件路径
+        work_dir: 中间文件目录
+        engines: 要比较的合成方式
+        tile_size: 分块合成的分块大小
+
+    返回:
+        结果字典：times 为各阶段耗时（秒），errors 为各合成方式的误差指标
+    """
+    layers_dir = os.path.join(work_dir, 'layers')
+    times = {}
+
+    def parse():
+        psd = PSDImage.open(psd_path)
+        return psd, walk_psd(psd, psd_path)
+
+    (psd, walk), times['parse'] = _timed(parse)
+    reference, times['psd_tools'] = _timed(lambda: psd.composite(ignore_preview=True))
+    reference = np.asarray(reference.convert('RGBA'))
+    _, times['extract'] = _timed(lambda: export_psd_layers(psd, psd_path, layers_dir, walk, render_groups=True))
+
+    errors = {}
+    flat_skipped = _has_root_pass_through(layers_dir)
+    for engine in engines:
+        if engine in ('pil', 'numpy') and flat_skipped:
+            errors[engine] = {'skipped': '第一层级有可见的穿透图层组'}
+            continue
+        output_path = os.path.join(work_dir, f"{engine}.png")
+        if engine == 'tiled':
+            compose = lambda: compose_tiled(layers_dir, output_path, tile_size)
+        elif engine == 'recursive':
+            compose = lambda: compose_layers(layers_dir, output_path, engine='numpy', recursive=True)
+        else:
+            # 不使用根目录下的PSD合成图像，否则它最后完全覆盖画布，输出与混合结果无关
+            compose = lambda: compose_layers(layers_dir, output_path, engine=engine, skip_root=True)
+        collector = _WarningCollector()
+        logging.getLogger(ROOT_LOGGER_NAME).addHandler(collector)
+        try:
+            _, times[engine] = _timed(compose)
+        except Exception as e:
+            errors[engine] = {'error': f"{type(e).__name__}: {e}"}
+            continue
+        finally:
+            logging.getLogger(ROOT_LOGGER_NAME).removeHandler(collector)
+        metrics = compare_metrics(output_path, reference, max_regions=5)
+        errors[engine] = {key: metrics[key] for key in ('mae', 'max_error', 'psnr', 'ssim', 'diff_pixels')}
+        errors[engine]['warnings'] = collector.messages
+        os.remove(output_path)
+
+    return {
+        'psd': os.path.basename(psd_path),
+        'width': psd.width,
+        'height': psd.height,
+        'layers': len(walk['tasks']),
+        'times': times,
+        'errors': errors
+    }
+
+
+def run_regression(fixtures_dir=None, sizes=FIXTURE_SIZES, engines=COMPOSE_ENGINES, only=None, tile_size=256):
+    """
+    生成测试文档并逐个运行，打印每个文档各阶段的耗时和各合成方式的误差
+
+    参数:
+        fixtures_dir: 测试文档目录，已存在的文档直接复用；为None时使用临时目录
+        sizes: 画布大小测试的边长
+        engines: 要比较的合成方式
+        only: 只运行名称包含该字符串的文档
+        tile_size: 分块合成的分块大小
+
+    返回:
+        每个文档的结果字典，键为文档名称
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='psd_regression_') as temp_dir:
+        fixtures_dir = fixtures_dir or os.path.join(temp_dir, 'fixtures')
+        os.makedirs(fixtures_dir, exist_ok=True)
+
+        stages = ['parse', 'psd_tools', 'extract'] + list(engines)
+        print(f"{'文档':<20}" + ''.join(f"{stage + '(ms)':>14}" for stage in stages))
+        for name, build in regression_fixtures(sizes):
+            if only and only not in name:
+                continue
+            psd_path, psb_path = _generate_fixture(fixtures_dir, name, build)
+            work_dir = os.path.join(temp_dir, name)
+            os.makedirs(work_dir)
+            result = run_fixture(psd_path, work_dir, engines, tile_size)
+            result['structure'] = {os.path.basename(path): check_structure(path) for path in (psd_path, psb_path)}
+            results[name] = result
+
+            times = result['times']
+            print(f"{name:<20}" + ''.join(f"{times[stage] * 1000:>14.1f}" if stage in times else f"{'失败':>12}"
+                                          for stage in stages))
+            for engine in engines:
+                error = result['errors'][engine]
+                if 'error' in error:
+                    print(f"  {engine:<10} 失败: {error['error']}")
+                elif 'skipped' in error:
+                    print(f"  {engine:<10} 跳过: {error['skipped']}")
+                else:
+                    psnr = f"{error['psnr']:7.2f} dB" if error['psnr'] is not None else f"{'相同':>8}"
+                    print(f"  {engine:<10} MAE {error['mae']:8.4f}  最大误差 {error['max_error']:>3}  "
+                          f"PSNR {psnr}  SSIM {error['ssim']:.5f}")
+                    for message in error['warnings']:
+                        print(f"  {engine:<10} 警告: {message}")
+            for file_name, mismatches in result['structure'].items():
+                for mismatch in mismatches:
+                    print(f"  结构解析与 psd_tools 不一致 {file_name}: {mismatch}")
+    return results
+
+
+def structure_mismatches(results):
+    """
+    返回结构解析不一致的项目列表 [(文档文件, 描述)]
+    """
+    return [(file_name, mismatch) for result in results.values()
+            for file_name, mismatches in result.get('structure', {}).items() for mismatch in mismatches]
+
+
+def threshold_failures(results, max_error=None, min_psnr=None):
+    """
+    返回超出绝对误差阈值、合成失败或合成时有图层被跳过的项目列表 [(文档, 合成方式, 原因)]
+
+    参数:
+        results: run_regression 的结果
+        max_error: 允许的最大误差，为None时使用 ERROR_LIMITS 中各合成方式的阈值
+        min_psnr: 允许的最低PSNR（dB），为None时同样按合成方式确定；图像相同时PSNR为None，视为通过
+    """
+    failures = []
+    for name, result in results.items():
+        for engine, error in result['errors'].items():
+            if 'skipped' in error:
+                continue
+            engine_max_error, engine_min_psnr = ERROR_LIMITS[engine]
+            engine_max_error = engine_max_error if max_error is None else max_error
+            engine_min_psnr = engine_min_psnr if min_psnr is None else min_psnr
+            if 'error' in error:
+                failures.append((name, engine, error['error']))
+                continue
+            if error['max_error'] > engine_max_error:
+                failures.append((name, engine, f"最大误差 {error['max_error']} > {engine_max_error}"))
+            if error['psnr'] is not None and error['psnr'] < engine_min_psnr:
+                failures.append((name, engine, f"PSNR {error['psnr']:.2f} dB < {engine_min_psnr} dB"))
+            if error['warnings']:
+                failures.append((name, engine, f"{len(error['warnings'])} 条合成警告: {error['warnings'][0]}"))
+    return failures
+
+
+def compare_with_baseline(results, baseline, time_tolerance=TIME_TOLERANCE, mae_tolerance=MAE_TOLERANCE):
+    """
+    与基准结果对比，打印变慢或误差增大的项目
+
+    参数:
+        results: run_regression 的结果
+        baseline: 之前保存的结果
+        time_tolerance: 允许的耗时增长比例
+        mae_tolerance: 允许的MAE增长
+
+    返回:
+        精度退化的项目列表 [(文档, 合成方式)]
+    """
+    regressions = []
+    print("\n与基准结果对比:")
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for stage, elapsed in result['times'].items():
+            old_time = old['times'].get(stage)
+            if old_time and elapsed > old_time * (1 + time_tolerance):
+                print(f"  变慢   {name:<20} {stage:<10} {old_time * 1000:.1f} -> {elapsed * 1000:.1f} ms")
+            elif old_time and elapsed < old_time * (1 - time_tolerance):
+                print(f"  变快   {name:<20} {stage:<10} {old_time * 1000:.1f} -> {elapsed * 1000:.1f} ms")
+        for engine, error in result['errors'].items():
+            old_error = old['errors'].get(engine)
+            if not old_error or 'error' in old_error or 'skipped' in old_error or 'skipped' in error:
+                continue
+            if 'error' in error or error['mae'] > old_error['mae'] + mae_tolerance \
+                    or error['max_error'] > old_error['max_error']:
+                regressions.append((name, engine))
+                now = error.get('error') or f"MAE {error['mae']:.4f}, 最大误差 {error['max_error']}"
+                print(f"  精度退化 {name:<20} {engine:<10} MAE {old_error['mae']:.4f}, "
+                      f"最大误差 {old_error['max_error']} -> {now}")
+    print(f"精度退化 {len(regressions)} 项")
+    return regressions
+
+
+def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='合成结果与 psd_tools 合成的回归测试（精度与耗时）')
+    parser.add_argument('--fixtures-dir', help='测试文档目录，已存在的文档直接复用，省略时使用临时目录')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(FIXTURE_SIZES), help='画布大小测试的边长')
+    parser.add_argument('--engines', choices=COMPOSE_ENGINES, nargs='+', default=list(COMPOSE_ENGINES),
+                        help='要比较的合成方式')
+    parser.add_argument('--only', help='只运行名称包含该字符串的文档，如 blend_ 或 depth_4')
+    parser.add_argument('--tile-size', type=int, default=256, help='分块合成的分块大小')
+    parser.add_argument('-o', '--output', help='结果JSON的输出路径')
+    parser.add_argument('--baseline', help='之前保存的结果JSON，精度退化时以状态码1退出')
+    parser.add_argument('--max-error', type=int,
+                        help='所有合成方式允许的最大误差，超过时以状态码1退出；默认 pil 为32，其他为16')
+    parser.add_argument('--min-psnr', type=float,
+                        help='所有合成方式允许的最低PSNR（dB），低于时以状态码1退出；默认为40')
+    args = parser.parse_args()
+
+    results = run_regression(args.fixtures_dir, args.sizes, args.engines, args.only, args.tile_size)
+    mismatches = structure_mismatches(results)
+    print(f"结构解析与 psd_tools 不一致 {len(mismatches)} 项")
+    failures = threshold_failures(results, args.max_error, args.min_psnr)
+    for name, engine, reason in failures:
+        print(f"  未通过 {name:<20} {engine:<10} {reason}")
+    print(f"超出误差阈值或合成失败 {len(failures)} 项")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2, allow_nan=False)
+        print(f"已保存回归测试结果到: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare_with_baseline(results, baseline):
+            sys.exit(1)
+    if mismatches or failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
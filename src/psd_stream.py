@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+流式图像写出
+
+按行带（band）逐段写出PNG和TIFF文件，整幅图像无需同时驻留在内存中，
+供 psd_composer 的分块合成模式和 psd_lazy 的合并图像写出使用。
+"""
+
+import struct
+import zlib
+import numpy as np
+
+# PNG文件签名
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG的Paeth过滤类型
+_PNG_FILTER_PAETH = 4
+
+# 每像素通道数对应的PNG颜色类型：2为RGB，6为RGBA
+_PNG_COLOR_TYPES = {3: 2, 4: 6}
+
+
+def _paeth_filter(rows, previous, bpp=4):
+    """
+    对uint8字节行做PNG的Paeth过滤
+
+    编码时的左、上、左上邻居都是原始字节，因此可以整行甚至整段向量化计算。
+
+    参数:
+        rows: HxN 的uint8数组，每行为一条扫描线的原始字节
+        previous: 上一条扫描线的原始字节，第一条扫描线时为全零
+        bpp: 每个像素的字节数
+
+    返回:
+        过滤后的 HxN uint8数组
+    """
+    up = np.empty_like(rows)
+    up[0] = previous
+    up[1:] = rows[:-1]
+
+    rows16 = rows.astype(np.int16)
+    a = np.zeros_like(rows16)
+    a[:, bpp:] = rows16[:, :-bpp]
+    b = up.astype(np.int16)
+    c = np.zeros_like(rows16)
+    c[:, bpp:] = b[:, :-bpp]
+
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - 2 * c)
+    predictor = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    return (rows16 - predictor).astype(np.uint8)
+
+
+class StreamingPNGWriter:
+    """
+    逐段写出8位RGBA（或RGB）的PNG文件
+
+    用法:
+        with StreamingPNGWriter(path, width, height) as writer:
+            writer.write_rows(band)  # band 为 hxWx4 的uint8数组，自上而下依次写入
+    """
+
+    def __init__(self, path, width, height, compress_level=6, channels=4):
+        if channels not in _PNG_COLOR_TYPES:
+            raise ValueError(f"不支持 {channels} 个通道的PNG")
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows_written = 0
+        self._previous = np.zeros(width * channels, dtype=np.uint8)
+        self._compressor = zlib.compressobj(compress_level)
+        self._file = open(path, 'wb')
+        self._file.write(_PNG_SIGNATURE)
+        # 位深8，默认压缩、过滤和非隔行
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, _PNG_COLOR_TYPES[channels], 0, 0, 0))
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF))
+
+    def write_rows(self, rows):
+        """
+        写入若干行像素
+
+        参数:
+            rows: hxWx4 （RGB时为hxWx3）的uint8数组
+        """
+        if rows.shape[1:] != (self.width, self.channels):
+            raise ValueError(f"行尺寸 {rows.shape[1:]} 与图像宽度 {self.width} 不一致")
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError("写入的行数超过图像高度")
+
+        raw = np.ascontiguousarray(rows, dtype=np.uint8).reshape(rows.shape[0], -1)
+        scanlines = np.empty((raw.shape[0], raw.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 0] = _PNG_FILTER_PAETH
+        scanlines[:, 1:] = _paeth_filter(raw, self._previous, self.channels)
+        self._previous = raw[-1].copy()
+        self.rows_written += rows.shape[0]
+
+        data = self._compressor.compress(scanlines.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+
+    def close(self):
+        """
+        结束压缩流并写出文件尾
+        """
+        if self._file is None:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"只写入了 {self.rows_written}/{self.height} 行")
+            self._write_chunk(b'IDAT', self._compressor.flush())
+            self._write_chunk(b'IEND', b'')
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class StreamingTIFFWriter:
+    """
+    逐段写出未压缩的8位RGBA TIFF文件
+
+    未压缩时每个条带（strip）的大小和偏移都可以预先算出，因此目录（IFD）写在文件开头，
+    之后像素行按顺序直接追加。文件大小受经典TIFF的32位偏移限制，不能超过4GB。
+    """
+
+    def __init__(self, path, width, height, rows_per_strip=256):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+
+        row_bytes = width * 4
+        strip_count = (height + rows_per_strip - 1) // rows_per_strip
+        byte_counts = [min(rows_per_strip, height - i * rows_per_strip) * row_bytes for i in range(strip_count)]
+
+        # 文件头、IFD和数组值的布局
+        entry_count = 11
+        ifd_offset = 8
+        ifd_size = 2 + entry_count * 12 + 4
+        bits_offset = ifd_offset + ifd_size
+        offsets_offset = bits_offset + 8
+        counts_offset = offsets_offset + 4 * strip_count
+        data_offset = counts_offset + 4 * strip_count
+        if data_offset + row_bytes * height > 0xFFFFFFFF:
+            raise ValueError("图像超过4GB，无法写出经典TIFF文件")
+
+        strip_offsets = []
+        offset = data_offset
+        for count in byte_counts:
+            strip_offsets.append(offset)
+            offset += count
+
+        def entry(tag, field_type, count, value):
+            # 类型3为SHORT，类型4为LONG；值不超过4字节时直接存放在条目中
+            if field_type == 3 and count == 1:
+                return struct.pack('<HHIHH', tag, field_type, count, value, 0)
+            return struct.pack('<HHII', tag, field_type, count, value)
+
+        def offsets_entry(tag, values, values_offset):
+            if len(values) == 1:
+                return entry(tag, 4, 1, values[0])
+            return entry(tag, 4, len(values), values_offset)
+
+        entries = [
+            entry(256, 4, 1, width),                 # ImageWidth
+            entry(257, 4, 1, height),                # ImageLength
+            entry(258, 3, 4, bits_offset),           # BitsPerSample
+            entry(259, 3, 1, 1),                     # Compression：不压缩
+            entry(262, 3, 1, 2),                     # PhotometricInterpretation：RGB
+            offsets_entry(273, strip_offsets, offsets_offset),  # StripOffsets
+            entry(277, 3, 1, 4),                     # SamplesPerPixel
+            entry(278, 4, 1, rows_per_strip),        # RowsPerStrip
+            offsets_entry(279, byte_counts, counts_offset),     # StripByteCounts
+            entry(284, 3, 1, 1),                     # PlanarConfiguration：交错存储
+            entry(338, 3, 1, 2),                     # ExtraSamples：非预乘alpha
+        ]
+
+        self._file = open(path, 'wb')
+        self._file.write(b'II*\x00' + struct.pack('<I', ifd_offset))
+        self._file.write(struct.pack('<H', entry_count) + b''.join(entries) + struct.pack('<I', 0))
+        self._file.write(struct.pack('<4H', 8, 8, 8, 8))
+        self._file.write(struct.pack(f'<{strip_count}I', *strip_offsets))
+        self._file.write(struct.pack(f'<{strip_count}I', *byte_counts))
+
+    def write_rows(self, rows):
+        """
+        写入若干行像素
+
+        参数:
+            rows: hxWx4 的uint8数组
+        """
+        if rows.shape[1:] != (self.width, 4):
+            raise ValueError(f"行尺寸 {rows.shape[1:]} 与图像宽度 {self.width} 不一致")
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError("写入的行数超过图像高度")
+        self._file.write(np.ascontiguousarray(rows, dtype=np.uint8).tobytes())
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"只写入了 {self.rows_written}/{self.height} 行")
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def open_image_writer(path, width, height, rows_per_strip=256):
+    """
+    根据扩展名创建流式图像写出器：.tif/.tiff 写出TIFF，其他写出PNG
+    """
+    if path.lower().endswith(('.tif', '.tiff')):
+        return StreamingTIFFWriter(path, width, height, rows_per_strip)
+    return StreamingPNGWriter(path, width, height)
@@ -8,6 +8,12 @@ from PIL import Image
 import argparse
 import re
 
+import psd_trace
+from psd_log import get_logger
+from psd_manifest import load_layer_manifest, manifest_entries
+
+logger = get_logger('html')
+
 def sanitize_css_name(name):
     """
     将图层名称转换为有效的CSS类名
@@ -65,9 +71,11 @@ def get_layer_css(layer, parent_path=''):
     
     return css_class_name, css
 
-def get_layer_html(layer, psd_info, output_dir, parent_path='', depth=0):
+def get_layer_html(layer, psd_info, output_dir, parent_path='', depth=0, entries=None):
     """
     生成图层的HTML代码
+    
+    entries为图层路径到图层清单条目的映射，为None时逐个尝试可能的图片路径
     """
     indent = '    ' * depth
     layer_name = layer['name']
@@ -105,11 +113,23 @@ def get_layer_html(layer, psd_info, output_dir, parent_path='', depth=0):
     
     # 查找第一个存在的图片路径
     img_path = None
-    for path in img_paths:
-        full_path = os.path.join(os.path.dirname(output_dir), path)
-        if os.path.exists(full_path):
-            img_path = path
-            break
+    img_style = ''
+    if entries is not None:
+        # 有图层清单时直接取图像路径，空图层没有图像
+        entry = entries.get(layer_path)
+        if entry is not None and entry.get('image'):
+            img_path = f"../data/image/layers/{entry['image']}"
+            # 图像已裁剪到不透明区域，按裁剪后的矩形相对图层定位
+            offset = (entry['left'] - layer['left'], entry['top'] - layer['top'])
+            if offset != (0, 0) or (entry['width'], entry['height']) != (layer['width'], layer['height']):
+                img_style = (f" style=\"position: absolute; left: {offset[0]}px; top: {offset[1]}px; "
+                             f"width: {entry['width']}px; height: {entry['height']}px;\"")
+    else:
+        for path in img_paths:
+            full_path = os.path.join(os.path.dirname(output_dir), path)
+            if os.path.exists(full_path):
+                img_path = path
+                break
     
     # 生成HTML代码
     html = f"{indent}<div class=\"layer {css_class_name}\" title=\"{layer_name}\">"
@@ -118,16 +138,17 @@ def get_layer_html(layer, psd_info, output_dir, parent_path='', depth=0):
     if is_group and 'children' in layer and layer['children']:
         html += "\n"
         for child in layer['children']:
-            html += get_layer_html(child, psd_info, output_dir, layer_path, depth + 1)
+            html += get_layer_html(child, psd_info, output_dir, layer_path, depth + 1, entries)
         html += f"{indent}"
     elif img_path:  # 如果找到了图片路径，添加图片
-        html += f"\n{indent}    <img src=\"{img_path}\" alt=\"{layer_name}\" />"
+        html += f"\n{indent}    <img src=\"{img_path}\" alt=\"{layer_name}\"{img_style} />"
         html += f"\n{indent}"
     
     html += "</div>\n"
     
     return html
 
+@psd_trace.traced('html_emit')
 def generate_html(psd_info, output_dir, output_file):
     """
     生成完整的HTML页面
@@ -254,9 +275,13 @@ body {
     <div class="psd-container" style="width: {psd_width}px; height: {psd_height}px;">
 """
     
+    # 有图层清单时直接从清单得到图像路径，不再逐个检查文件是否存在
+    manifest = load_layer_manifest(output_dir)
+    entries = manifest_entries(manifest) if manifest else None
+    
     # 添加图层HTML
     for layer in psd_info['layers']:
-        html += get_layer_html(layer, psd_info, output_dir)
+        html += get_layer_html(layer, psd_info, output_dir, entries=entries)
     
     # 添加JavaScript交互
     html += """    </div>
@@ -302,7 +327,7 @@ body {
     with open(output_file, 'w', encoding='utf-8') as f:
         f.write(html)
     
-    print(f"已生成HTML文件: {output_file}")
+    logger.info("已生成HTML文件: %s", output_file)
 
 def main():
     # 解析命令行参数
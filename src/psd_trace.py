@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+分阶段的耗时与内存记录
+
+在解析、提取、合成和HTML生成的关键步骤上记录区间（span），每个区间包含墙钟时间、
+当前线程的CPU时间和结束时进程的峰值常驻内存（RSS），可以导出为JSON或Chrome trace格式
+（在 chrome://tracing 或 https://ui.perfetto.dev 中打开），也可以按名称和参数汇总，
+查看哪些图层和混合模式占用了最多时间。
+
+默认关闭，关闭时 span() 返回共享的空上下文，循环内的开销可以忽略。开启方式:
+    import psd_trace
+    psd_trace.enable()
+    ...
+    psd_trace.export_chrome_trace('trace.json')
+
+或者设置环境变量后运行任意脚本，退出时自动导出并打印汇总:
+    PSD_TRACE=trace.json [PSD_TRACE_FORMAT=chrome|json] python src/psd_composer.py compose ...
+
+区间名称:
+    open            打开PSD文件（只读取结构时 args: mode=structure，映射文件时 mode=mmap）
+    walk            遍历图层树
+    layer_composite psd_tools 渲染单个图层（args: layer）
+    layer_decode    按需解压单个图层的通道数据（args: layer）
+    merged_decode   解压文件中保存的合并图像并写出PNG（args: file）
+    png_encode      编码并写出图像（args: file, format）
+    png_decode      读取并解码图层图像（args: file）
+    json_write      写出JSON文件（args: file）
+    compose_layer   合成单个叶子图层（args: layer, blend_mode）
+    compose_group   合成一个图层组，包含其子图层的区间，嵌套的图层组会重复计入（args: layer, blend_mode）
+    blend           按混合模式混合一次（args: mode）
+    html_emit       生成HTML页面
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextlib
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块，不记录峰值内存
+    resource = None
+
+_enabled = False
+_spans = []
+_lock = threading.Lock()
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def _peak_rss():
+    """
+    进程的峰值常驻内存（字节），无法获取时返回None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以KB为单位，macOS 以字节为单位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _Span:
+    """
+    一个正在记录的区间
+    """
+
+    __slots__ = ('name', 'args', 'start', 'cpu_start', 'rss_start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.rss_start = _peak_rss()
+        self.cpu_start = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        cpu = time.thread_time() - self.cpu_start
+        peak = _peak_rss()
+        record = {
+            'name': self.name,
+            'args': self.args,
+            # perf_counter 为系统单调时钟，不同进程记录的时间可以直接比较
+            'start': self.start,
+            'wall': end - self.start,
+            'cpu': cpu,
+            'peak_rss': peak,
+            'rss_growth': peak - self.rss_start if peak is not None else None,
+            'pid': os.getpid(),
+            'tid': threading.get_ident()
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        with _lock:
+            _spans.append(record)
+        return False
+
+
+def span(name, **args):
+    """
+    记录一个区间，用作上下文管理器:
+        with psd_trace.span('png_encode', file=path):
+            image.save(path)
+
+    参数:
+        name: 区间名称
+        args: 附加参数，如图层路径或混合模式，用于汇总和在trace中显示
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name):
+    """
+    装饰器形式的 span()，每次调用函数记录一个区间
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    清空已记录的区间
+    """
+    with _lock:
+        _spans.clear()
+
+
+def spans():
+    """
+    返回已记录区间的副本
+    """
+    with _lock:
+        return list(_spans)
+
+
+def drain():
+    """
+    返回并清空已记录的区间，供工作进程把区间交回主进程
+    """
+    with _lock:
+        drained = list(_spans)
+        _spans.clear()
+    return drained
+
+
+def merge(records):
+    """
+    合并其他进程记录的区间
+    """
+    with _lock:
+        _spans.extend(records)
+
+
+def summarize(key_args=('mode', 'blend_mode')):
+    """
+    按区间名称（以及混合模式等参数）汇总次数、总墙钟时间、总CPU时间和最大峰值内存
+
+    参数:
+        key_args: 参与分组的参数名，如 blend 区间按 mode 分组
+
+    返回:
+        按总墙钟时间降序排列的汇总列表
+    """
+    groups = defaultdict(lambda: {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': None})
+    for record in spans():
+        label = record['name']
+        extra = [str(record['args'][key]) for key in key_args if key in record['args']]
+        if extra:
+            label = f"{label}[{','.join(extra)}]"
+        group = groups[label]
+        group['count'] += 1
+        group['wall'] += record['wall']
+        group['cpu'] += record['cpu']
+        if record['peak_rss'] is not None:
+            group['peak_rss'] = max(group['peak_rss'] or 0, record['peak_rss'])
+    return sorted(({'name': label, **values} for label, values in groups.items()),
+                  key=lambda item: item['wall'], reverse=True)
+
+
+def print_summary(limit=30, file=None):
+    """
+    打印汇总表
+    """
+    file = file or sys.stderr
+    print(f"{'区间':<36}{'次数':>8}{'墙钟(ms)':>12}{'CPU(ms)':>12}{'峰值RSS(MB)':>14}", file=file)
+    for item in summarize()[:limit]:
+        peak = f"{item['peak_rss'] / (1024 * 1024):>14.1f}" if item['peak_rss'] is not None else f"{'-':>14}"
+        print(f"{item['name'][:36]:<36}{item['count']:>8}{item['wall'] * 1000:>12.1f}"
+              f"{item['cpu'] * 1000:>12.1f}{peak}", file=file)
+
+
+def export_json(path):
+    """
+    将所有区间和汇总写出为JSON
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'spans': spans(), 'summary': summarize()}, f, ensure_ascii=False, indent=2)
+
+
+def export_chrome_trace(path):
+    """
+    将所有区间写出为Chrome trace格式（完整事件 'X'，时间单位为微秒）
+    """
+    records = spans()
+    origin = min((record['start'] for record in records), default=0.0)
+    events = []
+    for record in records:
+        args = dict(record['args'])
+        args['cpu_ms'] = round(record['cpu'] * 1000, 3)
+        if record['peak_rss'] is not None:
+            args['peak_rss_mb'] = round(record['peak_rss'] / (1024 * 1024), 1)
+            args['rss_growth_mb'] = round(record['rss_growth'] / (1024 * 1024), 1)
+        if 'error' in record:
+            args['error'] = record['error']
+        events.append({
+            'name': record['name'],
+            'cat': 'psd',
+            'ph': 'X',
+            'ts': round((record['start'] - origin) * 1e6, 3),
+            'dur': round(record['wall'] * 1e6, 3),
+            'pid': record['pid'],
+            'tid': record['tid'],
+            'args': args
+        })
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+
+
+def _export_at_exit(path, trace_format):
+    if not _spans:
+        return
+    if trace_format == 'json':
+        export_json(path)
+    else:
+        export_chrome_trace(path)
+    print_summary()
+    print(f"已保存性能记录到: {path}", file=sys.stderr)
+
+
+# 通过环境变量开启时，在进程退出时导出；工作进程继承环境变量，但区间由主进程合并导出
+if os.environ.get('PSD_TRACE'):
+    enable()
+    if os.environ.get('_PSD_TRACE_WORKER') != '1':
+        os.environ['_PSD_TRACE_WORKER'] = '1'
+        atexit.register(_export_at_exit, os.environ['PSD_TRACE'], os.environ.get('PSD_TRACE_FORMAT', 'chrome'))
@@ -1,11 +1,10 @@
-from psd_tools import PSDImage
 import os
-import psd_tools.api.layers
+from psd_lazy import LazyPSD
 
 def visualize_psd_structure(psd_path):
     """可视化PSD文件的图层结构，特别关注深度嵌套的图层"""
-    # 打开PSD文件
-    psd = PSDImage.open(psd_path)
+    # 以映射模式打开PSD文件，只读取图层结构
+    psd = LazyPSD.open(psd_path, use_mmap=True)
     
     print(f"\n分析PSD文件: {os.path.basename(psd_path)}")
     print("=" * 50)
@@ -20,7 +19,7 @@ def visualize_psd_structure(psd_path):
         path = current_path + [layer.name]
         
         # 检查是否是图层组
-        is_group = isinstance(layer, psd_tools.api.layers.Group)
+        is_group = layer.is_group()
         
         # 更新最大深度
         if depth > max_depth_found[0]:
@@ -29,7 +28,7 @@ def visualize_psd_structure(psd_path):
         
         # 如果是当前最大深度的图层，记录路径
         if depth == max_depth_found[0] and not is_group:
-            deepest_paths.append((path, depth, layer.__class__.__name__))
+            deepest_paths.append((path, depth, layer.class_name))
         
         # 如果是图层组，递归分析子图层
         if is_group:
@@ -57,7 +56,7 @@ def visualize_psd_structure(psd_path):
         depth_stats[depth] = depth_stats.get(depth, 0) + 1
         
         # 如果是图层组，递归计算子图层
-        if isinstance(layer, psd_tools.api.layers.Group):
+        if layer.is_group():
             for child_layer in layer:
                 count_layers_by_depth(child_layer, depth + 1)
     
@@ -76,8 +75,8 @@ def visualize_psd_structure(psd_path):
     def print_group_structure(layer, indent=0, depth=0):
         # 图层基本信息
         prefix = "  " * indent
-        is_group = isinstance(layer, psd_tools.api.layers.Group)
-        layer_type = "Group" if is_group else layer.__class__.__name__
+        is_group = layer.is_group()
+        layer_type = "Group" if is_group else layer.class_name
         
         # 打印图层信息
         print(f"{prefix}{'└─' if indent > 0 else '├─'} {layer.name} [{layer_type}] (深度: {depth})")
@@ -88,12 +87,12 @@ def visualize_psd_structure(psd_path):
             if child_count > 0:
                 print(f"{prefix}  ├─ 包含 {child_count} 个子图层")
                 for child_layer in layer:
-                    if isinstance(child_layer, psd_tools.api.layers.Group):
+                    if child_layer.is_group():
                         print_group_structure(child_layer, indent + 1, depth + 1)
     
     # 只打印图层组结构
     for layer in psd:
-        if isinstance(layer, psd_tools.api.layers.Group):
+        if layer.is_group():
             print_group_structure(layer)
     
     print("=" * 50)